@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import platform
+import re
+from pathlib import Path
+from typing import Optional
+from config import ARTIFACT_CACHE_DIR
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _slug(value: str) -> str:
+    """Make a value safe to use as a directory name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", value).strip("_")
+
+def artifact_dir(kind: str, *key_parts: str) -> Optional[Path]:
+    """
+    Directory for cached artifacts of one kind, keyed by model and library versions.
+
+    Artifacts made for a different model, library version or CPU architecture
+    land in a different directory, so a stale one is never picked up.
+
+    Args:
+        kind: Artifact family, e.g. "inductor" or "onnxruntime"
+        key_parts: Model name, library versions and similar
+
+    Returns:
+        Existing directory, or None when ARTIFACT_CACHE_DIR is disabled
+    """
+    if not ARTIFACT_CACHE_DIR:
+        return None
+    key = "-".join(_slug(part) for part in (*key_parts, platform.machine()) if part)
+    path = Path(ARTIFACT_CACHE_DIR).resolve() / kind / key
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def enable_torch_compile_cache(model_name: str) -> Optional[Path]:
+    """
+    Point the torch.compile (inductor) caches at the artifact cache.
+
+    Must run before the first compilation in the process; later restarts
+    then reuse the compiled kernels instead of compiling again.
+
+    Returns:
+        Cache directory in use, or None when disabled or already configured
+    """
+    import torch
+
+    # Importing transformers already fills in torch's temp-dir default, so only
+    # a different value means the user chose a location themselves
+    configured = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+    try:
+        from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+        default = os.path.abspath(default_cache_dir())
+    except ImportError:
+        default = None
+    if configured and os.path.abspath(configured) != default:
+        return None
+
+    path = artifact_dir("inductor", model_name, f"torch{torch.__version__}")
+    if path is None:
+        return None
+    # Triton kernels go to a subdirectory of this unless TRITON_CACHE_DIR is set
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(path)
+    try:
+        torch._inductor.config.fx_graph_cache = True  # type: ignore[attr-defined]
+    except AttributeError:
+        pass
+    logger.info(f"torch.compile cache: {path}")
+    return path
+
+def onnx_optimized_path(source: Path, model_name: str, ort_version: str) -> Optional[Path]:
+    """
+    Where onnxruntime's optimized copy of an exported graph is kept.
+
+    Args:
+        source: Exported .onnx file
+        model_name: Model the graph was exported from
+        ort_version: onnxruntime version doing the optimization
+
+    Returns:
+        Path for the optimized graph, or None when the cache is disabled
+    """
+    path = artifact_dir("onnxruntime", model_name, f"ort{ort_version}")
+    if path is None:
+        return None
+    # Separate exports of the same model (different directories) must not share graphs
+    origin = hashlib.blake2b(str(source.resolve()).encode(), digest_size=6).hexdigest()
+    return path / f"{source.stem}-{origin}.optimized.onnx"
+
+def is_fresh(artifact: Path, source: Path) -> bool:
+    """Whether artifact exists and was written after source last changed."""
+    try:
+        return artifact.stat().st_mtime >= source.stat().st_mtime
+    except OSError:
+        return False
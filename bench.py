@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Benchmark the captioning pipeline offline.
+Feeds local images (or synthetic JPEGs) through the same path as Telegram
+images after download: fair scheduler slot, decode and preprocessing in the
+I/O pool, then batched captioning. Every combination of client concurrency
+and batch size is run for each backend, and throughput, latency percentiles,
+peak RSS and the per-stage breakdown are printed (or written) as JSON. Each
+backend runs in its own process. With --baseline, the run fails if
+throughput or p95 latency regressed beyond --tolerance.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from PIL import Image
+
+SUPPORTED_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+def make_synthetic_jpeg(index: int, width: int, height: int) -> bytes:
+    """Create a distinct colour JPEG that compresses like a real photo."""
+    # Coarse random structure keeps perceptual hashes apart (no false cache hits)
+    base = Image.blend(
+        Image.linear_gradient('L').rotate(index * 37),
+        Image.effect_noise((4, 4), 80).resize((256, 256), Image.Resampling.BICUBIC), 0.6
+    ).resize((width, height))
+    bands = [base] + [
+        Image.effect_noise((width // 4, height // 4), 20 + (index * 7 + offset) % 60).resize(
+            (width, height)
+        )
+        for offset in (0, 30)
+    ]
+    buffer = io.BytesIO()
+    Image.merge('RGB', bands).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+def load_inputs(image_dir: str, count: int, size: str) -> List[bytes]:
+    """Encoded image files to feed the pipeline, read up front so disk time is excluded."""
+    if image_dir:
+        paths = sorted(
+            path for path in Path(image_dir).iterdir()
+            if path.suffix.lower() in SUPPORTED_SUFFIXES
+        )[:count]
+        if not paths:
+            raise SystemExit(f"No images found in {image_dir}")
+        return [path.read_bytes() for path in paths]
+    width, height = (int(value) for value in size.lower().split('x'))
+    return [make_synthetic_jpeg(index, width, height) for index in range(count)]
+
+def read_rss_kb(field: str) -> int:
+    """Resident set size field (VmRSS or VmHWM) of this process in KiB (Linux)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS so each run reports its own peak (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+def _percentiles_ms(values: List[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+    return {
+        f"p{round(quantile * 100)}": round(
+            ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000, 1
+        )
+        for quantile in (0.5, 0.95, 0.99)
+    }
+
+def reset_stage_metrics():
+    """Drop stage samples so the next breakdown covers one run only."""
+    from metrics import METRICS, STAGE_METRIC
+
+    for labels in METRICS.collect(STAGE_METRIC):
+        METRICS.discard(STAGE_METRIC, **dict(labels))
+    METRICS.discard("caption_tokens_generated_total")
+
+def stage_breakdown() -> dict:
+    """Count and p50/p95/p99 per stage since the last reset, plus tokens generated."""
+    from metrics import METRICS, stage_percentiles
+
+    stages = {}
+    for stage, (count, percentiles) in sorted(stage_percentiles().items()):
+        stages[stage] = {"count": count}
+        stages[stage].update({
+            f"p{round(quantile * 100)}_ms": round(value * 1000, 2) if value is not None else None
+            for quantile, value in percentiles.items()
+        })
+    stages["tokens_generated"] = int(
+        METRICS.counter("caption_tokens_generated_total", "Caption tokens generated").value
+    )
+    return stages
+
+async def run_config(pipeline, inputs: List[bytes], requests: int, concurrency: int,
+                     batch_size: int, profile: str) -> dict:
+    """Caption requests images with concurrency clients, each waiting for its caption."""
+    from fair_scheduler import SchedulerBusyError
+
+    assert pipeline.caption_batcher is not None
+    pipeline.caption_batcher.max_batch_size = max(1, batch_size)
+    reset_stage_metrics()
+    reset_peak_rss()
+    rss_before = read_rss_kb('VmRSS')
+
+    latencies: List[float] = []
+    failures = 0
+    rejected = 0
+    next_request = iter(range(requests))
+
+    async def client(user: int):
+        nonlocal failures, rejected
+        for index in next_request:
+            started = time.perf_counter()
+            try:
+                slot = pipeline.scheduler.reserve(user)
+            except SchedulerBusyError:
+                rejected += 1
+                continue
+            async with slot:
+                await slot.wait()
+                image, _ = await pipeline.prepare_image(inputs[index % len(inputs)])
+                caption = None
+                if image is not None:
+                    caption, _ = await pipeline.caption_image(image, profile)
+            if caption is None:
+                failures += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # One user per client, as if each were a different chat
+    await asyncio.gather(*(client(user) for user in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "requests": requests,
+        "failures": failures,
+        "rejected": rejected,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_s": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": _percentiles_ms(latencies),
+        "peak_rss_mb": round(read_rss_kb('VmHWM') / 1024, 1),
+        "peak_rss_delta_mb": round((read_rss_kb('VmHWM') - rss_before) / 1024, 1),
+        "stages": stage_breakdown()
+    }
+
+async def run_backend(backend: str, inputs: List[bytes], requests: int,
+                      concurrencies: List[int], batch_sizes: List[int], profile: str,
+                      adaptive: bool, warm_up: bool) -> dict:
+    """Load one backend and run every concurrency/batch size combination."""
+    from generation_policy import AdaptiveProfilePolicy
+    from image_processor import ImageProcessor
+    from model_loader import ModelLoader
+    from pipeline import CaptionPipeline
+
+    loader = ModelLoader(backend, warm_up=warm_up)
+    caption_model = loader.load()
+    # Cycled inputs would otherwise be served from the embedding cache
+    if getattr(caption_model, "embedding_cache", None) is not None:
+        caption_model.embedding_cache = None
+
+    pipeline = CaptionPipeline(ImageProcessor(), caption_model)
+    if not adaptive:
+        # Keep the requested profile so runs stay comparable
+        pipeline.profile_policy = AdaptiveProfilePolicy(max_queue_depth=0, max_p95_ms=0)
+
+    runs = []
+    try:
+        for batch_size in batch_sizes:
+            for concurrency in concurrencies:
+                result = await run_config(pipeline, inputs, requests, concurrency,
+                                          batch_size, profile)
+                print(f"{backend} batch={batch_size} concurrency={concurrency}: "
+                      f"{result['images_per_s']} images/s, p95 {result['latency_ms']['p95']} ms",
+                      file=sys.stderr)
+                runs.append(result)
+    finally:
+        await pipeline.shutdown()
+
+    return {
+        "backend": backend,
+        "optimizations": getattr(caption_model, "optimizations", None),
+        "load_s": round(loader.elapsed, 2),
+        "profile": profile,
+        "runs": runs
+    }
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Runs whose throughput dropped or p95 latency rose by more than tolerance."""
+    regressions = []
+    for backend, result in results["backends"].items():
+        previous = {
+            (run["concurrency"], run["batch_size"]): run
+            for run in baseline.get("backends", {}).get(backend, {}).get("runs", [])
+        }
+        for run in result["runs"]:
+            before = previous.get((run["concurrency"], run["batch_size"]))
+            if before is None:
+                continue
+            name = f"{backend} concurrency={run['concurrency']} batch={run['batch_size']}"
+            if (before["images_per_s"] and run["images_per_s"] is not None
+                    and run["images_per_s"] < before["images_per_s"] * (1 - tolerance)):
+                regressions.append(f"{name}: {run['images_per_s']} images/s "
+                                   f"(baseline {before['images_per_s']})")
+            p95, before_p95 = run["latency_ms"]["p95"], before["latency_ms"]["p95"]
+            if p95 is not None and before_p95 and p95 > before_p95 * (1 + tolerance):
+                regressions.append(f"{name}: p95 {p95} ms (baseline {before_p95} ms)")
+    return regressions
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main():
+    """Run every backend in its own process and report JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=16, help="Distinct images to cycle through")
+    parser.add_argument("--size", default="1280x960", help="Synthetic image size, WIDTHxHEIGHT")
+    parser.add_argument("--backends", default="torch",
+                        help="Comma-separated caption backends (torch, onnx, remote)")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32],
+                        help="Comma-separated client concurrencies")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 8],
+                        help="Comma-separated maximum batch sizes")
+    parser.add_argument("--requests", type=int, default=64, help="Images captioned per run")
+    parser.add_argument("--profile", default=None, help="Generation profile (default DEFAULT_PROFILE)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Allow the fallback profile under load, as the bot does")
+    parser.add_argument("--no-warm-up", action="store_true", help="Skip the startup warm-up")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Earlier report to compare with; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative throughput/p95 change vs. the baseline")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from config import DEFAULT_PROFILE
+    profile = args.profile or DEFAULT_PROFILE
+
+    if args.worker:
+        inputs = load_inputs(args.images, args.count, args.size)
+        result = asyncio.run(run_backend(
+            args.worker, inputs, args.requests, args.concurrency, args.batch_sizes,
+            profile, args.adaptive, not args.no_warm_up
+        ))
+        print(json.dumps(result))
+        return
+
+    results = {
+        "inputs": args.images or f"synthetic {args.size} x{args.count}",
+        "requests_per_run": args.requests,
+        "backends": {}
+    }
+    for backend in [name.strip() for name in args.backends.split(',') if name.strip()]:
+        command = [
+            sys.executable, __file__, "--worker", backend, "--count", str(args.count),
+            "--size", args.size, "--requests", str(args.requests), "--profile", profile,
+            "--concurrency", ",".join(map(str, args.concurrency)),
+            "--batch-sizes", ",".join(map(str, args.batch_sizes))
+        ]
+        if args.images:
+            command += ["--images", args.images]
+        if args.adaptive:
+            command.append("--adaptive")
+        if args.no_warm_up:
+            command.append("--no-warm-up")
+        output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+        results["backends"][backend] = json.loads(output.strip().splitlines()[-1])
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Acceptance check: the memory budget bounds RSS under a burst of large uploads.
+Serves large synthetic PNGs and JPEGs from the fake Bot API (fake_bot_api.py,
+in its own process so its buffers are not counted) and captions --requests
+of them at once through CaptionPipeline.caption_telegram_file, the path the
+bot's handlers use: getFile, streamed download, decode, batching and the
+loaded caption model. Each upload comes from its own user and the scheduler
+admits all of them, so only the memory budgets limit how many are held.
+The burst runs with the budgets and then with them lifted, each in a fresh
+process so its peak RSS (VmHWM, Linux) is its own; the model is loaded and
+warmed up before the baseline is taken. Prints both runs as JSON and exits
+1 if the budgeted peak grew by more than the two budgets plus --slack, or
+if any upload went uncaptioned.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from PIL import Image
+
+# Nothing is sent to Telegram, but the token must be well-formed
+os.environ.setdefault("BOT_TOKEN", "123456:MEMORYTEST")
+
+MB = 1024 * 1024
+
+def make_large_image(index: int, width: int, height: int) -> bytes:
+    """A noisy image that barely compresses: PNG for even indexes, JPEG for odd ones."""
+    noise = [Image.effect_noise((width, height), 30 + (index * 11 + offset) % 50)
+             for offset in (0, 17, 34)]
+    image = Image.merge('RGB', noise)
+    buffer = io.BytesIO()
+    if index % 2 == 0:
+        image.save(buffer, format='PNG', compress_level=1)
+    else:
+        image.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+def build_uploads(distinct: int, requests: int, width: int, height: int) -> Dict[str, bytes]:
+    """One file id per request, cycling through a few distinct large files."""
+    images = [make_large_image(index, width, height) for index in range(distinct)]
+    return {f"upload{index}": images[index % distinct] for index in range(requests)}
+
+async def serve_uploads(args):
+    """Fake Bot API process: serve the uploads until terminated."""
+    from fake_bot_api import FakeBotApi
+
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    api = FakeBotApi()
+    api.files.update(build_uploads(args.distinct, args.requests, width, height))
+    await api.start()
+    print(f"listening {api.port}", flush=True)
+    await asyncio.Event().wait()
+
+async def run_burst(args, budgeted: bool) -> dict:
+    """Caption every upload concurrently through the pipeline, reporting peak RSS growth."""
+    from telegram import Bot
+    from bench import read_rss_kb, reset_peak_rss
+    from fair_scheduler import FairScheduler
+    from image_processor import ImageProcessor
+    from memory_budget import MemoryBudget
+    from model_loader import ModelLoader
+    from pipeline import CaptionPipeline
+
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, __file__, "--serve", "--requests", str(args.requests),
+        "--distinct", str(args.distinct), "--size", args.size,
+        stdout=asyncio.subprocess.PIPE
+    )
+    assert server.stdout is not None
+    port = int((await server.stdout.readline()).split()[-1])
+    token = os.environ["BOT_TOKEN"]
+    bot = Bot(token, base_url=f"http://127.0.0.1:{port}/bot",
+              base_file_url=f"http://127.0.0.1:{port}/file/bot")
+
+    pipeline = CaptionPipeline(ImageProcessor())
+    # Every upload is new work, and admission is left to the memory budgets
+    pipeline.caption_cache = None
+    pipeline.scheduler = FairScheduler(max_in_flight=args.requests,
+                                       max_queued=args.requests)
+    if budgeted:
+        pipeline.download_budget = MemoryBudget(args.download_budget * MB, "download")
+        pipeline.decode_budget = MemoryBudget(args.decode_budget * MB, "decode")
+    else:
+        pipeline.download_budget = MemoryBudget(sys.maxsize, "download")
+        pipeline.decode_budget = MemoryBudget(sys.maxsize, "decode")
+    pipeline.attach_model(ModelLoader().load())
+
+    try:
+        async with bot:
+            baseline_kb = read_rss_kb('VmRSS')
+            reset_peak_rss()
+            started = time.perf_counter()
+            captions = await asyncio.gather(*(
+                pipeline.caption_telegram_file(bot, file_id, file_id, args.profile, user=user)
+                for user, file_id in enumerate(f"upload{index}" for index in range(args.requests))
+            ))
+            elapsed = time.perf_counter() - started
+            peak_kb = read_rss_kb('VmHWM')
+    finally:
+        await pipeline.shutdown()
+        server.terminate()
+        await server.wait()
+
+    captioned = sum(caption is not None for caption in captions)
+    return {
+        "budgeted": budgeted,
+        "captioned": captioned,
+        "failed": len(captions) - captioned,
+        "duration_s": round(elapsed, 2),
+        "baseline_rss_mb": round(baseline_kb / 1024, 1),
+        "peak_rss_mb": round(peak_kb / 1024, 1),
+        "peak_growth_mb": round((peak_kb - baseline_kb) / 1024, 1),
+        "download_budget": pipeline.download_budget.get_stats(),
+        "decode_budget": pipeline.decode_budget.get_stats()
+    }
+
+def main():
+    """Run the burst with and without budgets, each in its own process."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100, help="Concurrent uploads")
+    parser.add_argument("--distinct", type=int, default=6, help="Distinct files among them")
+    parser.add_argument("--size", default="2400x1800", help="Image size, WIDTHxHEIGHT")
+    parser.add_argument("--profile", default="fast", help="Generation profile for the captions")
+    parser.add_argument("--download-budget", type=int, default=64,
+                        help="Download budget for the budgeted run (MB)")
+    parser.add_argument("--decode-budget", type=int, default=128,
+                        help="Decode budget for the budgeted run (MB)")
+    parser.add_argument("--slack", type=int, default=128,
+                        help="Allowed peak growth beyond the budgets (MB): threads, "
+                             "allocator, batches of model inputs")
+    parser.add_argument("--skip-unbudgeted", action="store_true",
+                        help="Only run with budgets (the unbudgeted run can need several GB)")
+    parser.add_argument("--worker", choices=("budgeted", "unbudgeted"), help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve_uploads(args))
+        return
+    if args.worker:
+        print(json.dumps(asyncio.run(run_burst(args, args.worker == "budgeted"))))
+        return
+
+    modes: List[str] = ["budgeted"] if args.skip_unbudgeted else ["budgeted", "unbudgeted"]
+    results = {}
+    for mode in modes:
+        command = [
+            sys.executable, __file__, "--worker", mode, "--requests", str(args.requests),
+            "--distinct", str(args.distinct), "--size", args.size, "--profile", args.profile,
+            "--download-budget", str(args.download_budget),
+            "--decode-budget", str(args.decode_budget)
+        ]
+        output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+
+    bound_mb = args.download_budget + args.decode_budget + args.slack
+    budgeted = results["budgeted"]
+    failures = []
+    if budgeted["peak_growth_mb"] > bound_mb:
+        failures.append(f"Peak RSS grew by {budgeted['peak_growth_mb']} MB with budgets, "
+                        f"above {bound_mb} MB")
+    if budgeted["failed"]:
+        failures.append(f"{budgeted['failed']} upload(s) were not captioned")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
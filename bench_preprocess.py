@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Benchmark image decoding and preprocessing.
+Compares the previous full-resolution decode + LANCZOS path with the
+draft-mode fast path in ImageProcessor.preprocess_image. Each mode runs in
+its own process so that peak RSS is measured independently.
+"""
+
+import argparse
+import io
+import json
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+# Typical phone camera resolutions
+DEFAULT_SIZES = ["4032x3024", "4000x3000", "3024x4032", "8000x6000"]
+
+def make_synthetic_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    """Create a noisy colour JPEG that compresses like a real photo."""
+    bands = [
+        Image.effect_noise((width // 4, height // 4), sigma).resize((width, height))
+        for sigma in (30, 50, 70)
+    ]
+    image = Image.merge('RGB', bands)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def legacy_preprocess(data: bytes, max_size: int) -> Image.Image:
+    """Previous pipeline: full decode, RGB conversion, then LANCZOS if oversized."""
+    image = Image.open(io.BytesIO(data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        new_size = (int(image.size[0] * ratio), int(image.size[1] * ratio))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    return image
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process in KiB."""
+    # VmHWM is reset on exec, unlike ru_maxrss which is inherited from the parent
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_worker(mode: str, paths: list, repeat: int) -> dict:
+    """Time one preprocessing mode over the given files (runs in a subprocess)."""
+    from config import MAX_IMAGE_SIZE
+    from image_processor import ImageProcessor
+
+    processor = ImageProcessor()
+    files = [Path(path).read_bytes() for path in paths]
+    baseline_rss = peak_rss_kb()
+
+    timings = []
+    output_size = None
+    for _ in range(repeat):
+        for data in files:
+            start = time.perf_counter()
+            if mode == 'legacy':
+                image = legacy_preprocess(data, MAX_IMAGE_SIZE)
+            else:
+                image = processor.preprocess_image(Image.open(io.BytesIO(data)))
+            image.load()
+            timings.append(time.perf_counter() - start)
+            output_size = image.size
+            del image
+
+    timings.sort()
+    peak_rss = peak_rss_kb()
+    return {
+        "mode": mode,
+        "images": len(timings),
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 2),
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 2),
+        "max_ms": round(timings[-1] * 1000, 2),
+        "last_output_size": list(output_size) if output_size else None,
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "peak_rss_delta_mb": round((peak_rss - baseline_rss) / 1024, 1)
+    }
+
+def collect_images(args) -> list:
+    """Use images from --images or write synthetic phone-sized JPEGs."""
+    if args.images:
+        paths = sorted(
+            str(path) for path in Path(args.images).iterdir()
+            if path.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+        )
+        if not paths:
+            raise SystemExit(f"No images found in {args.images}")
+        return paths
+
+    out_dir = Path(args.workdir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for size in args.sizes.split(','):
+        width, height = (int(value) for value in size.lower().split('x'))
+        path = out_dir / f"synthetic_{width}x{height}.jpg"
+        if not path.exists():
+            path.write_bytes(make_synthetic_jpeg(width, height))
+        paths.append(str(path))
+    return paths
+
+def main():
+    """Run both modes and print a JSON comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", help="Directory of images to use instead of synthetic ones")
+    parser.add_argument("--sizes", default=",".join(DEFAULT_SIZES),
+                        help="Comma-separated WxH sizes for synthetic JPEGs")
+    parser.add_argument("--workdir", default=".bench_images", help="Where synthetic images are written")
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the image set")
+    parser.add_argument("--worker", choices=["legacy", "fast"], help=argparse.SUPPRESS)
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.paths, args.repeat)))
+        return
+
+    paths = collect_images(args)
+    results = {}
+    for mode in ("legacy", "fast"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--worker", mode, "--repeat", str(args.repeat), *paths],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    results["speedup"] = round(results["legacy"]["mean_ms"] / results["fast"]["mean_ms"], 2)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
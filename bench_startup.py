@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark bot cold start.
+Measures, from process start, how long it takes until the bot can answer a
+command (/start) and until it returns its first caption, with lazy and eager
+model loading. Each mode runs in a fresh process. Handlers are called
+directly with stub updates, so Telegram network time is not included.
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+class _StubMessage:
+    """Records replies instead of sending them."""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append((time.time(), text))
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.replies.append((time.time(), text))
+        return self
+
+def _stub_update():
+    return SimpleNamespace(message=_StubMessage(), effective_user=None)
+
+def _stub_context():
+    return SimpleNamespace(args=[], chat_data={}, bot=None)
+
+async def _scenario(bot, started_at: float) -> dict:
+    """Answer /start and /status, then caption one synthetic image."""
+    from PIL import Image
+
+    timings = {}
+    loading = None
+    if bot.caption_model is None:
+        # What on_startup does once polling begins
+        loading = asyncio.get_running_loop().create_task(bot.load_model())
+
+    update = _stub_update()
+    await bot.start_command(update, _stub_context())
+    timings["first_reply_s"] = update.message.replies[0][0] - started_at
+
+    update = _stub_update()
+    await bot.status_command(update, _stub_context())
+    timings["status_during_startup"] = "Ready to process images" not in update.message.replies[0][1]
+
+    image = Image.effect_noise((384, 384), 40).convert('RGB')
+    caption, _ = await bot.pipeline.caption_image(image, "fast")
+    timings["first_caption_s"] = time.time() - started_at
+    timings["caption_ok"] = caption is not None
+
+    if loading is not None:
+        await loading
+    timings["model_load_s"] = bot.model_loader.elapsed
+    await bot.pipeline.shutdown()
+    return timings
+
+def run_worker(mode: str, started_at: float) -> dict:
+    """Import and start the bot in one mode, recording milestones."""
+    import bot as bot_module
+    imported_at = time.time()
+    bot = bot_module.ImageCaptionBot(lazy_model_loading=(mode == "lazy"))
+    initialized_at = time.time()
+
+    result = {
+        "import_s": imported_at - started_at,
+        "init_s": initialized_at - started_at
+    }
+    result.update(asyncio.run(_scenario(bot, started_at)))
+    return {
+        key: round(value, 3) if isinstance(value, float) else value
+        for key, value in result.items()
+    }
+
+def main():
+    """Run both modes and print a JSON comparison."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", default="lazy,eager", help="Comma-separated: lazy, eager")
+    parser.add_argument("--worker", choices=["lazy", "eager"], help=argparse.SUPPRESS)
+    parser.add_argument("--started-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.started_at)))
+        return
+
+    results = {}
+    for mode in [mode.strip() for mode in args.modes.split(',') if mode.strip()]:
+        started_at = time.time()
+        output = subprocess.run(
+            [sys.executable, __file__, "--worker", mode, "--started-at", str(started_at)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    if "lazy" in results and "eager" in results:
+        results["first_reply_speedup"] = round(
+            results["eager"]["first_reply_s"] / results["lazy"]["first_reply_s"], 1
+        )
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Load-test the bot in webhook mode.
+Starts the bot's webhook server locally and posts synthetic text/command
+updates to it over HTTP at a fixed client concurrency from a separate
+process. Bot API calls (setWebhook, sendMessage) go to the local stand-in
+from fake_bot_api.py instead of Telegram. Reports how fast updates are accepted by the webhook and how fast
+they are fully handled (reply sent), plus request latency percentiles.
+No model is loaded; the handlers exercised do not need one.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+# The application needs a well-formed token; nothing is sent to Telegram
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+
+def _synthetic_update(update_id: int, users: int, text: str) -> dict:
+    user_id = 1000 + update_id % users
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}
+               if text.startswith("/") else {})
+        }
+    }
+
+def _percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def post_updates(url: str, secret: str, updates: int, concurrency: int,
+                       users: int, text: str) -> dict:
+    """Post synthetic updates over HTTP keep-alive connections and time each request."""
+    import httpx
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    latencies = []
+    failures = 0
+    next_id = iter(range(1, updates + 1))
+
+    async def client(http: httpx.AsyncClient):
+        nonlocal failures
+        for update_id in next_id:
+            started = time.perf_counter()
+            response = await http.post(url, json=_synthetic_update(update_id, users, text),
+                                       headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failures += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    started = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=30) as http:
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+    return {
+        "elapsed_s": time.perf_counter() - started,
+        "failures": failures,
+        "latencies": latencies
+    }
+
+async def run_load_test(updates: int, concurrency: int, concurrent_updates: int,
+                        users: int, text: str, port: int) -> dict:
+    """Start the webhook locally and load it from a separate client process."""
+    import bot as bot_module
+    from config import ALLOWED_UPDATES, WEBHOOK_PATH
+    from fake_bot_api import FakeBotApi
+
+    api = FakeBotApi()
+    api.start_in_thread()
+    bot = bot_module.ImageCaptionBot(lazy_model_loading=True)
+    application = bot.build_application(
+        concurrent_updates=concurrent_updates, base_url=f"http://127.0.0.1:{api.port}/bot"
+    )
+    secret = "loadtest-secret"
+    await application.initialize()
+    await application.start()
+    assert application.updater is not None
+    await application.updater.start_webhook(
+        listen="127.0.0.1", port=port, url_path=WEBHOOK_PATH,
+        secret_token=secret, allowed_updates=ALLOWED_UPDATES
+    )
+
+    # The load generator gets its own process so it does not compete for the bot's loop
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, __file__, "--client", f"http://127.0.0.1:{port}/{WEBHOOK_PATH}",
+        "--secret", secret, "--updates", str(updates), "--concurrency", str(concurrency),
+        "--users", str(users), "--text", text,
+        stdout=asyncio.subprocess.PIPE
+    )
+    output, _ = await process.communicate()
+    client = json.loads(output.decode().strip().splitlines()[-1])
+
+    # Every handled update sends one reply
+    expected = updates - client["failures"]
+    while api.sent < expected and time.perf_counter() - started < 120:
+        await asyncio.sleep(0.01)
+    handled_s = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.pipeline.shutdown()
+    api.stop()
+
+    latencies = client["latencies"]
+    return {
+        "updates": updates,
+        "client_concurrency": concurrency,
+        "concurrent_updates": concurrent_updates,
+        "failed_posts": client["failures"],
+        "replies_sent": api.sent,
+        "accepted_per_s": round(updates / client["elapsed_s"], 1),
+        "handled_per_s": round(api.sent / handled_s, 1),
+        "post_latency_ms": {
+            "p50": round(statistics.median(latencies) * 1000, 2),
+            "p95": round(_percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 2)
+        }
+    }
+
+def main():
+    """Run the load test and print JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000, help="Updates to post")
+    parser.add_argument("--concurrency", type=int, default=32, help="Simultaneous HTTP requests")
+    parser.add_argument("--concurrent-updates", type=int, default=None,
+                        help="Updates the bot handles at once (default CONCURRENT_UPDATES)")
+    parser.add_argument("--users", type=int, default=50, help="Distinct synthetic users")
+    parser.add_argument("--text", default="hello", help='Message text, e.g. "hello" or "/start"')
+    parser.add_argument("--port", type=int, default=8088, help="Local webhook port")
+    parser.add_argument("--client", metavar="URL", help=argparse.SUPPRESS)
+    parser.add_argument("--secret", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        print(json.dumps(asyncio.run(post_updates(
+            args.client, args.secret, args.updates, args.concurrency, args.users, args.text
+        ))))
+        return
+
+    from config import CONCURRENT_UPDATES
+    results = asyncio.run(run_load_test(
+        args.updates, args.concurrency, args.concurrent_updates or CONCURRENT_UPDATES,
+        args.users, args.text, args.port
+    ))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
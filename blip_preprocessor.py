@@ -0,0 +1,102 @@
+import logging
+import threading
+from typing import List, Tuple
+import numpy as np
+import torch
+from PIL import Image
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class BlipPreprocessor:
+    """Vectorized replacement for BlipProcessor's per-request image and prompt handling."""
+
+    def __init__(self, processor, prompt: str):
+        """
+        Read resize/normalization settings from a loaded BlipProcessor.
+
+        Args:
+            processor: Loaded BlipProcessor (provides image settings and tokenizer)
+            prompt: Constant text prompt, tokenized once here
+        """
+        image_processor = processor.image_processor
+        size = image_processor.size
+        self.height = int(size["height"])
+        self.width = int(size["width"])
+        self.resample = Image.Resampling(int(image_processor.resample))
+
+        # Rescale and normalize fold into one multiply-add per channel:
+        # (x * rescale - mean) / std == x * (rescale / std) + (-mean / std)
+        rescale = float(image_processor.rescale_factor) if image_processor.do_rescale else 1.0
+        if image_processor.do_normalize:
+            mean = torch.tensor(image_processor.image_mean, dtype=torch.float32)
+            std = torch.tensor(image_processor.image_std, dtype=torch.float32)
+        else:
+            mean = torch.zeros(3)
+            std = torch.ones(3)
+        self.scale = (rescale / std).view(1, 3, 1, 1)
+        self.bias = (-mean / std).view(1, 3, 1, 1)
+
+        # The prompt never changes, so tokenize it once
+        tokenizer = processor.tokenizer
+        prompt_inputs = tokenizer(prompt, return_tensors="pt")
+        self.prompt_ids: torch.Tensor = prompt_inputs["input_ids"]
+        self.prompt_mask: torch.Tensor = prompt_inputs["attention_mask"]
+
+        # Batches may run on several inference threads; each keeps its own buffers
+        self._buffers = threading.local()
+
+    def _get_buffers(self, batch_size: int) -> Tuple[np.ndarray, torch.Tensor]:
+        """Return this thread's uint8 staging and float output buffers, grown if needed."""
+        staging = getattr(self._buffers, "staging", None)
+        if staging is None or staging.shape[0] < batch_size:
+            staging = np.empty((batch_size, self.height, self.width, 3), dtype=np.uint8)
+            output = torch.empty((batch_size, 3, self.height, self.width), dtype=torch.float32)
+            self._buffers.staging = staging
+            self._buffers.output = output
+        return staging[:batch_size], self._buffers.output[:batch_size]
+
+    def pixel_values(self, images: List[Image.Image]) -> torch.Tensor:
+        """
+        Convert a batch of PIL images into normalized model input.
+
+        The returned tensor is a view into a per-thread buffer that is reused
+        by the next call on the same thread, so consume it before then.
+
+        Args:
+            images: List of PIL Image objects
+
+        Returns:
+            Float tensor of shape (batch, 3, height, width)
+        """
+        staging, output = self._get_buffers(len(images))
+
+        for index, image in enumerate(images):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            if image.size != (self.width, self.height):
+                image = image.resize((self.width, self.height), self.resample)
+            staging[index] = np.asarray(image)
+
+        # NHWC uint8 -> NCHW float32 in one copy, then a fused in-place affine
+        output.copy_(torch.from_numpy(staging).permute(0, 3, 1, 2))
+        output.mul_(self.scale).add_(self.bias)
+        return output
+
+    def prompt_inputs(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get the tokenized prompt repeated for a batch.
+
+        Copies are returned because BLIP's generate edits input_ids in place.
+
+        Args:
+            batch_size: Number of images in the batch
+
+        Returns:
+            Tuple of (input_ids, attention_mask)
+        """
+        return (
+            self.prompt_ids.repeat(batch_size, 1),
+            self.prompt_mask.repeat(batch_size, 1)
+        )
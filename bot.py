@@ -1,12 +1,28 @@
 import asyncio
 import logging
+import secrets
+import time
+from typing import Optional
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 
-from config import BOT_TOKEN, WELCOME_MESSAGE, ERROR_MESSAGE, PROCESSING_MESSAGE
+from config import (
+    BOT_TOKEN, WELCOME_MESSAGE, ERROR_MESSAGE, PROCESSING_MESSAGE,
+    CONCURRENT_UPDATES, BOT_CONNECTION_POOL_SIZE, GENERATION_PROFILES, DEFAULT_PROFILE,
+    STREAM_EDIT_INTERVAL, LAZY_MODEL_LOADING, WARMING_UP_MESSAGE, BUSY_MESSAGE,
+    UPDATE_MODE, ALLOWED_UPDATES, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, MAX_DOWNLOAD_BYTES, FILE_TOO_LARGE_MESSAGE,
+    METRICS_HOST, METRICS_PORT, TRACE_PATH, BOT_API_BASE_URL, BOT_API_FILE_URL
+)
+from fair_scheduler import SchedulerBusyError
 from image_processor import ImageProcessor
-from caption_model import CaptionModel
+from media_group import MediaGroupCollector
+from metrics import METRICS, observe_stage, serve_metrics, stage_percentiles
+from model_loader import ModelLoader
+from pipeline import CaptionPipeline
+from request_trace import TraceRecorder
 
 # Set up logging
 logging.basicConfig(
@@ -14,15 +30,70 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logs every Bot API request (token included) at INFO, one line per update
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Order of the stages in /status, roughly as an image passes through them
+STATUS_STAGES = ("total", "album_total", "scheduler_wait", "get_file", "download", "decode",
+                 "hash", "caption", "batch", "preprocess", "encoder", "decoder")
+
+def _count_request(result: str):
+    """Count a handled image request by outcome."""
+    METRICS.counter("caption_requests_total", "Image requests by outcome", result=result).inc()
+
+def _close_unused_model(loading: asyncio.Future):
+    """Close a model whose load finished after the bot stopped waiting for it."""
+    if loading.cancelled() or loading.exception() is not None:
+        return
+    close = getattr(loading.result(), "close", None)
+    if close is not None:
+        close()
 
 class ImageCaptionBot:
     """Telegram bot for image captioning using BLIP model."""
     
-    def __init__(self):
+    def __init__(self, lazy_model_loading: bool = LAZY_MODEL_LOADING):
         self.image_processor = ImageProcessor()
-        self.caption_model = CaptionModel()
+        self.model_loader = ModelLoader()
+        self.caption_model = None
+        # Without a model the pipeline still downloads and decodes images;
+        # they wait for captioning until the model is attached
+        self.pipeline = CaptionPipeline(self.image_processor)
+        self.media_groups = MediaGroupCollector()
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        self._load_task: Optional[asyncio.Task] = None
+        # Anonymized record of image requests for replay_trace.py
+        self.trace = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+        self.lazy_model_loading = lazy_model_loading
+        if not lazy_model_loading:
+            self._attach_model(self.model_loader.load())
         logger.info("Bot initialized successfully!")
     
+    def _attach_model(self, caption_model):
+        """Start captioning with a loaded model."""
+        self.caption_model = caption_model
+        self.pipeline.attach_model(caption_model)
+        logger.info("📊 Model info:")
+        for key, value in caption_model.get_model_info().items():
+            logger.info(f"   {key}: {value}")
+        logger.info("✅ Bot is ready to process images!")
+    
+    async def load_model(self):
+        """Load the caption model in a worker thread while the bot keeps serving updates."""
+        loop = asyncio.get_running_loop()
+        loading = loop.run_in_executor(None, self.model_loader.load)
+        try:
+            caption_model = await asyncio.shield(loading)
+        except asyncio.CancelledError:
+            # The loader thread cannot be interrupted; close the model if it still arrives
+            loading.add_done_callback(_close_unused_model)
+            raise
+        except Exception as e:
+            logger.error(f"❌ Failed to load caption model: {e}")
+            self.pipeline.fail_model()
+            return
+        self._attach_model(caption_model)
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command."""
         if update.message is not None:
@@ -46,6 +117,7 @@ class ImageCaptionBot:
 /start - Start the bot and see welcome message
 /help - Show this help message
 /status - Show bot and model status
+/mode - Show or change the caption style (fast, quality, creative)
 
 <b>How to use:</b>
 1. Send me any image (JPG, PNG, BMP, WebP)
@@ -71,62 +143,315 @@ class ImageCaptionBot:
             logger.warning("No message found in update for /status command.")
             return
             
-        model_info = self.caption_model.get_model_info()
-        status_text = f"""
-🤖 <b>Bot Status</b>
-
-<b>Model Information:</b>
+        if self.caption_model is not None:
+            model_info = self.caption_model.get_model_info()
+            model_status = f"""<b>Model Information:</b>
 • Model: {model_info['model_name']}
 • Device: {model_info['device']}
 • Max Length: {model_info['max_length']}
-• Beams: {model_info['num_beams']}
-• Temperature: {model_info['temperature']}
+• Optimizations: {model_info['optimizations']}
+• Embedding Cache: {self._format_embedding_cache(model_info['embedding_cache'])}
+"""
+            ready_status = "✅ Ready to process images\n✅ Model loaded successfully"
+        else:
+            model_status = f"<b>Model:</b> ⏳ {self.model_loader.describe()}\n"
+            ready_status = "⏳ Images are queued until the model is ready"
+        
+        status_text = f"""
+🤖 <b>Bot Status</b>
 
+{model_status}
+{self._format_cache_status()}
+{self._format_photo_status()}
+{self._format_profile_status(context.chat_data)}
+{self._format_scheduler_status()}
+{self._format_memory_status()}
+{self._format_latency_status()}
 <b>Bot Status:</b>
-✅ Ready to process images
-✅ Model loaded successfully
-✅ Image processor initialized
+{ready_status}
         """
         await update.message.reply_text(status_text, parse_mode=ParseMode.HTML)
     
-    async def handle_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle incoming images."""
+    def _format_cache_status(self) -> str:
+        """Format caption cache counters for the /status message."""
+        cache = self.pipeline.caption_cache
+        if cache is None:
+            return "<b>Caption Cache:</b> disabled\n"
+        
+        stats = cache.get_stats()
+        return (
+            "<b>Caption Cache:</b>\n"
+            f"• File ID: {stats['file_id_hits']} hits, {stats['file_id_misses']} misses\n"
+            f"• Similar image: {stats['hash_hits']} hits, {stats['hash_misses']} misses\n"
+            f"• Entries: {stats['entries']}"
+            f"{' (persistent)' if stats['persistent'] else ''}\n"
+        )
+    
+    def _format_photo_status(self) -> str:
+        """Format photo size selection savings for the /status message."""
+        stats = self.image_processor.get_photo_stats()
+        return (
+            "<b>Photo Downloads:</b>\n"
+            f"• Photos: {stats['photos']}\n"
+            f"• Downloaded: {stats['bytes_downloaded'] / 1e6:.1f} MB\n"
+            f"• Saved vs. full size: {stats['bytes_saved'] / 1e6:.1f} MB ({stats['saved_percent']}%)\n"
+        )
+    
+    def _format_profile_status(self, chat_data: Optional[dict]) -> str:
+        """Format the chat's profile and adaptive profile counters for the /status message."""
+        policy = self.pipeline.profile_policy
+        stats = policy.get_stats()
+        p95 = f"{stats['p95_ms']} ms" if stats['p95_ms'] is not None else "n/a"
+        profile = policy.resolve((chat_data or {}).get("profile"))
+        batcher = self.pipeline.caption_batcher
+        active = profile
+        if profile != policy.fallback_profile and policy.overloaded(batcher.pending if batcher else 0):
+            active = policy.fallback_profile
+        settings = ", ".join(
+            f"{key.replace('_', ' ')} {value}" for key, value in GENERATION_PROFILES[active].items()
+        )
+        fallback = f" (falling back from {profile} under load)" if active != profile else ""
+        return (
+            "<b>Generation:</b>\n"
+            f"• This chat: {active}{fallback}\n"
+            f"• Decoding: {settings}\n"
+            f"• p95 latency: {p95} ({stats['samples']} samples)\n"
+            f"• Fallbacks under load: {stats['fallbacks']}\n"
+        )
+    
+    def _format_scheduler_status(self) -> str:
+        """Format fair scheduler load for the /status message."""
+        scheduler = self.pipeline.scheduler
+        stats = scheduler.get_stats()
+        return (
+            "<b>Scheduler:</b>\n"
+            f"• In flight: {stats['in_flight']}/{scheduler.max_in_flight}\n"
+            f"• Queued: {stats['queued']} from {stats['waiting_users']} user(s)\n"
+            f"• Rejected as busy: {stats['rejected']}\n"
+        )
+    
+    def _format_memory_status(self) -> str:
+        """Format memory budget use for the /status message."""
+        lines = ["<b>Memory Budget:</b>"]
+        for budget in (self.pipeline.download_budget, self.pipeline.decode_budget):
+            stats = budget.get_stats()
+            lines.append(
+                f"• {budget.name.capitalize()}: {stats['in_use'] / 2**20:.0f}/{stats['limit'] / 2**20:.0f} MB"
+                f" (peak {stats['peak'] / 2**20:.0f} MB, {stats['waiting']} waiting,"
+                f" {stats['timeouts']} refused)"
+            )
+        return "\n".join(lines) + "\n"
+    
+    def _format_latency_status(self) -> str:
+        """Format per-stage latency percentiles for the /status message."""
+        stages = stage_percentiles()
+        if not stages:
+            return "<b>Latency:</b> no images handled yet\n"
+        
+        def ms(value: Optional[float]) -> str:
+            return f"{value * 1000:.0f}" if value is not None else "n/a"
+        
+        ordered = [stage for stage in STATUS_STAGES if stage in stages]
+        ordered += sorted(set(stages) - set(ordered))
+        lines = ["<b>Latency (p50/p95/p99 ms):</b>"]
+        for stage in ordered:
+            count, percentiles = stages[stage]
+            lines.append(f"• {stage}: {ms(percentiles[0.5])}/{ms(percentiles[0.95])}/"
+                         f"{ms(percentiles[0.99])} ({count})")
+        tokens = METRICS.counter("caption_tokens_generated_total", "Caption tokens generated").value
+        lines.append(f"• Tokens generated: {int(tokens)}")
+        return "\n".join(lines) + "\n"
+    
+    async def mode_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /mode command: show or set the chat's generation profile."""
         if update.message is None:
-            logger.warning("No message found in update for image handling.")
+            logger.warning("No message found in update for /mode command.")
             return
-            
+        
+        chat_data = context.chat_data if context.chat_data is not None else {}
+        profiles = ", ".join(GENERATION_PROFILES)
+        if not context.args:
+            current = chat_data.get("profile", DEFAULT_PROFILE)
+            await update.message.reply_text(
+                f"Current caption mode: <b>{current}</b>\nAvailable: {profiles}\n"
+                "Use /mode &lt;name&gt; to change it.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+        
+        profile = context.args[0].lower()
+        if profile not in GENERATION_PROFILES:
+            await update.message.reply_text(f"❌ Unknown mode. Available: {profiles}")
+            return
+        
+        chat_data["profile"] = profile
+        await update.message.reply_text(f"✅ Caption mode set to {profile}.")
+    
+    def _format_embedding_cache(self, stats: Optional[dict]) -> str:
+        """Format vision-encoder cache counters for the /status message."""
+        if stats is None:
+            return "disabled"
+        return (f"{stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['entries']} entries ({stats['bytes'] / (1024 * 1024):.1f} MB)")
+    
+    async def _describe_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             file_id: str, file_unique_id: str):
+        """
+        Caption a Telegram file and reply with the description.
+        
+        Args:
+            update: Incoming Telegram update with a message
+            context: Handler context
+            file_id: Telegram file id of the image to describe
+            file_unique_id: Telegram file_unique_id, used as the cache key
+        """
+        assert update.message is not None
+        
+        # Albums arrive as one message per photo; answer them together
+        if update.message.media_group_id:
+            await self._describe_album(update, context, file_id, file_unique_id)
+            return
+        
+        started = time.perf_counter()
+        # Re-sent and forwarded files are answered without downloading
+        chat_data = context.chat_data if context.chat_data is not None else {}
+        cached = await self.pipeline.get_cached_caption(file_unique_id, chat_data.get("profile"))
+        if cached is not None:
+            response_text = f"📸 <b>Image Description:</b>\n\n{cached}"
+            await update.message.reply_text(response_text, parse_mode=ParseMode.HTML)
+            observe_stage("total", time.perf_counter() - started)
+            _count_request("cached")
+            return
+        
+        # Refuse straight away when this user (or everyone) has too much queued
+        user = update.effective_user.id if update.effective_user else update.message.chat_id
         try:
-            # Get the photo with highest quality
-            photo = update.message.photo[-1]
-            
+            slot = self.pipeline.scheduler.reserve(user)
+        except SchedulerBusyError:
+            logger.info(f"Rejected image from user {user}: scheduler queues are full")
+            await update.message.reply_text(BUSY_MESSAGE)
+            _count_request("busy")
+            return
+        
+        async with slot:
             # Send processing message
-            processing_msg = await update.message.reply_text(PROCESSING_MESSAGE)
-            
-            # Get file path
-            file = await context.bot.get_file(photo.file_id)
-            file_path = file.file_path
-            
-            if file_path is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
-                return
-            
-            # Process image
-            processed_image = self.image_processor.process_telegram_image(file_path)
+            processing_msg = await update.message.reply_text(
+                PROCESSING_MESSAGE if self.pipeline.model_ready else WARMING_UP_MESSAGE
+            )
             
-            if processed_image is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
-                return
+            # Download, preprocess and caption off the event loop
+            loop = asyncio.get_running_loop()
             
-            # Generate caption
-            caption = self.caption_model.generate_caption(processed_image)
+            async def show_partial(text: str):
+                # Telegram rate-limits edits, so show at most one partial per interval per chat
+                now = loop.time()
+                if now - chat_data.get("last_edit", 0.0) < STREAM_EDIT_INTERVAL:
+                    return
+                chat_data["last_edit"] = now
+                try:
+                    await processing_msg.edit_text(f"📸 <b>Image Description:</b>\n\n{text}…",
+                                                   parse_mode=ParseMode.HTML)
+                except TelegramError as e:
+                    logger.debug(f"Skipping partial caption edit: {e}")
             
-            if caption is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
-                return
+            caption = await self.pipeline.caption_telegram_file(
+                context.bot, file_id, file_unique_id, chat_data.get("profile"), show_partial,
+                slot=slot
+            )
+        
+        if caption is None:
+            await processing_msg.edit_text(ERROR_MESSAGE)
+            _count_request("failed")
+            return
+        
+        # Send the caption
+        response_text = f"📸 <b>Image Description:</b>\n\n{caption}"
+        await processing_msg.edit_text(response_text, parse_mode=ParseMode.HTML)
+        observe_stage("total", time.perf_counter() - started)
+        _count_request("ok")
+    
+    async def _describe_album(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              file_id: str, file_unique_id: str):
+        """
+        Collect the photos of an album and reply once with all their captions.
+        
+        Only the album's first message replies; the others just add their file.
+        
+        Args:
+            update: Incoming Telegram update with a message from the album
+            context: Handler context
+            file_id: Telegram file id of this message's image
+            file_unique_id: Telegram file_unique_id, used as the cache key
+        """
+        message = update.message
+        assert message is not None and message.media_group_id is not None
+        group_id = message.media_group_id
+        if not self.media_groups.add(group_id, (message.message_id, file_id, file_unique_id)):
+            return
+        
+        started = time.perf_counter()
+        processing_msg = await message.reply_text(
+            PROCESSING_MESSAGE if self.pipeline.model_ready else WARMING_UP_MESSAGE
+        )
+        # Messages of one album may be handled out of order
+        items = sorted(await self.media_groups.collect(group_id))
+        
+        user = update.effective_user.id if update.effective_user else message.chat_id
+        try:
+            slot = self.pipeline.scheduler.reserve(user)
+        except SchedulerBusyError:
+            logger.info(f"Rejected album from user {user}: scheduler queues are full")
+            await processing_msg.edit_text(BUSY_MESSAGE)
+            _count_request("busy")
+            return
+        
+        chat_data = context.chat_data if context.chat_data is not None else {}
+        async with slot:
+            captions = await self.pipeline.caption_telegram_files(
+                context.bot, [(item[1], item[2]) for item in items],
+                chat_data.get("profile"), slot=slot
+            )
+        
+        if all(caption is None for caption in captions):
+            await processing_msg.edit_text(ERROR_MESSAGE)
+            _count_request("failed")
+            return
+        
+        lines = [
+            f"{number}. {caption if caption is not None else '❌ Could not describe this image'}"
+            for number, caption in enumerate(captions, start=1)
+        ]
+        response_text = "📸 <b>Album Description:</b>\n\n" + "\n\n".join(lines)
+        await processing_msg.edit_text(response_text, parse_mode=ParseMode.HTML)
+        # Includes the wait for the rest of the album
+        observe_stage("album_total", time.perf_counter() - started)
+        _count_request("ok")
+        logger.info(f"Described album of {len(items)} image(s) for user {user}")
+    
+    def _trace_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                       kind: str, file, mime_type: Optional[str] = None):
+        """Record an image request in the trace, if one is being written."""
+        if self.trace is None or update.message is None:
+            return
+        chat_data = context.chat_data if context.chat_data is not None else {}
+        self.trace.record(
+            kind, update.message.chat_id, file.file_unique_id,
+            media_group_id=update.message.media_group_id,
+            width=getattr(file, "width", None), height=getattr(file, "height", None),
+            file_size=file.file_size, mime_type=mime_type, profile=chat_data.get("profile")
+        )
+    
+    async def handle_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle incoming images."""
+        if update.message is None:
+            logger.warning("No message found in update for image handling.")
+            return
             
-            # Send the caption
-            response_text = f"📸 <b>Image Description:</b>\n\n{caption}"
-            await processing_msg.edit_text(response_text, parse_mode=ParseMode.HTML)
+        try:
+            # The smallest size that still covers the model input downloads fastest
+            photo = self.image_processor.select_photo_size(update.message.photo)
+            self._trace_request(update, context, "photo", photo)
+            await self._describe_file(update, context, photo.file_id, photo.file_unique_id)
             
             user_id = update.effective_user.id if update.effective_user else "unknown"
             logger.info(f"Successfully processed image for user {user_id}")
@@ -154,34 +479,14 @@ class ImageCaptionBot:
                 await update.message.reply_text("❌ Please send an image file (JPG, PNG, etc.)")
                 return
             
-            # Send processing message
-            processing_msg = await update.message.reply_text(PROCESSING_MESSAGE)
-            
-            # Get file path
-            file = await context.bot.get_file(document.file_id)
-            file_path = file.file_path
-            
-            if file_path is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
-                return
-            
-            # Process image
-            processed_image = self.image_processor.process_telegram_image(file_path)
-            
-            if processed_image is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
-                return
-            
-            # Generate caption
-            caption = self.caption_model.generate_caption(processed_image)
-            
-            if caption is None:
-                await processing_msg.edit_text(ERROR_MESSAGE)
+            # Telegram reports the size, so huge files are refused without downloading
+            if document.file_size and document.file_size > MAX_DOWNLOAD_BYTES:
+                await update.message.reply_text(FILE_TOO_LARGE_MESSAGE)
+                _count_request("too_large")
                 return
             
-            # Send the caption
-            response_text = f"📸 <b>Image Description:</b>\n\n{caption}"
-            await processing_msg.edit_text(response_text, parse_mode=ParseMode.HTML)
+            self._trace_request(update, context, "document", document, document.mime_type)
+            await self._describe_file(update, context, document.file_id, document.file_unique_id)
             
             user_id = update.effective_user.id if update.effective_user else "unknown"
             logger.info(f"Successfully processed document for user {user_id}")
@@ -204,28 +509,64 @@ class ImageCaptionBot:
     async def on_startup(self, application: Application):
         """Called when the bot starts up."""
         logger.info("🎉 Bot startup complete!")
-        logger.info("📊 Model info:")
-        model_info = self.caption_model.get_model_info()
-        for key, value in model_info.items():
-            logger.info(f"   {key}: {value}")
-        logger.info("✅ Bot is ready to process images!")
+        if METRICS_PORT:
+            try:
+                self.metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
+            except OSError as e:
+                logger.warning(f"⚠️ Metrics endpoint not started: {e}")
+        if self.caption_model is None:
+            logger.info("📥 Loading caption model in the background...")
+            self._load_task = asyncio.get_running_loop().create_task(self.load_model())
 
-    def run(self):
-        """Run the bot."""
-        if BOT_TOKEN is None:
-            logger.error("BOT_TOKEN is not set in environment variables")
-            raise ValueError("BOT_TOKEN is required")
-            
-        logger.info("🤖 Initializing Image Caption Bot...")
-        logger.info("📥 Loading BLIP model...")
+    async def on_shutdown(self, application: Application):
+        """Called when the bot shuts down."""
+        if self._load_task is not None and not self._load_task.done():
+            logger.info("Stopping model load still in progress")
+            self._load_task.cancel()
+            try:
+                await self._load_task
+            except asyncio.CancelledError:
+                pass
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        if self.trace is not None:
+            self.trace.close()
+        await self.pipeline.shutdown()
+
+    def build_application(self, concurrent_updates: int = CONCURRENT_UPDATES,
+                          base_url: Optional[str] = BOT_API_BASE_URL,
+                          base_file_url: Optional[str] = BOT_API_FILE_URL) -> Application:
+        """
+        Create the Telegram application with all handlers registered.
+        
+        Args:
+            concurrent_updates: Updates handled at the same time
+            base_url: Bot API endpoint to use instead of api.telegram.org
+            base_file_url: File download endpoint to use instead of api.telegram.org
         
-        # Create application
-        application = Application.builder().token(BOT_TOKEN).build()
+        Returns:
+            Configured application (not yet started)
+        """
+        # Updates are handled concurrently so that images arriving
+        # together can share a caption batch
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(concurrent_updates)
+            .connection_pool_size(BOT_CONNECTION_POOL_SIZE)
+        )
+        if base_url:
+            builder = builder.base_url(base_url)
+        if base_file_url:
+            builder = builder.base_file_url(base_file_url)
+        application = builder.build()
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("status", self.status_command))
+        application.add_handler(CommandHandler("mode", self.mode_command))
         
         # Handle images
         application.add_handler(MessageHandler(filters.PHOTO, self.handle_image))
@@ -238,15 +579,57 @@ class ImageCaptionBot:
         
         # Add startup callback
         application.post_init = self.on_startup
+        application.post_shutdown = self.on_shutdown
+        return application
+    
+    def run(self, mode: str = UPDATE_MODE):
+        """
+        Run the bot.
+        
+        Args:
+            mode: "polling" to fetch updates with getUpdates, "webhook" to
+                have Telegram post them to WEBHOOK_URL
+        """
+        if not BOT_TOKEN:
+            logger.error("BOT_TOKEN is not set in environment variables")
+            raise ValueError("BOT_TOKEN is required")
+        if mode not in ("polling", "webhook"):
+            raise ValueError(f"Unknown update mode {mode!r} (expected 'polling' or 'webhook')")
+        if mode == "webhook" and not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL is not set in environment variables")
+            raise ValueError("WEBHOOK_URL is required in webhook mode")
+            
+        secret_token = WEBHOOK_SECRET_TOKEN
+        if mode == "webhook" and not secret_token:
+            # Never accept unauthenticated posts; the token is registered with set_webhook
+            secret_token = secrets.token_urlsafe(32)
+            logger.warning("WEBHOOK_SECRET_TOKEN is not set; using a random token for this run")
+            
+        logger.info("🤖 Initializing Image Caption Bot...")
+        application = self.build_application()
         
         # Start the bot
-        logger.info("🚀 Starting bot...")
+        logger.info(f"🚀 Starting bot ({mode})...")
+        if BOT_API_BASE_URL:
+            logger.info(f"🔌 Using the Bot API at {BOT_API_BASE_URL}")
         logger.info("✅ Bot is now running and ready to receive messages!")
         logger.info("📱 You can now send images to your bot on Telegram")
         logger.info("🛑 Press Ctrl+C to stop the bot")
         
         try:
-            application.run_polling(allowed_updates=Update.ALL_TYPES)
+            # Only ask Telegram for the update types the handlers use
+            if mode == "webhook":
+                application.run_webhook(
+                    listen=WEBHOOK_LISTEN,
+                    port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    secret_token=secret_token,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+            else:
+                application.run_polling(allowed_updates=ALLOWED_UPDATES)
         except KeyboardInterrupt:
             logger.info("🛑 Bot stopped by user")
         except Exception as e:
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import List, Optional, Set, Tuple
+from PIL import Image
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+from metrics import METRICS, time_stage
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class CaptionBatcher:
+    """Collects concurrent caption requests into batched model calls."""
+
+    def __init__(self, caption_model, max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS,
+                 executor: Optional[Executor] = None, max_concurrent_batches: int = 1):
+        self.caption_model = caption_model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.executor = executor
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batch_slots: Optional[asyncio.Semaphore] = None
+        self._batches: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        """Number of images waiting to be batched."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_started(self):
+        """Start the batching worker on the running event loop if needed."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"Caption batcher started (max batch: {self.max_batch_size}, "
+                        f"max wait: {self.max_wait * 1000:.0f} ms)")
+
+    async def submit(self, image: Image.Image, profile: Optional[str] = None) -> Optional[str]:
+        """
+        Queue an image for captioning and wait for its caption.
+
+        Args:
+            image: Preprocessed PIL Image object
+            profile: Generation profile name (None for the default profile)
+
+        Returns:
+            Generated caption string or None if failed
+        """
+        self._ensure_started()
+        assert self._queue is not None
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, profile, future))
+        return await future
+
+    async def stop(self):
+        """Stop the batching worker and fail any queued requests."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        for task in list(self._batches):
+            task.cancel()
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
+
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, future = self._queue.get_nowait()
+                if not future.done():
+                    future.set_result(None)
+
+    async def _collect_batch(self) -> List[Tuple[Image.Image, Optional[str], asyncio.Future]]:
+        """Wait for the first request, then gather more until the window closes."""
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        try:
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Stopped mid-collection: the dequeued requests are no longer in the queue
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+            raise
+
+        # Take anything that is already waiting without extending the window
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+        return batch
+
+    async def _run(self):
+        """Batching loop: collect a batch and hand it to a free inference slot."""
+        assert self._batch_slots is not None
+        while True:
+            # Only start collecting once an inference slot is free, so that
+            # images keep accumulating into the next batch while workers are busy
+            await self._batch_slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except BaseException:
+                self._batch_slots.release()
+                raise
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch: List[Tuple[Image.Image, Optional[str], asyncio.Future]]):
+        """Caption one batch in the inference executor and resolve each caller."""
+        assert self._batch_slots is not None
+        loop = asyncio.get_running_loop()
+        images = [image for image, _, _ in batch]
+        # Mixed profiles share one encoder pass; the model decodes each group separately
+        profiles = [profile for _, profile, _ in batch]
+
+        METRICS.counter("caption_batches_total", "Batches run through the model").inc()
+        METRICS.counter("caption_batched_images_total", "Images captioned in batches").inc(len(batch))
+        captions: List[Optional[str]] = [None] * len(batch)
+        try:
+            with time_stage("batch"):
+                captions = await loop.run_in_executor(
+                    self.executor, self.caption_model.generate_captions, images, profiles
+                )
+            logger.info(f"Captioned batch of {len(batch)} image(s)")
+        except Exception as e:
+            logger.error(f"Error running caption batch: {e}")
+        finally:
+            self._batch_slots.release()
+            for (_, _, future), caption in zip(batch, captions):
+                if not future.done():
+                    future.set_result(caption)
@@ -0,0 +1,372 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+from PIL import Image
+from config import (
+    CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_DB_PATH, CACHE_HASH_MAX_DISTANCE,
+    EMBEDDING_CACHE_BYTES, DEFAULT_PROFILE
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def perceptual_hash(image: Image.Image) -> int:
+    """
+    Compute a 64-bit difference hash (dHash) of an image.
+
+    Visually identical images (recompressed, resized, forwarded) produce
+    hashes that differ in only a few bits.
+
+    Args:
+        image: PIL Image object
+
+    Returns:
+        64-bit integer hash
+    """
+    small = image.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def _hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+def _hash_bands(max_distance: int) -> List[Tuple[int, int]]:
+    """
+    Split the 64 hash bits into max_distance + 1 (shift, mask) bands.
+
+    Two hashes at most max_distance bits apart cannot differ in every
+    band, so they share at least one band exactly.
+    """
+    count = min(64, max_distance + 1)
+    bands = []
+    start = 0
+    for index in range(count):
+        width = (64 - start) // (count - index)
+        bands.append((start, (1 << width) - 1))
+        start += width
+    return bands
+
+class CaptionCache:
+    """
+    LRU/TTL caption cache keyed by Telegram file_unique_id and perceptual hash.
+
+    Every key includes the generation profile, so a chat only gets captions
+    written with the profile it selected.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS,
+                 db_path: Optional[str] = CACHE_DB_PATH,
+                 max_hash_distance: int = CACHE_HASH_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_hash_distance = max_hash_distance
+        # Keys are (profile, file_unique_id) and (profile, hash)
+        self._by_file_id: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._by_hash: "OrderedDict[Tuple[str, int], Tuple[str, float]]" = OrderedDict()
+        # Hashes indexed by each band, so near-duplicate lookups only compare candidates
+        self._bands = _hash_bands(max_hash_distance) if max_hash_distance > 0 else []
+        self._band_index: Dict[Tuple[str, int, int], Set[Tuple[str, int]]] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+        self.file_id_hits = 0
+        self.file_id_misses = 0
+        self.hash_hits = 0
+        self.hash_misses = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        """Open the on-disk tier and preload recent hashes for near-duplicate lookups."""
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(captions)")]
+            if columns and "profile" not in columns:
+                # Older files did not record the profile a caption was written with
+                logger.info("Discarding caption cache entries without a generation profile")
+                self._db.execute("DROP TABLE captions")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "profile TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, "
+                "caption TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (profile, kind, key))"
+            )
+            self._db.execute("DELETE FROM captions WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+            rows = self._db.execute(
+                "SELECT profile, key, caption, expires_at FROM captions WHERE kind = 'hash' "
+                "ORDER BY expires_at DESC LIMIT ?", (self.max_entries,)
+            ).fetchall()
+            for profile, key, caption, expires_at in reversed(rows):
+                self._put_memory(self._by_hash, (profile, int(key, 16)), caption, expires_at)
+            logger.info(f"Caption cache database opened: {db_path} ({len(rows)} hashes loaded)")
+        except sqlite3.Error as e:
+            logger.error(f"Error opening caption cache database: {e}")
+            self._db = None
+
+    def _get_memory(self, table: OrderedDict, key) -> Optional[str]:
+        """Look up a key in an in-memory tier, honouring TTL and LRU order."""
+        entry = table.get(key)
+        if entry is None:
+            return None
+        caption, expires_at = entry
+        if expires_at < time.time():
+            del table[key]
+            if table is self._by_hash:
+                self._unindex_hash(key)
+            return None
+        table.move_to_end(key)
+        return caption
+
+    def _put_memory(self, table: OrderedDict, key, caption: str, expires_at: float):
+        """Insert into an in-memory tier and evict the least recently used entries."""
+        if table is self._by_hash and key not in table:
+            self._index_hash(key)
+        table[key] = (caption, expires_at)
+        table.move_to_end(key)
+        while len(table) > self.max_entries:
+            evicted, _ = table.popitem(last=False)
+            if table is self._by_hash:
+                self._unindex_hash(evicted)
+
+    def _index_hash(self, key: Tuple[str, int]):
+        """Add a (profile, hash) key to the band index."""
+        profile, image_hash = key
+        for shift, mask in self._bands:
+            self._band_index.setdefault((profile, shift, (image_hash >> shift) & mask), set()).add(key)
+
+    def _unindex_hash(self, key: Tuple[str, int]):
+        """Remove a (profile, hash) key from the band index."""
+        profile, image_hash = key
+        for shift, mask in self._bands:
+            band = (profile, shift, (image_hash >> shift) & mask)
+            bucket = self._band_index.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._band_index[band]
+
+    def _near_hashes(self, profile: str, image_hash: int) -> Set[Tuple[str, int]]:
+        """Stored keys of a profile sharing at least one band with image_hash."""
+        candidates: Set[Tuple[str, int]] = set()
+        for shift, mask in self._bands:
+            candidates |= self._band_index.get((profile, shift, (image_hash >> shift) & mask), set())
+        return candidates
+
+    def _get_db(self, profile: str, kind: str, key: str) -> Optional[Tuple[str, float]]:
+        """Look up a key in the on-disk tier."""
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT caption, expires_at FROM captions "
+                "WHERE profile = ? AND kind = ? AND key = ?",
+                (profile, kind, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading caption cache database: {e}")
+            return None
+        if row is None or row[1] < time.time():
+            return None
+        return row[0], row[1]
+
+    @property
+    def persistent(self) -> bool:
+        """Whether lookups and stores go to the on-disk tier (and may block)."""
+        return self._db is not None
+
+    def get_by_file_id(self, file_unique_id: str, profile: str = DEFAULT_PROFILE) -> Optional[str]:
+        """
+        Look up a caption by Telegram file_unique_id (no download needed).
+
+        Args:
+            file_unique_id: Telegram file_unique_id of the photo or document
+            profile: Generation profile the caption must have been written with
+
+        Returns:
+            Cached caption or None on miss
+        """
+        key = (profile, file_unique_id)
+        with self._lock:
+            caption = self._get_memory(self._by_file_id, key)
+            if caption is None:
+                entry = self._get_db(profile, 'file', file_unique_id)
+                if entry is not None:
+                    caption = entry[0]
+                    self._put_memory(self._by_file_id, key, *entry)
+            if caption is not None:
+                self.file_id_hits += 1
+            else:
+                self.file_id_misses += 1
+            return caption
+
+    def get_by_hash(self, image_hash: int, profile: str = DEFAULT_PROFILE) -> Optional[str]:
+        """
+        Look up a caption by perceptual hash, accepting near-duplicates.
+
+        Args:
+            image_hash: Hash from perceptual_hash()
+            profile: Generation profile the caption must have been written with
+
+        Returns:
+            Cached caption or None on miss
+        """
+        with self._lock:
+            caption = self._get_memory(self._by_hash, (profile, image_hash))
+            if caption is None:
+                entry = self._get_db(profile, 'hash', f"{image_hash:016x}")
+                if entry is not None:
+                    caption = entry[0]
+                    self._put_memory(self._by_hash, (profile, image_hash), *entry)
+
+            if caption is None and self.max_hash_distance > 0:
+                now = time.time()
+                best_distance = self.max_hash_distance + 1
+                best_key = None
+                for key in self._near_hashes(profile, image_hash):
+                    if self._by_hash[key][1] < now:
+                        continue
+                    distance = _hamming_distance(key[1], image_hash)
+                    if distance < best_distance:
+                        best_distance = distance
+                        best_key = key
+                if best_key is not None:
+                    caption = self._get_memory(self._by_hash, best_key)
+
+            if caption is not None:
+                self.hash_hits += 1
+            else:
+                self.hash_misses += 1
+            return caption
+
+    def put(self, caption: str, file_unique_id: Optional[str] = None,
+            image_hash: Optional[int] = None, profile: str = DEFAULT_PROFILE):
+        """
+        Store a caption under its file id and/or perceptual hash.
+
+        Args:
+            caption: Generated caption
+            file_unique_id: Telegram file_unique_id, if known
+            image_hash: Perceptual hash of the decoded image, if computed
+            profile: Generation profile the caption was written with
+        """
+        expires_at = time.time() + self.ttl
+        rows = []
+        with self._lock:
+            if file_unique_id:
+                self._put_memory(self._by_file_id, (profile, file_unique_id), caption, expires_at)
+                rows.append((profile, 'file', file_unique_id, caption, expires_at))
+            if image_hash is not None:
+                self._put_memory(self._by_hash, (profile, image_hash), caption, expires_at)
+                rows.append((profile, 'hash', f"{image_hash:016x}", caption, expires_at))
+
+            if self._db is not None and rows:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO captions (profile, kind, key, caption, expires_at) "
+                        "VALUES (?, ?, ?, ?, ?)", rows
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing caption cache database: {e}")
+
+    def get_stats(self) -> dict:
+        """Get hit/miss counters per key type and sizes."""
+        with self._lock:
+            return {
+                "file_id_hits": self.file_id_hits,
+                "file_id_misses": self.file_id_misses,
+                "hash_hits": self.hash_hits,
+                "hash_misses": self.hash_misses,
+                "entries": len(self._by_file_id) + len(self._by_hash),
+                "persistent": self._db is not None
+            }
+
+    def close(self):
+        """Close the on-disk tier."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class EmbeddingCache:
+    """LRU cache of vision-encoder outputs bounded by a memory budget in bytes."""
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up cached image embeddings.
+
+        Args:
+            key: Content hash of the model-input image
+
+        Returns:
+            Cached embeddings or None on miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: Any, nbytes: int):
+        """
+        Store embeddings, evicting least recently used entries to stay in budget.
+
+        Args:
+            key: Content hash of the model-input image
+            value: Embeddings (tensor or array)
+            nbytes: Memory held by value
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> dict:
+        """Get hit/miss counters and memory use."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes
+            }
@@ -0,0 +1,193 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Callable, List, Optional
+from PIL import Image
+from config import CAPTION_SERVER_ADDRESS, CAPTION_SERVER_CONNECTIONS, CAPTION_SERVER_TIMEOUT
+from caption_rpc import ProtocolError, parse_address, recv_frame, send_frame
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class ServerBusyError(Exception):
+    """Raised when the caption server keeps refusing work until the timeout."""
+
+class RemoteCaptionModel:
+    """
+    Client for caption_server.py with the same interface as CaptionModel.
+
+    Keeps a small pool of persistent connections, each carrying one request at
+    a time, so CaptionPipeline can use it like a local model. When the server
+    answers "busy" the request is retried with backoff until the timeout.
+    """
+
+    # The server loads and warms up its own model
+    remote = True
+
+    def __init__(self, address: str = CAPTION_SERVER_ADDRESS,
+                 connections: int = CAPTION_SERVER_CONNECTIONS,
+                 timeout: float = CAPTION_SERVER_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.parallel_batches = max(1, connections)
+        self._target = parse_address(address)
+        self._idle: "queue.LifoQueue[socket.socket]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.parallel_batches)
+        self._info: dict = {}
+
+        try:
+            self._info = self._call({"op": "info"})["info"]
+            logger.info(f"Connected to caption server at {address}")
+        except (OSError, ProtocolError, KeyError) as e:
+            logger.warning(f"Caption server at {address} is not reachable yet: {e}")
+
+    def _connect(self) -> socket.socket:
+        """Open a new connection to the server."""
+        kind, target = self._target
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(str(target))
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(target, timeout=self.timeout)  # type: ignore
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _call(self, header: dict, payload: bytes = b"",
+              on_partial: Optional[Callable[[str], None]] = None) -> dict:
+        """Send one request on a pooled connection and return the final response header."""
+        with self._slots:
+            try:
+                sock = self._idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                sock = self._connect()
+                reused = False
+
+            while True:
+                try:
+                    send_frame(sock, header, payload)
+                    while True:
+                        response, _ = recv_frame(sock)
+                        if "partial" in response:
+                            if on_partial is not None:
+                                on_partial(response["partial"])
+                            continue
+                        break
+                except socket.timeout:
+                    sock.close()
+                    raise
+                except (OSError, ProtocolError):
+                    sock.close()
+                    # A pooled connection may have been closed by a server restart
+                    if reused:
+                        sock = self._connect()
+                        reused = False
+                        continue
+                    raise
+                self._idle.put(sock)
+                return response
+
+    def _caption(self, images: List[Image.Image], profiles: List[Optional[str]],
+                 stream: bool = False,
+                 on_partial: Optional[Callable[[str], None]] = None) -> List[Optional[str]]:
+        """Send images as raw pixels and wait for their captions, backing off while busy."""
+        entries = []
+        chunks = []
+        for image in images:
+            data = image.tobytes()
+            entries.append({"length": len(data), "mode": image.mode,
+                            "width": image.width, "height": image.height})
+            chunks.append(data)
+        header = {"op": "caption", "images": entries, "profiles": profiles, "stream": stream}
+        payload = b"".join(chunks)
+
+        if not self._info:
+            # The server was down when the bot started; fetch its info now
+            try:
+                self._info = self._call({"op": "info"})["info"]
+            except (OSError, ProtocolError, KeyError):
+                pass
+
+        deadline = time.monotonic() + self.timeout
+        delay = 0.05
+        while True:
+            response = self._call(header, payload, on_partial)
+            if response.get("error") != "busy":
+                break
+            if time.monotonic() + delay > deadline:
+                raise ServerBusyError(f"Caption server busy for {self.timeout} seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        if "error" in response:
+            raise ProtocolError(response["error"])
+        return response["captions"]
+
+    @property
+    def optimizations(self) -> str:
+        """Short description of the server's inference optimizations."""
+        return f"remote ({self._info.get('optimizations', 'unknown')})"
+
+    def generate_caption(self, image: Image.Image) -> Optional[str]:
+        """Generate a caption for one image."""
+        return self.generate_captions([image])[0]
+
+    def generate_captions(self, images: List[Image.Image],
+                          profiles: Optional[List[str]] = None) -> List[Optional[str]]:
+        """
+        Generate captions for a batch of images on the caption server.
+
+        Args:
+            images: List of preprocessed PIL Image objects
+            profiles: Generation profile name per image (None entries use DEFAULT_PROFILE)
+
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        if not images:
+            return []
+        try:
+            return self._caption(images, list(profiles) if profiles else [None] * len(images))
+        except (OSError, ProtocolError, ServerBusyError) as e:
+            logger.error(f"Error requesting captions from {self.address}: {e}")
+            return [None] * len(images)
+
+    def stream_caption(self, image: Image.Image, on_partial: Callable[[str], None],
+                       profile: Optional[str] = None) -> Optional[str]:
+        """Generate one caption on the server, reporting partial captions (see CaptionModel)."""
+        try:
+            return self._caption([image], [profile], stream=True, on_partial=on_partial)[0]
+        except (OSError, ProtocolError, ServerBusyError) as e:
+            logger.error(f"Error requesting caption from {self.address}: {e}")
+            return None
+
+    def get_model_info(self) -> dict:
+        """
+        Get the server's model information as last fetched.
+
+        Called from the event loop (/status), so it never touches the network.
+        """
+        info = {
+            "model_name": "unknown", "device": "unknown", "max_length": None,
+            "embedding_cache": None
+        }
+        info.update(self._info)
+        info["optimizations"] = self.optimizations
+        info["server"] = self.address
+        return info
+
+    def close(self):
+        """Close pooled connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
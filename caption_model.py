@@ -1,26 +1,70 @@
+import contextlib
+import hashlib
 import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from transformers.tokenization_utils_base import BatchEncoding
+from transformers import BlipProcessor, BlipForConditionalGeneration, TextStreamer
 from PIL import Image
 import logging
-from typing import Optional, Dict, Any, Union
-from config import MODEL_NAME, MAX_LENGTH, NUM_BEAMS, TEMPERATURE
+from typing import Callable, Dict, Optional, List
+from config import (
+    MODEL_NAME, MAX_LENGTH, TOP_P, REPETITION_PENALTY, TEXT_PROMPT,
+    QUANTIZE_INT8, BF16_AUTOCAST, TORCH_COMPILE, CAPTION_BACKEND, EMBEDDING_CACHE_BYTES,
+    GENERATION_PROFILES, DEFAULT_PROFILE, INFERENCE_PROCESSES
+)
+from blip_preprocessor import BlipPreprocessor
+from caption_cache import EmbeddingCache
+from artifact_cache import enable_torch_compile_cache
+from metrics import METRICS, time_stage
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class _PartialCaptionStreamer(TextStreamer):
+    """Streamer that reports the caption decoded so far, one word at a time."""
+    
+    def __init__(self, tokenizer, on_text: Callable[[str], None]):
+        super().__init__(tokenizer, skip_special_tokens=True)
+        self.on_text = on_text
+        self.text = ""
+    
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text and not stream_end:
+            self.text += text
+            self.on_text(self.text)
+
 class CaptionModel:
     """Handles the Salesforce BLIP model for image captioning."""
     
-    def __init__(self):
+    def __init__(self, quantize_int8: bool = QUANTIZE_INT8, bf16_autocast: bool = BF16_AUTOCAST,
+                 torch_compile: bool = TORCH_COMPILE,
+                 embedding_cache_bytes: int = EMBEDDING_CACHE_BYTES,
+                 model: Optional[BlipForConditionalGeneration] = None,
+                 processor: Optional[BlipProcessor] = None):
+        """
+        Args:
+            quantize_int8: Apply dynamic int8 quantization (CPU)
+            bf16_autocast: Run inference under bfloat16 autocast (CPU)
+            torch_compile: Compile the vision encoder and text decoder
+            embedding_cache_bytes: Memory for cached vision-encoder outputs (0 disables)
+            model: Already loaded model to use instead of loading MODEL_NAME
+            processor: Already loaded processor to use instead of loading MODEL_NAME
+        """
         self.model_name = MODEL_NAME
         self.max_length = MAX_LENGTH
-        self.num_beams = NUM_BEAMS
-        self.temperature = TEMPERATURE
-        self.processor: Optional[BlipProcessor] = None
-        self.model: Optional[BlipForConditionalGeneration] = None
+        self.top_p = TOP_P
+        self.repetition_penalty = REPETITION_PENALTY
+        self.text_prompt = TEXT_PROMPT
+        self.processor: Optional[BlipProcessor] = processor
+        self.preprocessor: Optional[BlipPreprocessor] = None
+        self.model: Optional[BlipForConditionalGeneration] = model
         self.device: Optional[str] = None
+        self.quantize_int8 = quantize_int8
+        self.bf16_autocast = bf16_autocast
+        self.torch_compile = torch_compile
+        # Vision-encoder outputs, so re-captioning an image only costs the decoder
+        self.embedding_cache: Optional[EmbeddingCache] = (
+            EmbeddingCache(embedding_cache_bytes) if embedding_cache_bytes > 0 else None
+        )
         self._load_model()
     
     def _load_model(self):
@@ -28,14 +72,21 @@ class CaptionModel:
         try:
             logger.info(f"Loading BLIP model: {self.model_name}")
             
-            # Determine device
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            # Determine device (a model handed in stays where it is)
+            if self.model is not None:
+                self.device = next(self.model.parameters()).device.type
+            else:
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
             logger.info(f"Using device: {self.device}")
             
             # Load processor and model
-            self.processor = BlipProcessor.from_pretrained(self.model_name)  # type: ignore
+            if self.processor is None:
+                self.processor = BlipProcessor.from_pretrained(self.model_name)  # type: ignore
+            self.preprocessor = BlipPreprocessor(self.processor, self.text_prompt)
             
-            if self.device == "cuda":
+            if self.model is not None:
+                logger.info("Using already loaded model weights")
+            elif self.device == "cuda":
                 self.model = BlipForConditionalGeneration.from_pretrained(
                     self.model_name,
                     torch_dtype=torch.float16,
@@ -53,12 +104,64 @@ class CaptionModel:
             # Set model to evaluation mode
             self.model.eval()
             
+            self._apply_optimizations()
+            
             logger.info("BLIP model loaded successfully!")
             
         except Exception as e:
             logger.error(f"Error loading BLIP model: {e}")
             raise
     
+    def _apply_optimizations(self):
+        """Apply the configured CPU inference optimizations to the loaded model."""
+        assert self.model is not None
+        
+        if self.quantize_int8:
+            if self.device == "cpu":
+                # Weights of every Linear layer become int8; activations are
+                # quantized on the fly, which suits the matmul-heavy BLIP layers
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+                logger.info("Applied dynamic int8 quantization to Linear layers")
+            else:
+                logger.warning("int8 quantization is only supported on CPU, skipping")
+                self.quantize_int8 = False
+        
+        if self.bf16_autocast and self.device != "cpu":
+            logger.warning("bfloat16 autocast is only used on CPU, skipping")
+            self.bf16_autocast = False
+        
+        if self.torch_compile:
+            # Compiled kernels are written to the artifact cache, so restarts
+            # load them instead of compiling again
+            enable_torch_compile_cache(self.model_name)
+            # generate() itself cannot be compiled, so compile the two forwards
+            # it drives; the decoder sees a new sequence length every step
+            vision_model = self.model.vision_model
+            text_decoder = self.model.text_decoder
+            vision_model.forward = torch.compile(vision_model.forward)
+            text_decoder.forward = torch.compile(text_decoder.forward, dynamic=True)
+            logger.info("Compiled vision encoder and text decoder with torch.compile")
+    
+    def _inference_context(self):
+        """Context manager for inference: no autograd, optional bfloat16 autocast."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.bf16_autocast:
+            stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+        return stack
+    
+    @property
+    def optimizations(self) -> str:
+        """Short description of the active inference optimizations."""
+        modes = [name for name, enabled in (
+            ("int8", self.quantize_int8),
+            ("bf16", self.bf16_autocast),
+            ("compile", self.torch_compile)
+        ) if enabled]
+        return "+".join(modes) if modes else "fp32"
+    
     def generate_caption(self, image: Image.Image) -> Optional[str]:
         """
         Generate a detailed caption for the given image.
@@ -69,85 +172,305 @@ class CaptionModel:
         Returns:
             Generated caption string or None if failed
         """
+        return self.generate_captions([image])[0]
+    
+    def _embedding_key(self, image: Image.Image) -> str:
+        """Content hash of a model-input image, used as the embedding cache key."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    
+    def encode_pixel_values(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Run the vision encoder on already normalized model input (no caching).
+        
+        Args:
+            pixel_values: Float tensor of shape (batch, 3, height, width)
+            
+        Returns:
+            image_embeds for the batch
+        """
+        assert self.model is not None
+        pixel_values = pixel_values.to(self.device, dtype=self.model.dtype)
+        with self._inference_context():
+            return self.model.vision_model(pixel_values=pixel_values)[0]
+    
+    def _run_encoder(self, images: List[Image.Image]) -> list:
+        """Run the vision encoder and return one embedding per image."""
+        assert self.preprocessor is not None
+        with time_stage("preprocess"):
+            pixel_values = self.preprocessor.pixel_values(images)
+        with time_stage("encoder"):
+            image_embeds = self.encode_pixel_values(pixel_values)
+        # Rows are cloned so a cached entry does not pin the whole batch tensor
+        return [row.clone() for row in image_embeds]
+    
+    def _stack(self, embeddings: list):
+        """Combine per-image embeddings into one batch."""
+        return torch.stack(embeddings)
+    
+    def _embedding_nbytes(self, embedding) -> int:
+        """Memory held by one cached embedding."""
+        return embedding.element_size() * embedding.nelement()
+    
+    def encode_image(self, image: Image.Image):
+        """
+        Encode one image with the vision encoder, reusing cached embeddings.
+        
+        Args:
+            image: PIL Image object
+            
+        Returns:
+            image_embeds with a batch dimension of 1
+        """
+        return self.encode_images([image])
+    
+    def encode_images(self, images: List[Image.Image]):
+        """
+        Encode a batch of images, running the vision encoder only for cache misses.
+        
+        Args:
+            images: List of PIL Image objects
+            
+        Returns:
+            image_embeds for the batch, in input order
+        """
+        embeddings: list = [None] * len(images)
+        missing = []
+        keys = []
+        for index, image in enumerate(images):
+            key = self._embedding_key(image) if self.embedding_cache is not None else None
+            keys.append(key)
+            cached = self.embedding_cache.get(key) if key is not None else None
+            if cached is None:
+                missing.append(index)
+            else:
+                embeddings[index] = cached
+        
+        if missing:
+            encoded = self._run_encoder([images[index] for index in missing])
+            for index, embedding in zip(missing, encoded):
+                embeddings[index] = embedding
+                if self.embedding_cache is not None:
+                    self.embedding_cache.put(
+                        keys[index], embedding, self._embedding_nbytes(embedding)
+                    )
+        
+        return self._stack(embeddings)
+    
+    def _decoder_prompt(self, batch_size: int, conditional: bool):
+        """Decoder input ids and mask, laid out the way BLIP's generate() prepares them."""
+        assert self.model is not None and self.preprocessor is not None
+        text_config = self.model.config.text_config
+        if conditional:
+            input_ids, attention_mask = self.preprocessor.prompt_inputs(batch_size)
+            # BLIP decodes from [DEC] in place of [CLS] and drops the trailing [SEP]
+            input_ids[:, 0] = text_config.bos_token_id
+            input_ids = input_ids[:, :-1].to(self.device)
+            attention_mask = attention_mask[:, :-1].to(self.device)
+        else:
+            input_ids = torch.full(
+                (batch_size, 1), text_config.bos_token_id, dtype=torch.long, device=self.device
+            )
+            attention_mask = None
+        return input_ids, attention_mask
+    
+    def decode(self, image_embeds, conditional: Optional[bool] = None,
+               **generate_kwargs) -> List[Optional[str]]:
+        """
+        Generate captions from image embeddings produced by encode_images().
+        
+        Args:
+            image_embeds: Output of encode_images()
+            conditional: Start from the text prompt (defaults to whether one is configured)
+            **generate_kwargs: Generation settings (a GENERATION_PROFILES entry);
+                unset ones come from DEFAULT_PROFILE
+            
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        batch_size = len(image_embeds)
         try:
-            if self.processor is None or self.model is None:
+            if self.processor is None or self.model is None or self.preprocessor is None:
                 logger.error("Model or processor not loaded")
-                return None
-
-            # Prepare inputs
-            logger.info(f"Processing image: {image.size} {image.mode}")
+                return [None] * batch_size
+            
+            if conditional is None:
+                conditional = bool(self.text_prompt)
+            input_ids, attention_mask = self._decoder_prompt(batch_size, conditional)
             
-            # For BLIP, we need to provide a text prompt for conditional generation
-            text_prompt = "a photography of"
+            # Decoding strategy comes from the profile; the rest are shared defaults
+            settings = {
+                "max_length": self.max_length,
+                "num_beams": 1,
+                "do_sample": False,
+                "top_p": self.top_p,
+                "repetition_penalty": self.repetition_penalty,
+                "length_penalty": 1.0,
+                "early_stopping": True
+            }
+            settings.update(GENERATION_PROFILES[DEFAULT_PROFILE])
+            settings.update(generate_kwargs)
+            # Drop settings the chosen strategy does not use instead of letting
+            # generate() warn about them on every call
+            if not settings["do_sample"]:
+                for key in ("temperature", "top_p"):
+                    settings.pop(key, None)
+            if settings["num_beams"] == 1:
+                for key in ("length_penalty", "early_stopping"):
+                    settings.pop(key, None)
             
-            inputs: Union[BatchEncoding, Dict[str, Any]] = self.processor(
-                images=image,
-                text=text_prompt,
-                return_tensors="pt"
+            text_config = self.model.config.text_config
+            image_attention_mask = torch.ones(
+                image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device
             )
-
-            # Move inputs to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Extract required inputs with proper type checking
-            input_ids = inputs.get("input_ids")
-            pixel_values = inputs.get("pixel_values")
-            attention_mask = inputs.get("attention_mask")
-            
-            # Log the available keys for debugging
-            logger.info(f"Available input keys: {list(inputs.keys())}")
-            
-            # Validate that required inputs are present
-            if pixel_values is None:
-                logger.error("Required input pixel_values is missing")
-                return None
-            
-            # Generate caption with optimized parameters for detailed descriptions
-            with torch.no_grad():
-                if input_ids is not None:
-                    # Conditional generation with text prompt
-                    outputs = self.model.generate(
-                        input_ids=input_ids,
-                        pixel_values=pixel_values,
-                        attention_mask=attention_mask,
-                        max_length=self.max_length,
-                        num_beams=self.num_beams,
-                        temperature=self.temperature,
-                        do_sample=True,
-                        top_p=0.9,
-                        repetition_penalty=1.5,
-                        length_penalty=1.0,
-                        early_stopping=True
-                    )
-                else:
-                    # Unconditional generation (no text prompt)
-                    outputs = self.model.generate(
-                        pixel_values=pixel_values,
-                        max_length=self.max_length,
-                        num_beams=self.num_beams,
-                        temperature=self.temperature,
-                        do_sample=True,
-                        top_p=0.9,
-                        repetition_penalty=1.5,
-                        length_penalty=1.0,
-                        early_stopping=True
-                    )
-
-            # Decode the generated caption
+            with self._inference_context(), time_stage("decoder"):
+                outputs = self.model.text_decoder.generate(
+                    input_ids=input_ids,
+                    eos_token_id=text_config.sep_token_id,
+                    pad_token_id=text_config.pad_token_id,
+                    attention_mask=attention_mask,
+                    encoder_hidden_states=image_embeds,
+                    encoder_attention_mask=image_attention_mask,
+                    **settings
+                )
+            
+            # Tokens generated after the prompt, padding excluded
+            generated = outputs[:, input_ids.shape[1]:]
+            METRICS.counter("caption_tokens_generated_total", "Caption tokens generated").inc(
+                int((generated != text_config.pad_token_id).sum())
+            )
+            
+            # Decode the generated captions
             tokenizer = getattr(self.processor, "tokenizer", None)
             if tokenizer is None:
                 logger.error("Processor does not have a tokenizer attribute")
-                return None
-            caption = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-            # Clean up the caption
-            caption = self._clean_caption(caption)
-            logger.info(f"Generated caption: {caption}")
-            return caption
+                return [None] * batch_size
+            captions = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            
+            # Clean up the captions
+            captions = [self._clean_caption(caption) for caption in captions]
+            logger.info(f"Generated captions: {captions}")
+            return captions
+            
+        except Exception as e:
+            logger.error(f"Error generating captions: {e}")
+            return [None] * batch_size
+    
+    def generate_captions(self, images: List[Image.Image],
+                          profiles: Optional[List[str]] = None) -> List[Optional[str]]:
+        """
+        Generate captions for a batch of images in a single forward pass.
+        
+        The vision encoder runs once for the whole batch; images asking for
+        different generation profiles are then decoded in one group per profile.
+        
+        Args:
+            images: List of PIL Image objects
+            profiles: Generation profile name per image (None entries use DEFAULT_PROFILE)
+            
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        if not images:
+            return []
+        
+        try:
+            if self.processor is None or self.preprocessor is None:
+                logger.error("Model or processor not loaded")
+                return [None] * len(images)
+            
+            logger.info(f"Processing batch of {len(images)} image(s): "
+                        f"{[(image.size, image.mode) for image in images]}")
+            image_embeds = self.encode_images(images)
+        except Exception as e:
+            logger.error(f"Error encoding images: {e}")
+            return [None] * len(images)
+        
+        return self.decode_profiles(image_embeds, profiles)
+    
+    def decode_profiles(self, image_embeds,
+                        profiles: Optional[List[str]] = None) -> List[Optional[str]]:
+        """
+        Decode a batch of embeddings with a generation profile per image.
+        
+        Args:
+            image_embeds: Output of encode_images() or encode_pixel_values()
+            profiles: Generation profile name per image (None entries use DEFAULT_PROFILE)
+            
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        batch_size = len(image_embeds)
+        groups: Dict[str, List[int]] = {}
+        for index, profile in enumerate(profiles or [None] * batch_size):
+            profile = profile or DEFAULT_PROFILE
+            if profile not in GENERATION_PROFILES:
+                logger.warning(f"Unknown generation profile {profile!r}, using {DEFAULT_PROFILE}")
+                profile = DEFAULT_PROFILE
+            groups.setdefault(profile, []).append(index)
+        
+        captions: List[Optional[str]] = [None] * batch_size
+        for profile, indices in groups.items():
+            group_embeds = image_embeds if len(indices) == batch_size else image_embeds[indices]
+            for index, caption in zip(indices, self.decode(group_embeds,
+                                                           **GENERATION_PROFILES[profile])):
+                captions[index] = caption
+        return captions
+    
+    def stream_caption(self, image: Image.Image, on_partial: Callable[[str], None],
+                       profile: Optional[str] = None) -> Optional[str]:
+        """
+        Generate a caption for one image, reporting partial captions as words are decoded.
+        
+        Streaming decodes a single sequence, so profiles that use beam search
+        are decoded greedily here.
+        
+        Args:
+            image: PIL Image object
+            on_partial: Called from the inference thread with the caption so far
+            profile: Generation profile name (None for DEFAULT_PROFILE)
             
+        Returns:
+            Final caption string or None if failed
+        """
+        try:
+            image_embeds = self.encode_image(image)
         except Exception as e:
-            logger.error(f"Error generating caption: {e}")
+            logger.error(f"Error encoding image: {e}")
+            return None
+        return self.stream_decode(image_embeds, on_partial, profile)
+    
+    def stream_decode(self, image_embeds, on_partial: Callable[[str], None],
+                      profile: Optional[str] = None) -> Optional[str]:
+        """
+        Decode one image's embeddings, reporting partial captions (see stream_caption).
+        
+        Args:
+            image_embeds: Embeddings of a single image
+            on_partial: Called from the inference thread with the caption so far
+            profile: Generation profile name (None for DEFAULT_PROFILE)
+            
+        Returns:
+            Final caption string or None if failed
+        """
+        tokenizer = getattr(self.processor, "tokenizer", None)
+        if tokenizer is None:
+            logger.error("Processor does not have a tokenizer attribute")
             return None
+        
+        settings = dict(GENERATION_PROFILES.get(profile or DEFAULT_PROFILE,
+                                                GENERATION_PROFILES[DEFAULT_PROFILE]))
+        settings["num_beams"] = 1
+        
+        def report(text: str):
+            partial = " ".join(text.split())
+            if partial:
+                on_partial(partial[0].upper() + partial[1:])
+        
+        streamer = _PartialCaptionStreamer(tokenizer, report)
+        return self.decode(image_embeds, streamer=streamer, **settings)[0]
     
     def _clean_caption(self, caption: str) -> str:
         """
@@ -178,6 +501,29 @@ class CaptionModel:
             "model_name": self.model_name,
             "device": self.device,
             "max_length": self.max_length,
-            "num_beams": self.num_beams,
-            "temperature": self.temperature
-        } 
\ No newline at end of file
+            "optimizations": self.optimizations,
+            "embedding_cache": self.embedding_cache.get_stats() if self.embedding_cache else None
+        }
+
+def create_caption_model(backend: str = CAPTION_BACKEND) -> CaptionModel:
+    """
+    Create the caption model for a backend ("torch", "onnx" or "remote").
+    
+    With INFERENCE_PROCESSES set, the torch backend runs in a pool of worker
+    processes (see worker_pool.py); "remote" talks to caption_server.py. Both
+    are used the same way as CaptionModel.
+    """
+    if backend == "remote":
+        from caption_client import RemoteCaptionModel
+        return RemoteCaptionModel()  # type: ignore
+    if backend == "onnx":
+        if INFERENCE_PROCESSES:
+            raise ValueError("INFERENCE_PROCESSES is only supported with the torch backend")
+        from onnx_caption_model import OnnxCaptionModel
+        return OnnxCaptionModel()
+    if backend != "torch":
+        raise ValueError(f"Unknown CAPTION_BACKEND: {backend}")
+    if INFERENCE_PROCESSES:
+        from worker_pool import ProcessPoolCaptionModel
+        return ProcessPoolCaptionModel()  # type: ignore
+    return CaptionModel()
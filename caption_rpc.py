@@ -0,0 +1,84 @@
+import asyncio
+import json
+import socket
+import struct
+from typing import Tuple
+
+# Frame: header length and payload length (big-endian uint32), JSON header, raw payload
+FRAME_PREFIX = struct.Struct(">II")
+MAX_HEADER_BYTES = 1024 * 1024
+MAX_PAYLOAD_BYTES = 256 * 1024 * 1024
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed or oversized frame."""
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """
+    Parse a caption server address.
+
+    Args:
+        address: "unix:/path/to/socket" or "host:port"
+
+    Returns:
+        ("unix", path) or ("tcp", (host, port))
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid caption server address: {address!r}")
+    return "tcp", (host, int(port))
+
+def encode_frame(header: dict, payload: bytes = b"") -> bytes:
+    """Serialize one frame."""
+    header_bytes = json.dumps(header).encode()
+    return FRAME_PREFIX.pack(len(header_bytes), len(payload)) + header_bytes + payload
+
+def _decode_header(header_bytes: bytes) -> dict:
+    try:
+        header = json.loads(header_bytes)
+    except ValueError as e:
+        raise ProtocolError(f"Invalid frame header: {e}")
+    if not isinstance(header, dict):
+        raise ProtocolError("Frame header must be an object")
+    return header
+
+def _check_lengths(header_length: int, payload_length: int):
+    if header_length > MAX_HEADER_BYTES or payload_length > MAX_PAYLOAD_BYTES:
+        raise ProtocolError(f"Frame too large ({header_length} + {payload_length} bytes)")
+
+def _recv_exactly(sock: socket.socket, length: int) -> bytes:
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return bytes(buffer)
+
+def send_frame(sock: socket.socket, header: dict, payload: bytes = b""):
+    """Write one frame to a blocking socket."""
+    sock.sendall(encode_frame(header, payload))
+
+def recv_frame(sock: socket.socket) -> Tuple[dict, bytes]:
+    """Read one frame from a blocking socket."""
+    header_length, payload_length = FRAME_PREFIX.unpack(_recv_exactly(sock, FRAME_PREFIX.size))
+    _check_lengths(header_length, payload_length)
+    header = _decode_header(_recv_exactly(sock, header_length))
+    return header, _recv_exactly(sock, payload_length)
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[dict, bytes]:
+    """Read one frame from an asyncio stream (IncompleteReadError at end of stream)."""
+    header_length, payload_length = FRAME_PREFIX.unpack(
+        await reader.readexactly(FRAME_PREFIX.size)
+    )
+    _check_lengths(header_length, payload_length)
+    header = _decode_header(await reader.readexactly(header_length))
+    return header, await reader.readexactly(payload_length)
+
+async def write_frame(writer: asyncio.StreamWriter, header: dict, payload: bytes = b""):
+    """Write one frame to an asyncio stream."""
+    writer.write(encode_frame(header, payload))
+    await writer.drain()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Standalone caption server.
+Loads the caption model once and serves captions over a local socket
+(caption_rpc framing), so several bot instances can share one warm model
+and bots can restart without reloading BLIP. Requests from all connections
+are batched together.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from typing import List, Optional
+
+from PIL import Image
+
+from config import (
+    CAPTION_BACKEND, CAPTION_SERVER_ADDRESS, CAPTION_SERVER_MAX_PENDING
+)
+from caption_rpc import ProtocolError, parse_address, read_frame, write_frame
+
+# Set up logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+class CaptionServer:
+    """Serves caption requests from CaptionPipeline over caption_rpc frames."""
+
+    def __init__(self, pipeline, max_pending: int = CAPTION_SERVER_MAX_PENDING):
+        self.pipeline = pipeline
+        self.max_pending = max_pending
+        self.pending = 0
+        self.connections = 0
+
+    def _decode_images(self, entries: List[dict], payload: bytes) -> List[Optional[Image.Image]]:
+        """Turn the payload back into images (raw pixels or encoded files)."""
+        images: List[Optional[Image.Image]] = []
+        offset = 0
+        for entry in entries:
+            length = int(entry["length"])
+            data = payload[offset:offset + length]
+            offset += length
+            if "mode" in entry:
+                try:
+                    images.append(Image.frombytes(
+                        entry["mode"], (int(entry["width"]), int(entry["height"])), data
+                    ))
+                except (ValueError, KeyError) as e:
+                    logger.error(f"Invalid raw image in request: {e}")
+                    images.append(None)
+            else:
+                images.append(self.pipeline.image_processor.process_image_bytes(data))
+        return images
+
+    async def _caption(self, header: dict, payload: bytes, writer: asyncio.StreamWriter):
+        """Handle one caption request."""
+        entries = header.get("images") or []
+        profiles = header.get("profiles") or [None] * len(entries)
+        if len(profiles) != len(entries):
+            raise ProtocolError("profiles and images differ in length")
+        if sum(int(entry["length"]) for entry in entries) != len(payload):
+            raise ProtocolError("Image lengths do not match the payload")
+
+        # Refuse instead of queueing without bound; the client backs off and retries
+        if self.pending + len(entries) > self.max_pending:
+            await write_frame(writer, {"error": "busy"})
+            return
+
+        self.pending += len(entries)
+        try:
+            loop = asyncio.get_running_loop()
+            images = await loop.run_in_executor(
+                self.pipeline.io_executor, self._decode_images, entries, payload
+            )
+            del payload
+
+            async def send_partial(text: str):
+                await write_frame(writer, {"partial": text})
+
+            on_partial = send_partial if header.get("stream") and len(images) == 1 else None
+
+            async def caption_one(image: Optional[Image.Image], profile: Optional[str]):
+                if image is None:
+                    return None
+                caption, _ = await self.pipeline.caption_image(image, profile, on_partial)
+                return caption
+
+            captions = await asyncio.gather(*(
+                caption_one(image, profile) for image, profile in zip(images, profiles)
+            ))
+        finally:
+            self.pending -= len(entries)
+        await write_frame(writer, {"captions": list(captions)})
+
+    def get_info(self) -> dict:
+        """Model information plus server load, for the info request."""
+        info = self.pipeline.caption_model.get_model_info()
+        info["server_pending"] = self.pending
+        info["server_connections"] = self.connections
+        return info
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        """Serve requests on one connection until the client disconnects."""
+        self.connections += 1
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                operation = header.get("op")
+                if operation == "caption":
+                    await self._caption(header, payload, writer)
+                elif operation == "info":
+                    await write_frame(writer, {"info": self.get_info()})
+                else:
+                    await write_frame(writer, {"error": f"unknown op {operation!r}"})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ProtocolError, KeyError, ValueError) as e:
+            logger.warning(f"Closing connection after bad request: {e}")
+            try:
+                await write_frame(writer, {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, address: str):
+        """Listen on address until interrupted."""
+        kind, target = parse_address(address)
+        if kind == "unix":
+            path = str(target)
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle_connection, path)
+        else:
+            host, port = target  # type: ignore
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Caption server listening on {address}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            await self.pipeline.shutdown()
+            logger.info("Caption server stopped")
+
+def main():
+    """Load the model and serve captions."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--address", default=CAPTION_SERVER_ADDRESS,
+                        help='Listen address, "host:port" or "unix:/path"')
+    parser.add_argument("--backend", choices=("torch", "onnx"),
+                        default=CAPTION_BACKEND if CAPTION_BACKEND != "remote" else "torch",
+                        help="Caption backend served by this process")
+    args = parser.parse_args()
+
+    from image_processor import ImageProcessor
+    from model_loader import ModelLoader
+    from pipeline import CaptionPipeline
+
+    # Warm up before listening, so clients never see the cold first requests
+    caption_model = ModelLoader(args.backend).load()
+    pipeline = CaptionPipeline(ImageProcessor(), caption_model)
+    asyncio.run(CaptionServer(pipeline).serve(args.address))
+
+if __name__ == "__main__":
+    main()
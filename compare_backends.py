@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Compare CPU inference modes of CaptionModel.
+Runs the same images through each mode (fp32, int8, bf16, compile, onnx, ...)
+and reports caption latency, peak memory and word overlap with the fp32
+captions, so the fastest mode that still produces acceptable captions can be
+chosen. Each mode runs in its own process so memory is measured separately.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+from image_processor import ImageProcessor
+
+# Mode name -> CaptionModel keyword arguments
+MODES = {
+    "fp32": {},
+    "int8": {"quantize_int8": True},
+    "bf16": {"bf16_autocast": True},
+    "compile": {"torch_compile": True},
+    "int8+compile": {"quantize_int8": True, "torch_compile": True},
+    # Uses graphs written by export_onnx.py to ONNX_MODEL_DIR
+    "onnx": None
+}
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB (Linux)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return 0.0
+
+def write_synthetic_images(out_dir: Path, count: int):
+    """Write synthetic test images so every mode sees identical input."""
+    for index in range(count):
+        base = Image.linear_gradient('L').rotate(index * 37).resize((640, 480))
+        noise = Image.effect_noise((640, 480), 20 + index * 5)
+        Image.merge('RGB', (base, noise, base)).save(out_dir / f"synthetic_{index:03d}.png")
+
+def load_images(image_dir: str, count: int) -> list:
+    """Load and preprocess up to count images from a directory."""
+    processor = ImageProcessor()
+    paths = sorted(
+        path for path in Path(image_dir).iterdir()
+        if path.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+    )[:count]
+    return [processor.preprocess_image(Image.open(path)) for path in paths]
+
+def word_overlap(caption: str, reference: str) -> float:
+    """F1 of the word sets of two captions (1.0 means same words)."""
+    words = set(caption.lower().strip('.').split())
+    reference_words = set(reference.lower().strip('.').split())
+    if not words or not reference_words:
+        return 0.0
+    common = len(words & reference_words)
+    if common == 0:
+        return 0.0
+    precision = common / len(words)
+    recall = common / len(reference_words)
+    return 2 * precision * recall / (precision + recall)
+
+def run_mode(name: str, images: list, batch_size: int, repeat: int) -> dict:
+    """Load the model in one mode and time caption generation."""
+    from caption_model import CaptionModel
+
+    load_start = time.perf_counter()
+    if MODES[name] is None:
+        from onnx_caption_model import OnnxCaptionModel
+        model = OnnxCaptionModel()
+    else:
+        model = CaptionModel(**MODES[name])
+    load_seconds = time.perf_counter() - load_start
+
+    # First batch includes one-off costs (compilation, allocator warm-up)
+    first_start = time.perf_counter()
+    model.generate_captions(images[:batch_size])
+    first_batch_seconds = time.perf_counter() - first_start
+
+    latencies = []
+    captions = []
+    for _ in range(repeat):
+        captions = []
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            torch.manual_seed(0)
+            batch_start = time.perf_counter()
+            captions.extend(model.generate_captions(batch))
+            latencies.append((time.perf_counter() - batch_start) / len(batch))
+
+    return {
+        "mode": model.optimizations,
+        "load_s": round(load_seconds, 2),
+        "first_batch_s": round(first_batch_seconds, 2),
+        "mean_ms_per_image": round(statistics.mean(latencies) * 1000, 1),
+        "median_ms_per_image": round(statistics.median(latencies) * 1000, 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "captions": captions
+    }
+
+def main():
+    """Run every requested mode in its own process and print a JSON report."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", help="Directory of images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=8, help="Number of images to caption")
+    parser.add_argument("--modes", default="fp32,int8,bf16",
+                        help=f"Comma-separated modes from: {', '.join(MODES)}")
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per generate call")
+    parser.add_argument("--repeat", type=int, default=2, help="Timed passes over the images")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        images = load_images(args.images, args.count)
+        result = run_mode(args.worker, images, args.batch_size, args.repeat)
+        print(json.dumps(result))
+        return
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        raise SystemExit(f"Unknown modes: {', '.join(unknown)}")
+    if "fp32" not in modes:
+        modes.insert(0, "fp32")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_dir = args.images
+        if not image_dir:
+            image_dir = temp_dir
+            write_synthetic_images(Path(temp_dir), args.count)
+
+        results = {}
+        for mode in modes:
+            output = subprocess.run(
+                [sys.executable, __file__, "--worker", mode, "--images", image_dir,
+                 "--count", str(args.count), "--batch-size", str(args.batch_size),
+                 "--repeat", str(args.repeat)],
+                capture_output=True, text=True, check=True
+            ).stdout
+            results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    reference = results["fp32"]["captions"]
+    for result in results.values():
+        scores = [
+            word_overlap(caption or "", expected or "")
+            for caption, expected in zip(result["captions"], reference)
+        ]
+        result["overlap_with_fp32"] = round(statistics.mean(scores), 3) if scores else None
+        result["speedup_vs_fp32"] = round(
+            results["fp32"]["mean_ms_per_image"] / result["mean_ms_per_image"], 2
+        )
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,127 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Bot Configuration
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN environment variable is required")
+BOT_TOKEN = os.getenv('BOT_TOKEN') # Checked when the bot starts, so tools can import config without it
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling') # "polling" or "webhook"
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL') # Bot API endpoint, token appended (unset = https://api.telegram.org/bot)
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL') # File download endpoint, token appended (unset = https://api.telegram.org/file/bot)
+ALLOWED_UPDATES = ["message"] # Update types requested from Telegram (only what the handlers use)
+LAZY_MODEL_LOADING = True # Start polling at once and load the model in the background
+WARMUP_ENABLED = True # Caption synthetic images at startup so the first real one is fast
+WARMUP_BATCH_SIZES = [1, 2, 4, 8] # Batch sizes to warm up (capped at BATCH_MAX_SIZE)
+WARMUP_IMAGE_SIZES = [(384, 384), (512, 384), (384, 576)] # Typical preprocessed image sizes
 
 # Model Configuration
 MODEL_NAME = "Salesforce/blip-image-captioning-base"
 MAX_LENGTH = 100
 NUM_BEAMS = 5
 TEMPERATURE = 1.0
+TOP_P = 0.9
+REPETITION_PENALTY = 1.5
+TEXT_PROMPT = "a photography of" # Prefix for conditional captions; empty for unconditional
+
+# Generation Profiles (selected per chat with /mode)
+GENERATION_PROFILES = {
+    # Greedy decoding: cheapest, used as the fallback under load
+    "fast": {"num_beams": 1, "do_sample": False, "max_length": 40},
+    # Beam search without sampling: most reliable captions
+    "quality": {"num_beams": NUM_BEAMS, "do_sample": False, "max_length": MAX_LENGTH,
+                "length_penalty": 1.0, "early_stopping": True},
+    # Nucleus sampling: more varied wording
+    "creative": {"num_beams": 1, "do_sample": True, "temperature": TEMPERATURE,
+                 "top_p": TOP_P, "max_length": MAX_LENGTH}
+}
+DEFAULT_PROFILE = "quality"
+FALLBACK_PROFILE = "fast" # Used instead of the chat's profile while overloaded
+ADAPTIVE_QUEUE_DEPTH = 16 # Fall back when this many images wait for inference (0 disables)
+ADAPTIVE_P95_MS = 8000 # Fall back when p95 caption latency exceeds this (0 disables)
+ADAPTIVE_LATENCY_WINDOW = 100 # Recent captions used for the p95 estimate
+STREAM_CAPTIONS = True # Show the caption word by word for single-beam profiles when idle
+STREAM_EDIT_INTERVAL = 1.0 # Minimum seconds between message edits in one chat
+
+# Inference Configuration (CPU)
+QUANTIZE_INT8 = False # Dynamic int8 quantization of Linear layers
+BF16_AUTOCAST = False # Run matmuls in bfloat16 (needs a CPU with AVX512-BF16/AMX to pay off)
+TORCH_COMPILE = False # Compile the vision encoder and text decoder with torch.compile
+
+# Caption Backend
+CAPTION_BACKEND = "torch" # "torch", "onnx" (run export_onnx.py first) or "remote" (caption_server.py)
+ONNX_MODEL_DIR = "onnx_model" # Where export_onnx.py writes the ONNX graphs
+ONNX_INTRA_OP_THREADS = 0 # Threads inside one operator (0 = onnxruntime default)
+ONNX_INTER_OP_THREADS = 0 # Operators run in parallel (0 = onnxruntime default)
+ARTIFACT_CACHE_DIR = ".artifact_cache" # Compiled kernels / optimized graphs reused across restarts (None disables)
+
+# Caption Server (CAPTION_BACKEND = "remote")
+CAPTION_SERVER_ADDRESS = "127.0.0.1:8765" # "host:port" or "unix:/path/to/socket"
+CAPTION_SERVER_CONNECTIONS = 4 # Connections per bot, one batch in flight on each
+CAPTION_SERVER_TIMEOUT = 60 # Seconds to wait for a response before giving up
+CAPTION_SERVER_MAX_PENDING = 64 # Images the server accepts at once before answering "busy"
+
+# Batching Configuration
+BATCH_MAX_SIZE = 8 # Maximum number of images captioned in one forward pass
+BATCH_MAX_WAIT_MS = 20 # How long to wait for more images before running a batch
+
+# Album Configuration
+MEDIA_GROUP_WAIT_MS = 1000 # How long to wait for more photos after an album's latest one
+MEDIA_GROUP_MAX_ITEMS = 10 # Telegram albums hold at most 10 photos
+
+# Concurrency Configuration
+CONCURRENT_UPDATES = 64 # Telegram updates handled at the same time
+IO_WORKERS = 4 # Threads for downloading, decoding and resizing images
+INFERENCE_WORKERS = 1 # Threads running model inference (one batch each)
+MAX_CONCURRENT_IMAGES = 16 # Images allowed in the pipeline at once
+USER_MAX_IN_FLIGHT = 8 # Images one user may have in the pipeline at once
+USER_MAX_QUEUED = 20 # Images one user may have waiting; more are refused as busy
+MAX_QUEUED_IMAGES = 200 # Images waiting across all users before everyone is refused
+USER_WEIGHTS = {} # Telegram user id -> images dispatched per round-robin turn (default 1)
+INFERENCE_PROCESSES = 0 # Worker processes sharing one copy of the weights (0 = in-process, CPU only)
+# With INFERENCE_PROCESSES, QUANTIZE_INT8 and TORCH_COMPILE make one copy of the weights per worker
+INFERENCE_PROCESS_THREADS = 0 # Torch threads per worker process (0 = cores / workers)
+WORKER_START_TIMEOUT = 300 # Seconds a worker process may take to start
+
+# Webhook Configuration (UPDATE_MODE = "webhook")
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # Public HTTPS base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_LISTEN = "0.0.0.0" # Interface the webhook server binds to (usually behind a reverse proxy)
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = "telegram-webhook" # URL path the updates are posted to
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') # Requests without this header value are rejected
+WEBHOOK_MAX_CONNECTIONS = 40 # Simultaneous connections Telegram may open (1-100)
+
+# Metrics Configuration
+METRICS_HOST = "127.0.0.1" # Interface for the Prometheus /metrics endpoint
+METRICS_PORT = 9108 # Port for the /metrics endpoint (0 disables it)
+METRICS_WINDOW = 1000 # Recent samples per histogram used for p50/p95/p99
+
+# Trace Recording (replay with replay_trace.py)
+TRACE_PATH = os.getenv('TRACE_PATH') # JSONL file for an anonymized trace of image requests (unset disables)
+TRACE_SALT = os.getenv('TRACE_SALT') # Secret mixed into hashed ids; random per run if unset
+
+# Download Configuration
+DOWNLOAD_POOL_SIZE = 16 # Keep-alive connections used for file downloads
+BOT_CONNECTION_POOL_SIZE = 32 # Connections used for Bot API calls (get_file, replies)
+DOWNLOAD_TIMEOUT = 30 # Seconds before a download is abandoned
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # Bytes read per streamed chunk
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024 # Larger files are refused before or while downloading (Bot API limit)
+HEADER_PROBE_BYTES = 256 * 1024 # Abort if no image header was found within this many bytes
+
+# Memory Budget Configuration
+DOWNLOAD_MEMORY_BUDGET = 128 * 1024 * 1024 # Downloaded file bytes held at once (unknown sizes count as MAX_DOWNLOAD_BYTES)
+DECODE_MEMORY_BUDGET = 384 * 1024 * 1024 # Estimated bitmap bytes of images being decoded and resized at once
+MEMORY_WAIT_TIMEOUT = 120 # Seconds an image may wait for memory before it is refused
+
+# Caption Cache Configuration
+CACHE_ENABLED = True
+CACHE_MAX_ENTRIES = 10000 # Entries kept in memory per key type
+CACHE_TTL_SECONDS = 7 * 24 * 3600 # How long a cached caption stays valid
+CACHE_DB_PATH = None # SQLite file for a persistent tier, e.g. "caption_cache.sqlite3"
+CACHE_HASH_MAX_DISTANCE = 4 # Max differing hash bits for a near-duplicate match
+EMBEDDING_CACHE_BYTES = 256 * 1024 * 1024 # Memory for cached vision-encoder outputs (0 disables)
 
 # Image Processing
 MAX_IMAGE_SIZE = 5120 # Maximum image size to process
+MAX_IMAGE_PIXELS = 120_000_000 # Decompression-bomb limit; images with more pixels are refused
+MODEL_INPUT_SIZE = 384 # BLIP input resolution; images are decoded down to this
+PHOTO_SIZE_MARGIN = 1.0 # Download the smallest photo size whose shorter side is >= MODEL_INPUT_SIZE x this
 SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.bmp', '.webp']
 
 # Bot Messages
@@ -38,4 +147,10 @@ Send an image to get started!
 
 ERROR_MESSAGE = "❌ Sorry, I encountered an error processing your image. Please try again with a different image."
 
-PROCESSING_MESSAGE = "🔄 Analyzing your image... Please wait a moment." 
\ No newline at end of file
+PROCESSING_MESSAGE = "🔄 Analyzing your image... Please wait a moment."
+
+WARMING_UP_MESSAGE = "⏳ The model is still starting up. Your image is queued and will be described shortly." 
+
+BUSY_MESSAGE = "🚦 I'm handling too many images right now. Please try again in a minute."
+
+FILE_TOO_LARGE_MESSAGE = "❌ This file is too large. Please send an image under 20 MB."
\ No newline at end of file
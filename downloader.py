@@ -0,0 +1,108 @@
+import logging
+from typing import Callable, Optional, Tuple
+import httpx
+from config import (
+    DOWNLOAD_POOL_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_CHUNK_SIZE, MAX_DOWNLOAD_BYTES, HEADER_PROBE_BYTES
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class ImageDownloader:
+    """Downloads Telegram files asynchronously over a pooled keep-alive client."""
+
+    def __init__(self, pool_size: int = DOWNLOAD_POOL_SIZE, timeout: float = DOWNLOAD_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Create the shared HTTP client on first use (inside the running loop)."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                )
+            )
+        return self._client
+
+    async def download(self, url: str, expected_size: Optional[int] = None,
+                       max_bytes: int = MAX_DOWNLOAD_BYTES,
+                       probe: Optional[Callable[[bytearray], Tuple[Optional[bool], str]]] = None
+                       ) -> Optional[bytearray]:
+        """
+        Stream a file into a buffer preallocated from its known size.
+
+        The download is abandoned as soon as the file turns out to be larger
+        than max_bytes, or probe rejects its header.
+
+        Args:
+            url: Absolute download URL
+            expected_size: File size reported by Telegram, if known
+            max_bytes: Largest file accepted
+            probe: Called with the bytes received so far until it returns
+                True (accept) or False (reject, with a reason); None means
+                it needs more data, for at most HEADER_PROBE_BYTES
+
+        Returns:
+            Buffer holding the file contents or None if the download failed or was refused
+        """
+        if expected_size and expected_size > max_bytes:
+            logger.warning(f"Refusing download of {expected_size} bytes (limit {max_bytes})")
+            return None
+        try:
+            async with self._get_client().stream("GET", url) as response:
+                response.raise_for_status()
+
+                if not expected_size:
+                    expected_size = int(response.headers.get("Content-Length") or 0)
+                if expected_size > max_bytes:
+                    logger.warning(f"Refusing download of {expected_size} bytes (limit {max_bytes})")
+                    return None
+                buffer = bytearray(expected_size)
+                received = 0
+                checked = probe is None
+
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    end = received + len(chunk)
+                    if end > max_bytes:
+                        logger.warning(f"Aborting download: more than {max_bytes} bytes")
+                        return None
+                    # Grows the buffer only if the server sends more than announced
+                    buffer[received:end] = chunk
+                    received = end
+
+                    # Unsupported formats and oversized dimensions are known
+                    # from the header, long before the whole file arrives
+                    if not checked:
+                        assert probe is not None
+                        verdict, reason = probe(buffer[:received])
+                        if verdict is False:
+                            logger.warning(f"Aborting download after {received} bytes: {reason}")
+                            return None
+                        if verdict is None and received >= HEADER_PROBE_BYTES:
+                            logger.warning(f"Aborting download: no image header in {received} bytes")
+                            return None
+                        checked = bool(verdict)
+
+                if received < len(buffer):
+                    del buffer[received:]
+
+            logger.info(f"Downloaded {received} bytes")
+            return buffer
+
+        except httpx.HTTPError as e:
+            logger.error(f"Network error downloading image: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error downloading image: {e}")
+            return None
+
+    async def close(self):
+        """Close pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Export the BLIP caption model to ONNX for the onnxruntime backend.
+Writes four graphs to ONNX_MODEL_DIR: the vision encoder, the per-layer
+cross-attention keys/values, and the text decoder with and without a
+self-attention KV cache. The processor and export metadata are saved next
+to them so the runtime never needs the PyTorch model.
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import math
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+from torch import nn
+
+from config import ONNX_MODEL_DIR
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+OPSET_VERSION = 17
+
+class VisionEncoder(nn.Module):
+    """pixel_values -> image_embeds."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+class CrossAttentionKV(nn.Module):
+    """image_embeds -> cross-attention key/value per decoder layer, computed once per image."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.layers = model.text_decoder.bert.encoder.layer
+        config = model.text_decoder.config
+        self.num_heads = config.num_attention_heads
+        self.head_size = config.hidden_size // config.num_attention_heads
+
+    def forward(self, image_embeds):
+        batch, length, _ = image_embeds.shape
+        outputs = []
+        for layer in self.layers:
+            attention = layer.crossattention.self
+            for projection in (attention.key, attention.value):
+                states = projection(image_embeds)
+                outputs.append(
+                    states.view(batch, length, self.num_heads, self.head_size).transpose(1, 2)
+                )
+        return tuple(outputs)
+
+class TextDecoder(nn.Module):
+    """
+    One decoding step of the BLIP text decoder with explicit KV tensors.
+
+    The attention math is written out here, while every Linear, LayerNorm and
+    activation is the original transformers submodule, so the exported graph
+    does not depend on the transformers cache implementation.
+    """
+
+    def __init__(self, model, use_past: bool):
+        super().__init__()
+        decoder = model.text_decoder
+        self.embeddings = decoder.bert.embeddings
+        self.layers = decoder.bert.encoder.layer
+        self.head = decoder.cls
+        config = decoder.config
+        self.num_layers = config.num_hidden_layers
+        self.num_heads = config.num_attention_heads
+        self.head_size = config.hidden_size // config.num_attention_heads
+        self.use_past = use_past
+
+    def _split_heads(self, states):
+        batch, length, _ = states.shape
+        return states.view(batch, length, self.num_heads, self.head_size).transpose(1, 2)
+
+    def _merge_heads(self, states):
+        batch, _, length, _ = states.shape
+        return states.transpose(1, 2).reshape(batch, length, self.num_heads * self.head_size)
+
+    def _attend(self, query, key, value, mask=None):
+        scores = torch.matmul(query, key.transpose(-1, -2)) / math.sqrt(self.head_size)
+        if mask is not None:
+            scores = scores + mask
+        return torch.matmul(torch.softmax(scores, dim=-1), value)
+
+    def forward(self, input_ids, *cache):
+        # cache = [past_key_0, past_value_0, ...] (with past) + [cross_key_0, cross_value_0, ...]
+        if self.use_past:
+            past = cache[:2 * self.num_layers]
+            cross = cache[2 * self.num_layers:]
+            past_length = past[0].shape[2]
+        else:
+            past = None
+            cross = cache
+            past_length = 0
+
+        length = input_ids.shape[1]
+        positions = torch.arange(length, device=input_ids.device) + past_length
+        hidden = self.embeddings.word_embeddings(input_ids)
+        hidden = hidden + self.embeddings.position_embeddings(positions).unsqueeze(0)
+        hidden = self.embeddings.LayerNorm(hidden)
+
+        # Causal mask over [past + new] keys for the new queries
+        key_positions = torch.arange(length + past_length, device=input_ids.device)
+        mask = (key_positions.unsqueeze(0) > positions.unsqueeze(1)).to(hidden.dtype)
+        mask = mask * torch.finfo(hidden.dtype).min
+
+        presents = []
+        for index, layer in enumerate(self.layers):
+            attention = layer.attention.self
+            key = self._split_heads(attention.key(hidden))
+            value = self._split_heads(attention.value(hidden))
+            if past is not None:
+                key = torch.cat([past[2 * index], key], dim=2)
+                value = torch.cat([past[2 * index + 1], value], dim=2)
+            presents.extend([key, value])
+
+            query = self._split_heads(attention.query(hidden))
+            context = self._merge_heads(self._attend(query, key, value, mask))
+            attention_output = layer.attention.output(context, hidden)
+
+            cross_query = self._split_heads(layer.crossattention.self.query(attention_output))
+            cross_context = self._merge_heads(
+                self._attend(cross_query, cross[2 * index], cross[2 * index + 1])
+            )
+            attention_output = layer.crossattention.output(cross_context, attention_output)
+
+            hidden = layer.output(layer.intermediate(attention_output), attention_output)
+
+        # Only the last position is needed to pick the next token
+        logits = self.head(hidden[:, -1:, :])[:, 0, :]
+        return (logits, *presents)
+
+def _cache_names(prefix: str, num_layers: int) -> List[str]:
+    """Input/output names for per-layer key/value tensors."""
+    names = []
+    for index in range(num_layers):
+        names.extend([f"{prefix}_key_{index}", f"{prefix}_value_{index}"])
+    return names
+
+def _export(module: nn.Module, args: tuple, path: Path, input_names: List[str],
+            output_names: List[str], dynamic_axes: dict):
+    """Export one graph and log its location."""
+    options = {}
+    # The decoder takes a variable number of cache tensors, which the tracing
+    # exporter handles directly; newer torch defaults to the dynamo exporter
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    torch.onnx.export(
+        module,
+        args,
+        str(path),
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=OPSET_VERSION,
+        do_constant_folding=True,
+        **options
+    )
+    logger.info(f"Exported {path}")
+
+def export_model(caption_model, output_dir: str = ONNX_MODEL_DIR) -> Path:
+    """
+    Export a loaded CaptionModel to ONNX.
+
+    Args:
+        caption_model: CaptionModel with its torch model and processor loaded
+        output_dir: Directory for the ONNX graphs, processor and metadata
+
+    Returns:
+        Path of the output directory
+    """
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+
+    model = caption_model.model.float().eval()
+    preprocessor = caption_model.preprocessor
+    text_config = model.text_decoder.config
+    num_layers = text_config.num_hidden_layers
+    head_size = text_config.hidden_size // text_config.num_attention_heads
+
+    batch = 2
+    pixel_values = torch.zeros(batch, 3, preprocessor.height, preprocessor.width)
+    prompt_ids, _ = preprocessor.prompt_inputs(batch)
+    prompt_ids = prompt_ids[:, :-1]
+
+    with torch.no_grad():
+        vision = VisionEncoder(model).eval()
+        image_embeds = vision(pixel_values)
+        cross_kv_module = CrossAttentionKV(model).eval()
+        cross_kv = cross_kv_module(image_embeds)
+        init_decoder = TextDecoder(model, use_past=False).eval()
+        init_outputs = init_decoder(prompt_ids, *cross_kv)
+        step_decoder = TextDecoder(model, use_past=True).eval()
+        next_ids = torch.zeros(batch, 1, dtype=torch.long)
+
+    cross_names = _cache_names("cross", num_layers)
+    past_names = _cache_names("past", num_layers)
+    present_names = _cache_names("present", num_layers)
+    cross_axes = {name: {0: "batch", 2: "image_length"} for name in cross_names}
+
+    _export(vision, (pixel_values,), out / "vision_encoder.onnx",
+            ["pixel_values"], ["image_embeds"],
+            {"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}})
+    _export(cross_kv_module, (image_embeds,), out / "cross_attention_kv.onnx",
+            ["image_embeds"], cross_names,
+            {"image_embeds": {0: "batch", 1: "image_length"}, **cross_axes})
+    _export(init_decoder, (prompt_ids, *cross_kv), out / "decoder_init.onnx",
+            ["input_ids", *cross_names], ["logits", *present_names],
+            {"input_ids": {0: "batch", 1: "length"}, "logits": {0: "batch"},
+             **cross_axes,
+             **{name: {0: "batch", 2: "length"} for name in present_names}})
+    _export(step_decoder, (next_ids, *init_outputs[1:], *cross_kv), out / "decoder_step.onnx",
+            ["input_ids", *past_names, *cross_names], ["logits", *present_names],
+            {"input_ids": {0: "batch"}, "logits": {0: "batch"},
+             **{name: {0: "batch", 2: "past_length"} for name in past_names},
+             **cross_axes,
+             **{name: {0: "batch", 2: "total_length"} for name in present_names}})
+
+    caption_model.processor.save_pretrained(str(out))
+    info = {
+        "model_name": caption_model.model_name,
+        "num_layers": num_layers,
+        "num_heads": text_config.num_attention_heads,
+        "head_size": head_size,
+        "bos_token_id": text_config.bos_token_id,
+        "sep_token_id": text_config.sep_token_id,
+        "pad_token_id": text_config.pad_token_id,
+        "opset": OPSET_VERSION
+    }
+    (out / "export_info.json").write_text(json.dumps(info, indent=2))
+    logger.info(f"ONNX export complete: {out}")
+    return out
+
+def verify_export(caption_model, output_dir: str = ONNX_MODEL_DIR) -> float:
+    """
+    Compare first-step logits of the exported graphs with the torch model.
+
+    Returns:
+        Maximum absolute logit difference
+    """
+    import onnxruntime as ort
+
+    out = Path(output_dir)
+    model = caption_model.model
+    preprocessor = caption_model.preprocessor
+    pixel_values = torch.randn(1, 3, preprocessor.height, preprocessor.width)
+    prompt_ids, prompt_mask = preprocessor.prompt_inputs(1)
+
+    with torch.inference_mode():
+        image_embeds = model.vision_model(pixel_values=pixel_values)[0]
+        decoder_ids = prompt_ids.clone()
+        decoder_ids[:, 0] = model.text_decoder.config.bos_token_id
+        expected = model.text_decoder(
+            input_ids=decoder_ids[:, :-1],
+            attention_mask=prompt_mask[:, :-1],
+            encoder_hidden_states=image_embeds,
+            is_decoder=True
+        ).logits[:, -1, :].numpy()
+
+    def session(name):
+        return ort.InferenceSession(str(out / name), providers=["CPUExecutionProvider"])
+
+    embeds = session("vision_encoder.onnx").run(None, {"pixel_values": pixel_values.numpy()})[0]
+    cross_session = session("cross_attention_kv.onnx")
+    cross = cross_session.run(None, {"image_embeds": embeds})
+    feeds = {"input_ids": decoder_ids[:, :-1].numpy()}
+    feeds.update({item.name: value for item, value in zip(cross_session.get_outputs(), cross)})
+    logits = session("decoder_init.onnx").run(["logits"], feeds)[0]
+    return float(np.abs(logits - expected).max())
+
+def main():
+    """Load the torch CaptionModel and export it."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default=ONNX_MODEL_DIR, help="Output directory")
+    parser.add_argument("--skip-verify", action="store_true", help="Do not compare against torch")
+    args = parser.parse_args()
+
+    from caption_model import CaptionModel
+
+    # Export from a plain fp32 model regardless of the configured optimizations
+    caption_model = CaptionModel(quantize_int8=False, bf16_autocast=False, torch_compile=False)
+    export_model(caption_model, args.output)
+    if not args.skip_verify:
+        difference = verify_export(caption_model, args.output)
+        logger.info(f"Max logit difference vs torch: {difference:.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, Optional
+from config import (
+    MAX_CONCURRENT_IMAGES, USER_MAX_IN_FLIGHT, USER_MAX_QUEUED, MAX_QUEUED_IMAGES, USER_WEIGHTS
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class SchedulerBusyError(Exception):
+    """Raised when a request is rejected because the queues are full."""
+
+class SchedulerSlot:
+    """
+    A place in the scheduler for one image.
+
+    Use as an async context manager and call wait() inside it; leaving the
+    block frees the slot (or the queue place if it was never granted).
+    Leaving more than once is harmless, so nested blocks may share a slot.
+    """
+
+    def __init__(self, scheduler: "FairScheduler", user: Hashable, granted: asyncio.Future):
+        self.scheduler = scheduler
+        self.user = user
+        self._granted = granted
+        self._closed = False
+
+    async def wait(self):
+        """Wait until the scheduler dispatches this image."""
+        await asyncio.shield(self._granted)
+
+    async def __aenter__(self) -> "SchedulerSlot":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._closed:
+            return
+        self._closed = True
+        if self._granted.done():
+            self.scheduler._release(self.user)
+        else:
+            self.scheduler._abandon(self.user, self._granted)
+
+class FairScheduler:
+    """
+    Admission control and fair dispatch of images between users.
+
+    Each user has a FIFO queue. Free slots are handed out round-robin across
+    users with waiting images, a user with weight w getting up to w images
+    per turn, so one user's album cannot delay everyone else. A user never
+    holds more than max_user_in_flight slots. When a user's queue or the
+    total queue is full, reserve() fails immediately instead of queueing.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_CONCURRENT_IMAGES,
+                 max_user_in_flight: int = USER_MAX_IN_FLIGHT,
+                 max_user_queued: int = USER_MAX_QUEUED,
+                 max_queued: int = MAX_QUEUED_IMAGES,
+                 weights: Optional[Dict[Hashable, int]] = None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_user_in_flight = max(1, max_user_in_flight)
+        self.max_user_queued = max(0, max_user_queued)
+        self.max_queued = max(0, max_queued)
+        self.weights = dict(USER_WEIGHTS if weights is None else weights)
+        # Users with waiting images, in dispatch order
+        self._waiting: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._turns: Dict[Hashable, int] = {}
+        self._running: Dict[Hashable, int] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.dispatched = 0
+        self.rejected = 0
+
+    def _weight(self, user: Hashable) -> int:
+        return max(1, int(self.weights.get(user, 1)))
+
+    def reserve(self, user: Hashable) -> SchedulerSlot:
+        """
+        Admit an image for a user without waiting.
+
+        Args:
+            user: Key the image is accounted to (normally the Telegram user id)
+
+        Returns:
+            Slot to wait on; its context must be left to free it
+
+        Raises:
+            SchedulerBusyError: The user's queue or the total queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        if (not self._waiting and self.in_flight < self.max_in_flight
+                and self._running.get(user, 0) < self.max_user_in_flight):
+            self._grant(user)
+            future.set_result(None)
+            return SchedulerSlot(self, user, future)
+
+        waiting = self._waiting.get(user)
+        if (len(waiting or ()) >= self.max_user_queued
+                or self.queued >= self.max_queued):
+            self.rejected += 1
+            raise SchedulerBusyError(f"Too many images queued (user {user})")
+
+        if waiting is None:
+            waiting = self._waiting[user] = deque()
+        waiting.append(future)
+        self.queued += 1
+        # A user at their in-flight limit may still have found a free slot here
+        self._dispatch()
+        return SchedulerSlot(self, user, future)
+
+    def _grant(self, user: Hashable):
+        self.in_flight += 1
+        self.dispatched += 1
+        self._running[user] = self._running.get(user, 0) + 1
+
+    def _release(self, user: Hashable):
+        """Free a dispatched image's slot and hand it to the next user in turn."""
+        self.in_flight -= 1
+        running = self._running[user] - 1
+        if running:
+            self._running[user] = running
+        else:
+            del self._running[user]
+        self._dispatch()
+
+    def _abandon(self, user: Hashable, future: asyncio.Future):
+        """Drop an image that gave up before it was dispatched."""
+        waiting = self._waiting.get(user)
+        if waiting is None:
+            return
+        try:
+            waiting.remove(future)
+        except ValueError:
+            return
+        self.queued -= 1
+        future.cancel()
+        if not waiting:
+            del self._waiting[user]
+            self._turns.pop(user, None)
+
+    def _dispatch(self):
+        """Hand free slots to waiting users, round-robin by weight."""
+        while self.in_flight < self.max_in_flight and self._waiting:
+            user = next((candidate for candidate in self._waiting
+                         if self._running.get(candidate, 0) < self.max_user_in_flight), None)
+            if user is None:
+                return
+            waiting = self._waiting[user]
+            future = waiting.popleft()
+            self.queued -= 1
+            self._grant(user)
+            future.set_result(None)
+
+            turns = self._turns.get(user, self._weight(user)) - 1
+            if not waiting:
+                del self._waiting[user]
+                self._turns.pop(user, None)
+            elif turns <= 0:
+                # Turn used up: go to the back of the rotation
+                self._waiting.move_to_end(user)
+                self._turns[user] = self._weight(user)
+            else:
+                self._turns[user] = turns
+
+    def get_stats(self) -> dict:
+        """Current load and admission counters."""
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "waiting_users": len(self._waiting),
+            "dispatched": self.dispatched,
+            "rejected": self.rejected
+        }
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Telegram Bot API, for end-to-end tests without network.
+Answers getMe, getUpdates (long polling), getFile, file downloads,
+sendMessage and editMessageText, and feeds the bot synthetic photo traffic
+at a fixed rate once it starts polling. Each update comes from its own chat
+so replies can be matched to it; users still repeat, so per-user fairness
+applies. When every update has a final reply (or --timeout passes), the
+updates/second and reply latency are printed as JSON.
+
+    python fake_bot_api.py --port 8081 --rate 10 --updates 300
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot \\
+    BOT_API_FILE_URL=http://127.0.0.1:8081/file/bot BOT_TOKEN=123:fake python bot.py
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import BUSY_MESSAGE, PROCESSING_MESSAGE, WARMING_UP_MESSAGE
+
+# Telegram's photo sizes: the longer side of each variant, smallest first
+PHOTO_VARIANTS = (90, 320, 800, 1280)
+
+def _percentiles_ms(values: List[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+    return {
+        f"p{round(quantile * 100)}": round(
+            ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000, 1
+        )
+        for quantile in (0.5, 0.95, 0.99)
+    }
+
+class FakeBotApi:
+    """
+    Minimal Bot API server with an optional synthetic photo traffic generator.
+
+    Bot API requests go to /bot<token>/<method>, files to
+    /file/bot<token>/<file_path>, as with api.telegram.org.
+    """
+
+    def __init__(self, updates: int = 0, rate: float = 10.0, users: int = 20,
+                 distinct_images: int = 32, image_size: str = "1280x960",
+                 documents: float = 0.0, poisson: bool = False, start_after: float = 0.0):
+        """
+        Args:
+            updates: Synthetic photo updates to generate (0 = none, plain responder)
+            rate: Updates generated per second
+            users: Distinct senders the updates are spread over
+            distinct_images: Different images; later updates repeat them (cache hits)
+            image_size: Full-size photo dimensions, WIDTHxHEIGHT
+            documents: Fraction of updates sent as image documents instead of photos
+            poisson: Random (exponential) gaps between updates instead of even ones
+            start_after: Seconds between the bot's first poll and the first update
+        """
+        self.target_updates = updates
+        self.rate = max(rate, 1e-3)
+        self.users = max(1, users)
+        self.distinct_images = max(1, distinct_images)
+        self.width, self.height = (int(value) for value in image_size.lower().split("x"))
+        self.documents = documents
+        self.poisson = poisson
+        self.start_after = max(0.0, start_after)
+        self.port = 0
+        self.sent = 0
+        self.files: Dict[str, bytes] = {}
+        self.bytes_served = 0
+
+        self._lock = threading.Lock()
+        self._pending: List[dict] = []
+        self._new_updates: Optional[asyncio.Event] = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._created: Dict[int, float] = {}
+        self._delivered: Dict[int, float] = {}
+        self._finished: Dict[int, float] = {}
+        self._outcomes: Dict[str, int] = {}
+        self._traffic: Optional[asyncio.Task] = None
+        self._first_created: Optional[float] = None
+        self._closing = False
+        self.done: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started = threading.Event()
+
+    # Synthetic content
+
+    def _prepare_files(self):
+        """Encode every photo variant of each distinct image up front."""
+        from bench import make_synthetic_jpeg
+
+        for image in range(self.distinct_images):
+            for longest in PHOTO_VARIANTS:
+                scale = min(1.0, longest / max(self.width, self.height))
+                size = (max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+                self.files[f"img{image}_{longest}"] = make_synthetic_jpeg(image, *size)
+
+    def _file(self, file_id: str) -> dict:
+        data = self.files[file_id]
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data),
+                "file_path": f"photos/{file_id}.jpg"}
+
+    def _make_update(self, rng: random.Random) -> dict:
+        update_id = next(self._update_ids)
+        user_id = 1000 + rng.randrange(self.users)
+        image = (update_id - 1) % self.distinct_images
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            # A chat per update, so every reply can be matched to its update
+            "chat": {"id": update_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Synthetic"}
+        }
+        if rng.random() < self.documents:
+            file = self._file(f"img{image}_{PHOTO_VARIANTS[-1]}")
+            message["document"] = {"file_id": file["file_id"], "file_unique_id": file["file_unique_id"],
+                                   "file_size": file["file_size"], "mime_type": "image/jpeg",
+                                   "file_name": f"{file['file_id']}.jpg"}
+        else:
+            photo = []
+            for longest in PHOTO_VARIANTS:
+                scale = min(1.0, longest / max(self.width, self.height))
+                file = self._file(f"img{image}_{longest}")
+                photo.append({"file_id": file["file_id"], "file_unique_id": file["file_unique_id"],
+                              "file_size": file["file_size"],
+                              "width": max(1, round(self.width * scale)),
+                              "height": max(1, round(self.height * scale))})
+            message["photo"] = photo
+        return {"update_id": update_id, "message": message}
+
+    async def _generate_traffic(self):
+        """Queue synthetic updates at the configured rate."""
+        assert self._new_updates is not None
+        rng = random.Random(0)
+        await asyncio.sleep(self.start_after)
+        started = time.perf_counter()
+        self._first_created = started
+        due = started
+        for _ in range(self.target_updates):
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = self._make_update(rng)
+            with self._lock:
+                self._created[update["update_id"]] = time.perf_counter()
+                self._pending.append(update)
+            self._new_updates.set()
+            due += rng.expovariate(self.rate) if self.poisson else 1.0 / self.rate
+
+    # Bot API methods
+
+    async def _get_updates(self, params: dict) -> list:
+        assert self._new_updates is not None
+        if self._traffic is None and self.target_updates:
+            # Traffic starts once the bot polls, so startup time is not counted
+            self._traffic = asyncio.get_running_loop().create_task(self._generate_traffic())
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.perf_counter() + float(params.get("timeout") or 0)
+        while True:
+            with self._lock:
+                self._pending = [update for update in self._pending if update["update_id"] >= offset]
+                batch = self._pending[:limit]
+                now = time.perf_counter()
+                for update in batch:
+                    self._delivered.setdefault(update["update_id"], now)
+            timeout = deadline - time.perf_counter()
+            if batch or timeout <= 0 or self._closing:
+                return batch
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _record_reply(self, chat_id: int, text: str):
+        """Note when an update got its final reply (not the progress message)."""
+        if text in (PROCESSING_MESSAGE, WARMING_UP_MESSAGE) or text.endswith("…"):
+            return
+        if text.startswith("📸"):
+            outcome = "described"
+        elif text == BUSY_MESSAGE:
+            outcome = "busy"
+        elif text.startswith("❌"):
+            outcome = "error"
+        else:
+            outcome = "other"
+        with self._lock:
+            if chat_id not in self._created or chat_id in self._finished:
+                return
+            self._finished[chat_id] = time.perf_counter()
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            finished = len(self._finished)
+        if finished >= self.target_updates and self.done is not None:
+            self.done.set()
+
+    async def call(self, method: str, params: dict):
+        """Result of one Bot API method call."""
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Fake",
+                    "username": "fake_caption_bot"}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getFile":
+            return self._file(params["file_id"])
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            text = params.get("text", "")
+            with self._lock:
+                self.sent += 1
+                message_id = (int(params["message_id"]) if params.get("message_id")
+                              else next(self._message_ids))
+            self._record_reply(chat_id, text)
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": text}
+        # deleteWebhook, setMyCommands, ...
+        return True
+
+    # HTTP server
+
+    def _application(self):
+        import tornado.web
+
+        api = self
+
+        class MethodHandler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                if self.request.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(self.request.body or b"{}")
+                else:
+                    params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+                try:
+                    result = await api.call(method, params)
+                except KeyError as e:
+                    self.write({"ok": False, "error_code": 400,
+                                "description": f"Bad Request: unknown {e}"})
+                    return
+                self.write({"ok": True, "result": result})
+
+            get = post
+
+        class FileHandler(tornado.web.RequestHandler):
+            def get(self, token, path):
+                data = api.files.get(path.rsplit("/", 1)[-1].split(".")[0])
+                if data is None:
+                    raise tornado.web.HTTPError(404)
+                with api._lock:
+                    api.bytes_served += len(data)
+                self.set_header("Content-Type", "image/jpeg")
+                self.write(data)
+
+        return tornado.web.Application([
+            (r"/file/bot([^/]+)/(.+)", FileHandler),
+            (r"/bot([^/]+)/(\w+)", MethodHandler)
+        ])
+
+    async def start(self, port: int = 0, host: str = "127.0.0.1"):
+        """Prepare the synthetic files and listen on the running loop."""
+        self._new_updates = asyncio.Event()
+        self.done = asyncio.Event()
+        if self.target_updates:
+            self._prepare_files()
+        server = self._application().listen(port, host)
+        self.port = next(iter(server._sockets.values())).getsockname()[1]
+
+    async def close(self):
+        """Answer waiting getUpdates calls so the server can stop cleanly."""
+        assert self._new_updates is not None
+        self._closing = True
+        self._new_updates.set()
+        await asyncio.sleep(0.1)
+
+    def start_in_thread(self, port: int = 0):
+        """Serve from a daemon thread with its own event loop."""
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start(port))
+            self._started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        self._started.wait()
+
+    def stop(self):
+        """Stop a server started with start_in_thread()."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def get_stats(self) -> dict:
+        """Throughput and latency of the synthetic traffic so far."""
+        with self._lock:
+            created = dict(self._created)
+            delivered = dict(self._delivered)
+            finished = dict(self._finished)
+            outcomes = dict(self._outcomes)
+        elapsed = (max(finished.values()) - self._first_created
+                   if finished and self._first_created is not None else 0.0)
+        return {
+            "updates_generated": len(created),
+            "updates_delivered": len(delivered),
+            "updates_answered": len(finished),
+            "outcomes": outcomes,
+            "target_rate_per_s": self.rate,
+            "answered_per_s": round(len(finished) / elapsed, 2) if elapsed > 0 else None,
+            "reply_latency_ms": _percentiles_ms(
+                [finished[key] - created[key] for key in finished]
+            ),
+            "delivery_latency_ms": _percentiles_ms(
+                [delivered[key] - created[key] for key in delivered]
+            ),
+            "messages_sent_by_bot": self.sent,
+            "file_mb_served": round(self.bytes_served / 1e6, 2)
+        }
+
+async def serve(args) -> dict:
+    """Run the server until all traffic is answered or the timeout passes."""
+    api = FakeBotApi(args.updates, args.rate, args.users, args.distinct_images,
+                     args.image_size, args.documents, args.poisson, args.start_after)
+    await api.start(args.port, args.host)
+    print(f"Fake Bot API listening on http://{args.host}:{api.port} "
+          f"(base URL http://{args.host}:{api.port}/bot, "
+          f"file URL http://{args.host}:{api.port}/file/bot)", flush=True)
+    assert api.done is not None
+    if not args.updates:
+        # Plain responder: serve until interrupted
+        await asyncio.Event().wait()
+    try:
+        await asyncio.wait_for(api.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print("Timed out before every update was answered", flush=True)
+    await api.close()
+    return api.get_stats()
+
+def main():
+    """Serve the fake Bot API and print JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8081, help="Port to listen on")
+    parser.add_argument("--updates", type=int, default=200,
+                        help="Synthetic photo updates to send (0 = only answer API calls)")
+    parser.add_argument("--rate", type=float, default=10.0, help="Updates per second")
+    parser.add_argument("--users", type=int, default=20, help="Distinct senders")
+    parser.add_argument("--distinct-images", type=int, default=32,
+                        help="Different images; further updates repeat them")
+    parser.add_argument("--image-size", default="1280x960", help="Full photo size, WIDTHxHEIGHT")
+    parser.add_argument("--documents", type=float, default=0.0,
+                        help="Fraction of updates sent as image documents")
+    parser.add_argument("--poisson", action="store_true", help="Random gaps between updates")
+    parser.add_argument("--start-after", type=float, default=0.0,
+                        help="Seconds to wait after the bot's first poll (e.g. for model loading)")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="Seconds after which to report even if replies are missing")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(serve(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
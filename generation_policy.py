@@ -0,0 +1,83 @@
+import logging
+import threading
+from collections import deque
+from typing import Optional
+from config import (
+    GENERATION_PROFILES, DEFAULT_PROFILE, FALLBACK_PROFILE,
+    ADAPTIVE_QUEUE_DEPTH, ADAPTIVE_P95_MS, ADAPTIVE_LATENCY_WINDOW
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class AdaptiveProfilePolicy:
+    """Chooses the generation profile per request, falling back to a cheaper one under load."""
+
+    def __init__(self, fallback_profile: str = FALLBACK_PROFILE,
+                 max_queue_depth: int = ADAPTIVE_QUEUE_DEPTH,
+                 max_p95_ms: float = ADAPTIVE_P95_MS,
+                 window: int = ADAPTIVE_LATENCY_WINDOW):
+        if fallback_profile not in GENERATION_PROFILES:
+            raise ValueError(f"Unknown FALLBACK_PROFILE: {fallback_profile}")
+        self.fallback_profile = fallback_profile
+        self.max_queue_depth = max_queue_depth
+        self.max_p95 = max_p95_ms / 1000.0
+        self._latencies: deque = deque(maxlen=max(1, window))
+        self._lock = threading.Lock()
+        self.fallbacks = 0
+
+    def record_latency(self, seconds: float):
+        """Record how long one caption took from submission to result."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def p95_latency(self) -> Optional[float]:
+        """95th percentile of recent caption latencies in seconds, or None without data."""
+        with self._lock:
+            if not self._latencies:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def overloaded(self, queue_depth: int) -> bool:
+        """Whether the queue depth or recent latency calls for the fallback profile."""
+        if self.max_queue_depth and queue_depth >= self.max_queue_depth:
+            return True
+        if self.max_p95:
+            p95 = self.p95_latency()
+            if p95 is not None and p95 > self.max_p95:
+                return True
+        return False
+
+    def resolve(self, requested: Optional[str]) -> str:
+        """Profile a chat asked for, or DEFAULT_PROFILE if unset or unknown."""
+        return requested if requested in GENERATION_PROFILES else DEFAULT_PROFILE
+
+    def choose(self, requested: Optional[str], queue_depth: int) -> str:
+        """
+        Pick the profile to run a caption with.
+
+        Args:
+            requested: Profile selected for the chat (None for DEFAULT_PROFILE)
+            queue_depth: Images currently waiting for inference
+
+        Returns:
+            Name of a profile in GENERATION_PROFILES
+        """
+        profile = self.resolve(requested)
+        if profile != self.fallback_profile and self.overloaded(queue_depth):
+            self.fallbacks += 1
+            logger.info(f"Overloaded (queue depth {queue_depth}), "
+                        f"using {self.fallback_profile!r} instead of {profile!r}")
+            return self.fallback_profile
+        return profile
+
+    def get_stats(self) -> dict:
+        """Get latency and fallback counters."""
+        p95 = self.p95_latency()
+        return {
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "samples": len(self._latencies),
+            "fallbacks": self.fallbacks
+        }
@@ -1,21 +1,139 @@
 import os
 import requests
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
-from typing import Optional, Tuple
+import threading
+import warnings
+from typing import Optional, Sequence, Tuple, Union
 import logging
-from config import MAX_IMAGE_SIZE, SUPPORTED_FORMATS
+from telegram import PhotoSize
+from config import (
+    MAX_IMAGE_SIZE, SUPPORTED_FORMATS, MODEL_INPUT_SIZE, DOWNLOAD_TIMEOUT, PHOTO_SIZE_MARGIN,
+    MAX_IMAGE_PIXELS, MAX_DOWNLOAD_BYTES, HEADER_PROBE_BYTES, DOWNLOAD_CHUNK_SIZE,
+    BOT_API_FILE_URL
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Decompression-bomb guard: opening an image with more pixels than this
+# fails (PIL only warns below twice the limit unless told otherwise)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter("error", Image.DecompressionBombWarning)
+
+class _BufferReader(io.RawIOBase):
+    """Read-only file over a downloaded buffer, so decoding does not copy it like BytesIO."""
+    
+    def __init__(self, data: Union[bytes, bytearray, memoryview]):
+        self._view = memoryview(data)
+        self._position = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def close(self):
+        # Let the buffer be resized or freed once the image is done with it
+        self._view.release()
+        super().close()
+
 class ImageProcessor:
     """Handles image processing and validation for the BLIP model."""
     
     def __init__(self):
         self.max_size = MAX_IMAGE_SIZE
         self.supported_formats = SUPPORTED_FORMATS
+        self.target_size = MODEL_INPUT_SIZE
+        self.resizable_modes = ('RGB', 'RGBA', 'L', 'LA', 'I', 'F')
+        # Reuse connections between downloads on the synchronous path
+        self.session = requests.Session()
+        # Smallest side a photo needs so preprocessing never upscales
+        self.min_photo_side = round(self.target_size * PHOTO_SIZE_MARGIN)
+        self._photo_lock = threading.Lock()
+        self.photos_selected = 0
+        self.photo_bytes_selected = 0
+        self.photo_bytes_largest = 0
+    
+    def select_photo_size(self, photos: Sequence[PhotoSize]) -> PhotoSize:
+        """
+        Pick the smallest photo size that still covers the model input.
+        
+        Telegram sends each photo in several sizes; the model only sees a
+        MODEL_INPUT_SIZE square, so the full resolution is rarely needed.
+        Falls back to the largest size when none is big enough.
+        
+        Args:
+            photos: PhotoSize list from a Telegram message
+            
+        Returns:
+            Selected PhotoSize
+        """
+        by_area = sorted(photos, key=lambda photo: photo.width * photo.height)
+        largest = by_area[-1]
+        selected = next(
+            (photo for photo in by_area if min(photo.width, photo.height) >= self.min_photo_side),
+            largest
+        )
+        
+        # Sizes are only comparable when Telegram reported both
+        if selected.file_size and largest.file_size:
+            with self._photo_lock:
+                self.photos_selected += 1
+                self.photo_bytes_selected += selected.file_size
+                self.photo_bytes_largest += largest.file_size
+        return selected
+    
+    def get_photo_stats(self) -> dict:
+        """Bytes downloaded for photos versus always taking the largest size."""
+        with self._photo_lock:
+            saved = self.photo_bytes_largest - self.photo_bytes_selected
+            return {
+                "photos": self.photos_selected,
+                "bytes_downloaded": self.photo_bytes_selected,
+                "bytes_saved": saved,
+                "saved_percent": round(100 * saved / self.photo_bytes_largest, 1)
+                if self.photo_bytes_largest else 0.0
+            }
+    
+    def build_download_url(self, file_path: str) -> Optional[str]:
+        """
+        Build the download URL for a Telegram file path.
+        
+        Args:
+            file_path: Telegram file path (relative or absolute URL)
+            
+        Returns:
+            Absolute download URL or None if the bot token is missing
+        """
+        # Check if file_path already contains the base URL
+        if file_path.startswith('http'):
+            return file_path
+        
+        bot_token = os.getenv('BOT_TOKEN')
+        if not bot_token:
+            logger.error("BOT_TOKEN not found in environment variables")
+            return None
+        
+        # The file_path from Telegram is relative, so we need to construct the full URL
+        base_file_url = BOT_API_FILE_URL or "https://api.telegram.org/file/bot"
+        return f"{base_file_url}{bot_token}/{file_path}"
     
     def download_image(self, file_path: str) -> Optional[Image.Image]:
         """
@@ -29,29 +147,37 @@ class ImageProcessor:
         """
         try:
             # Construct the correct URL for downloading Telegram files
-            bot_token = os.getenv('BOT_TOKEN')
-            if not bot_token:
-                logger.error("BOT_TOKEN not found in environment variables")
+            download_url = self.build_download_url(file_path)
+            if download_url is None:
                 return None
             
-            # Check if file_path already contains the base URL
-            if file_path.startswith('https://api.telegram.org/file/bot'):
-                download_url = file_path
-            elif file_path.startswith('http'):
-                download_url = file_path
-            else:
-                # The file_path from Telegram is relative, so we need to construct the full URL
-                download_url = f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
-            
             logger.info(f"Downloading image from: {download_url}")
             
-            # Download the file from Telegram
-            response = requests.get(download_url, timeout=30)
-            response.raise_for_status()
+            # Stream the file so oversized or non-image files are dropped early
+            with self.session.get(download_url, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > MAX_DOWNLOAD_BYTES:
+                    logger.warning(f"Refusing download: file larger than {MAX_DOWNLOAD_BYTES} bytes")
+                    return None
+                
+                data = bytearray()
+                checked = False
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    data += chunk
+                    if len(data) > MAX_DOWNLOAD_BYTES:
+                        logger.warning(f"Aborting download: file larger than {MAX_DOWNLOAD_BYTES} bytes")
+                        return None
+                    if not checked:
+                        verdict, reason = self.probe_header(data)
+                        if verdict is False or (verdict is None and len(data) >= HEADER_PROBE_BYTES):
+                            logger.warning(f"Aborting download: {reason or 'no image header found'}")
+                            return None
+                        checked = bool(verdict)
             
             # Open image from bytes
-            image = Image.open(io.BytesIO(response.content))
-            logger.info(f"Successfully downloaded image: {image.size} {image.mode}")
+            image = self.load_image(data)
+            if image is not None:
+                logger.info(f"Successfully downloaded image: {image.size} {image.mode}")
             return image
             
         except requests.exceptions.RequestException as e:
@@ -61,6 +187,84 @@ class ImageProcessor:
             logger.error(f"Error downloading image: {e}")
             return None
     
+    def load_image(self, data: Union[bytes, bytearray]) -> Optional[Image.Image]:
+        """
+        Open an image from downloaded bytes.
+        
+        Args:
+            data: Raw image file contents
+            
+        Returns:
+            PIL Image object or None if the data is not a readable image
+        """
+        try:
+            return Image.open(_BufferReader(data))
+        except Exception as e:
+            logger.error(f"Error opening image: {e}")
+            return None
+    
+    def estimate_decoded_bytes(self, data: Union[bytes, bytearray]) -> int:
+        """
+        Upper estimate of the bitmap memory preprocess_image() needs for a file.
+        
+        Only the header is read. Counts the decoded bitmap (at the JPEG draft
+        scale), a full-size RGB copy for modes that cannot be resized directly,
+        and the model-input sized result. PIL keeps multi-band pixels in 4 bytes.
+        
+        Args:
+            data: Raw image file contents
+            
+        Returns:
+            Estimated bytes (0 if the header cannot be read; decoding then fails early)
+        """
+        try:
+            with Image.open(_BufferReader(data)) as image:
+                width, height = image.size
+                mode, image_format = image.mode, image.format
+        except Exception:
+            return 0
+        
+        def bitmap(size: Tuple[int, int], bitmap_mode: str) -> int:
+            return size[0] * size[1] * (1 if bitmap_mode in ('1', 'L', 'P') else 4)
+        
+        scale = min(1.0, self.target_size / max(1, min(width, height)))
+        output = (max(1, round(width * scale)), max(1, round(height * scale)))
+        decoded = (width, height)
+        if scale < 1 and image_format == 'JPEG':
+            # Same reduction as Image.draft(): the largest of 1/2, 1/4, 1/8 that still covers output
+            reduce = min(width // output[0], height // output[1])
+            reduce = next(factor for factor in (8, 4, 2, 1) if reduce >= factor)
+            decoded = (-(-width // reduce), -(-height // reduce))
+            mode = 'RGB'
+        
+        total = bitmap(decoded, mode) + 2 * bitmap(output, 'RGB')
+        if mode not in self.resizable_modes:
+            total += bitmap(decoded, 'RGB')
+        return total
+    
+    def probe_header(self, data: Union[bytes, bytearray]) -> Tuple[Optional[bool], str]:
+        """
+        Check format and dimensions from the first bytes of an image file.
+        
+        Only the header is parsed; no pixel data is decoded or allocated, so
+        this can run on every chunk of a download until it gives a verdict.
+        
+        Args:
+            data: Start of the file (or all of it)
+            
+        Returns:
+            Tuple of (True if acceptable / False if not / None if the header
+            is not complete yet, error_message)
+        """
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                return self.validate_image(image)
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            return False, str(e)
+        except (UnidentifiedImageError, SyntaxError, OSError, EOFError):
+            # Truncated headers look like unknown formats until more data arrives
+            return None, ""
+    
     def validate_image(self, image: Image.Image) -> Tuple[bool, str]:
         """
         Validate image format and size.
@@ -93,31 +297,65 @@ class ImageProcessor:
             if max(image.size) > self.max_size * 4:
                 return False, f"Image too large. Maximum size: {self.max_size * 4}px"
             
+            # Decompression bombs: small files that expand to huge bitmaps
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                return False, f"Image has too many pixels. Maximum: {MAX_IMAGE_PIXELS}"
+            
             return True, ""
             
         except Exception as e:
             return False, f"Invalid image: {str(e)}"
     
-    def preprocess_image(self, image: Image.Image) -> Image.Image:
+    def preprocess_image(self, image: Image.Image, close_input: bool = False) -> Image.Image:
         """
         Preprocess image for BLIP model.
         
+        The model only sees a MODEL_INPUT_SIZE square, so images are shrunk
+        until their shorter side reaches that size. JPEGs are decoded directly
+        at a reduced scale (draft mode) and the remaining reduction is done in
+        a single resize before the mode conversion, so the full-resolution
+        bitmap is never materialised.
+        
         Args:
-            image: PIL Image object
+            image: PIL Image object (ideally not yet loaded)
+            close_input: Free the input's bitmap as soon as it has been consumed
+                (for images the caller does not use afterwards)
             
         Returns:
             Preprocessed PIL Image object
         """
         try:
+            source = image
+            
+            def replace(current: Image.Image, new: Image.Image) -> Image.Image:
+                # Each full-size intermediate is freed once the next one exists
+                if current is not source or close_input:
+                    current.close()
+                return new
+            
+            width, height = image.size
+            scale = self.target_size / min(width, height)
+            
+            if scale < 1:
+                new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                
+                # Let the JPEG decoder skip detail we would throw away anyway
+                if image.format == 'JPEG':
+                    image.draft('RGB', new_size)
+                
+                # Palette and other exotic modes cannot be resampled directly
+                if image.mode not in self.resizable_modes:
+                    image = replace(image, image.convert('RGB'))
+                
+                image = replace(image, image.resize(new_size, Image.Resampling.BICUBIC,
+                                                    reducing_gap=2.0))
+            
             # Convert to RGB if necessary
             if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Resize if too large while maintaining aspect ratio
-            if max(image.size) > self.max_size:
-                ratio = self.max_size / max(image.size)
-                new_size = (int(image.size[0] * ratio), int(image.size[1] * ratio))
-                image = image.resize(new_size, Image.Resampling.LANCZOS)
+                image = replace(image, image.convert('RGB'))
+            elif image is source and close_input:
+                # Decode now rather than during inference, and let go of the file buffer
+                image = replace(image, image.copy())
             
             return image
             
@@ -141,17 +379,40 @@ class ImageProcessor:
             if image is None:
                 return None
             
-            # Validate image
-            is_valid, error_msg = self.validate_image(image)
-            if not is_valid:
-                logger.error(f"Image validation failed: {error_msg}")
-                return None
+            return self._validate_and_preprocess(image)
+            
+        except Exception as e:
+            logger.error(f"Error processing image: {e}")
+            return None 
+    
+    def process_image_bytes(self, data: Union[bytes, bytearray]) -> Optional[Image.Image]:
+        """
+        Processing pipeline for an image that has already been downloaded.
+        
+        Args:
+            data: Raw image file contents
             
-            # Preprocess image
-            processed_image = self.preprocess_image(image)
+        Returns:
+            Processed PIL Image object or None if failed
+        """
+        try:
+            image = self.load_image(data)
+            if image is None:
+                return None
             
-            return processed_image
+            return self._validate_and_preprocess(image)
             
         except Exception as e:
             logger.error(f"Error processing image: {e}")
-            return None 
\ No newline at end of file
+            return None
+    
+    def _validate_and_preprocess(self, image: Image.Image) -> Optional[Image.Image]:
+        """Validate an opened image and preprocess it, or return None if invalid."""
+        # Validate image
+        is_valid, error_msg = self.validate_image(image)
+        if not is_valid:
+            logger.error(f"Image validation failed: {error_msg}")
+            return None
+        
+        # Preprocess image; the opened file is not needed afterwards
+        return self.preprocess_image(image, close_input=True)
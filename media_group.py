@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Any, Dict, List
+from config import MEDIA_GROUP_WAIT_MS, MEDIA_GROUP_MAX_ITEMS
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class _Group:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.changed = asyncio.Event()
+
+class MediaGroupCollector:
+    """
+    Gathers the messages of a Telegram album (media group).
+
+    Telegram delivers an album as separate messages sharing a media_group_id,
+    a few milliseconds apart. The first message of a group waits until no
+    new message has arrived for the wait time (or the group is full) and
+    then receives every item; the other messages only add themselves.
+    """
+
+    def __init__(self, wait_ms: float = MEDIA_GROUP_WAIT_MS,
+                 max_items: int = MEDIA_GROUP_MAX_ITEMS):
+        self.wait = max(0.0, wait_ms) / 1000.0
+        self.max_items = max(1, max_items)
+        self._groups: Dict[str, _Group] = {}
+
+    def add(self, group_id: str, item: Any) -> bool:
+        """
+        Add an item to its group.
+
+        Args:
+            group_id: Telegram media_group_id
+            item: Anything describing the message
+
+        Returns:
+            True if this is the group's first item; the caller must then
+            collect() the group
+        """
+        group = self._groups.get(group_id)
+        first = group is None
+        if group is None:
+            group = self._groups[group_id] = _Group()
+        group.items.append(item)
+        group.changed.set()
+        return first
+
+    async def collect(self, group_id: str) -> List[Any]:
+        """
+        Wait until the group is complete and return its items in arrival order.
+
+        Args:
+            group_id: Telegram media_group_id passed to add()
+        """
+        group = self._groups[group_id]
+        try:
+            while len(group.items) < self.max_items:
+                group.changed.clear()
+                try:
+                    await asyncio.wait_for(group.changed.wait(), self.wait)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Messages arriving after this start a new group
+            del self._groups[group_id]
+        return group.items
+
+    @property
+    def pending(self) -> int:
+        """Number of albums still being collected."""
+        return len(self._groups)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class MemoryBudgetError(Exception):
+    """Raised when memory for an image could not be reserved in time."""
+
+class MemoryReservation:
+    """
+    Bytes held against a MemoryBudget; use as an async context manager.
+
+    The memory is counted from entering the context until release() or
+    leaving it; shrink() hands back what a finished stage no longer needs.
+    """
+
+    def __init__(self, budget: "MemoryBudget", nbytes: int):
+        self.budget = budget
+        # Larger requests than the whole budget run alone instead of never
+        self.nbytes = max(0, min(nbytes, budget.limit))
+        self.held = 0
+
+    async def __aenter__(self) -> "MemoryReservation":
+        await self.budget._acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def shrink(self, nbytes: int):
+        """Keep only nbytes reserved, returning the rest to the budget."""
+        if 0 <= nbytes < self.held:
+            self.budget._release(self.held - nbytes)
+            self.held = nbytes
+
+    def release(self):
+        """Return everything still held (safe to call more than once)."""
+        if self.held:
+            self.budget._release(self.held)
+            self.held = 0
+
+class MemoryBudget:
+    """
+    Caps the bytes that images in flight may hold at one stage.
+
+    Reservations are granted in arrival order, so a large image is not
+    starved by a stream of small ones. Use from the event loop only.
+    """
+
+    def __init__(self, limit: int, name: str = "memory", timeout: Optional[float] = None):
+        """
+        Args:
+            limit: Bytes that may be reserved at once
+            name: Label used in logs and metrics
+            timeout: Seconds to wait for a reservation before giving up (None waits forever)
+        """
+        self.limit = max(1, limit)
+        self.name = name
+        self.timeout = timeout
+        self.in_use = 0
+        self.peak = 0
+        self.waited = 0
+        self.timeouts = 0
+        self._waiters: Deque[Tuple[MemoryReservation, asyncio.Future]] = deque()
+
+    def reserve(self, nbytes: int) -> MemoryReservation:
+        """
+        Reservation for nbytes, granted when its context is entered.
+
+        Raises (on entering):
+            MemoryBudgetError: Not granted within the timeout
+        """
+        return MemoryReservation(self, nbytes)
+
+    def _grant(self, reservation: MemoryReservation):
+        reservation.held = reservation.nbytes
+        self.in_use += reservation.nbytes
+        self.peak = max(self.peak, self.in_use)
+
+    async def _acquire(self, reservation: MemoryReservation):
+        if not self._waiters and self.in_use + reservation.nbytes <= self.limit:
+            self._grant(reservation)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (reservation, future)
+        self._waiters.append(entry)
+        self.waited += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # Granted just as the wait ended: hand the memory back
+                reservation.release()
+            else:
+                future.cancel()
+                self._waiters.remove(entry)
+                self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise MemoryBudgetError(
+                    f"No {self.name} memory for {reservation.nbytes} bytes "
+                    f"within {self.timeout}s ({self.in_use}/{self.limit} in use)"
+                ) from None
+            raise
+
+    def _release(self, nbytes: int):
+        self.in_use -= nbytes
+        self._wake()
+
+    def _wake(self):
+        """Grant waiting reservations in order while they fit."""
+        while self._waiters:
+            reservation, future = self._waiters[0]
+            if self.in_use + reservation.nbytes > self.limit:
+                return
+            self._waiters.popleft()
+            self._grant(reservation)
+            future.set_result(None)
+
+    @property
+    def waiting(self) -> int:
+        """Reservations queued for memory."""
+        return len(self._waiters)
+
+    def get_stats(self) -> dict:
+        """Current and peak use and how often images had to wait."""
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "peak": self.peak,
+            "waiting": len(self._waiters),
+            "waited": self.waited,
+            "timeouts": self.timeouts
+        }
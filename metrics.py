@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from config import METRICS_WINDOW
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds; covers cache hits (~1 ms) up to slow beam-search batches
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic count, either incremented or read from a callback at scrape time."""
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self._fn = fn
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._fn() if self._fn is not None else self._value
+
+    def bind(self, fn: Callable[[], float]):
+        """Read the value from fn from now on, replacing any earlier callback."""
+        self._fn = fn
+
+class Gauge(Counter):
+    """Current value, either set or read from a callback at scrape time."""
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+class Histogram:
+    """
+    Bucketed latency distribution (for Prometheus) plus a window of recent
+    samples for exact p50/p95/p99.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS, window: int = METRICS_WINDOW):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._recent: Deque[float] = deque(maxlen=max(1, window))
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._recent.append(value)
+            self.count += 1
+            self.sum += value
+
+    def percentiles(self, quantiles: Tuple[float, ...] = (0.5, 0.95, 0.99)) -> Dict[float, Optional[float]]:
+        """Quantiles over the recent window (None without samples)."""
+        with self._lock:
+            ordered = sorted(self._recent)
+        if not ordered:
+            return {quantile: None for quantile in quantiles}
+        return {
+            quantile: ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+            for quantile in quantiles
+        }
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            counts = list(self._counts)
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+class MetricsRegistry:
+    """Named, labelled metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, Dict[Labels, object]]] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, name: str, help_text: str, labels: Dict[str, str], factory):
+        key: Labels = tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (kind, help_text, {})
+            elif family[0] != kind:
+                raise ValueError(f"Metric {name} already registered as a {family[0]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name: str, help_text: str = "",
+                fn: Optional[Callable[[], float]] = None, **labels: str) -> Counter:
+        """
+        Get or create a counter (fn makes it read its value at scrape time).
+
+        Passing fn for an existing counter rebinds it, so the latest owner
+        (e.g. a new pipeline in the same process) is the one reported.
+        """
+        counter = self._get("counter", name, help_text, labels, lambda: Counter(fn))
+        if fn is not None:
+            counter.bind(fn)
+        return counter
+
+    def gauge(self, name: str, help_text: str = "",
+              fn: Optional[Callable[[], float]] = None, **labels: str) -> Gauge:
+        """Get or create a gauge (fn makes it read its value at scrape time, see counter())."""
+        gauge = self._get("gauge", name, help_text, labels, lambda: Gauge(fn))
+        if fn is not None:
+            gauge.bind(fn)
+        return gauge
+
+    def histogram(self, name: str, help_text: str = "", **labels: str) -> Histogram:
+        """Get or create a latency histogram."""
+        return self._get("histogram", name, help_text, labels, Histogram)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, help_text: str = "", **labels: str) -> Iterator[None]:
+        """Observe the duration of the block in a histogram (also when it raises)."""
+        histogram = self.histogram(name, help_text, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    def discard(self, name: str, **labels: str):
+        """Forget one labelled metric, e.g. samples that would skew the percentiles."""
+        key: Labels = tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is not None:
+                family[2].pop(key, None)
+
+    def collect(self, name: str) -> Dict[Labels, object]:
+        """Metrics of one family by label set (empty if unknown)."""
+        with self._lock:
+            family = self._families.get(name)
+            return dict(family[2]) if family is not None else {}
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            families = [(name, kind, help_text, dict(metrics))
+                        for name, (kind, help_text, metrics) in sorted(self._families.items())]
+        lines = []
+        for name, kind, help_text, metrics in families:
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(metrics.items()):
+                if isinstance(metric, Histogram):
+                    for bound, count in metric.cumulative_counts():
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+                else:
+                    try:
+                        value = metric.value  # type: ignore[attr-defined]
+                    except Exception as e:
+                        logger.debug(f"Skipping metric {name}: {e}")
+                        continue
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            # Recent-window quantiles for readers without a Prometheus server
+            if kind == "histogram":
+                lines.append(f"# TYPE {name}_recent gauge")
+                for labels, metric in sorted(metrics.items()):
+                    for quantile, value in metric.percentiles().items():  # type: ignore[attr-defined]
+                        if value is not None:
+                            lines.append(
+                                f"{name}_recent{_format_labels(labels, ('quantile', str(quantile)))} {value}"
+                            )
+        return "\n".join(lines) + "\n"
+
+# Shared by the bot, the pipeline and the model
+METRICS = MetricsRegistry()
+
+STAGE_METRIC = "caption_stage_seconds"
+
+def time_stage(stage: str):
+    """Time one stage of handling an image (get_file, download, decode, encoder, ...)."""
+    return METRICS.timer(STAGE_METRIC, "Time spent per image-handling stage", stage=stage)
+
+def observe_stage(stage: str, seconds: float):
+    """Record a stage duration measured by the caller."""
+    METRICS.histogram(STAGE_METRIC, "Time spent per image-handling stage", stage=stage).observe(seconds)
+
+def stage_percentiles() -> Dict[str, Tuple[int, Dict[float, Optional[float]]]]:
+    """Sample count and recent p50/p95/p99 per stage, for /status."""
+    return {
+        dict(labels)["stage"]: (histogram.count, histogram.percentiles())  # type: ignore[attr-defined]
+        for labels, histogram in METRICS.collect(STAGE_METRIC).items()
+    }
+
+async def serve_metrics(host: str, port: int,
+                        registry: MetricsRegistry = METRICS) -> asyncio.AbstractServer:
+    """
+    Serve GET /metrics on a small HTTP server in the running loop.
+
+    Args:
+        host: Interface to bind (keep it local unless scraped remotely)
+        port: TCP port
+
+    Returns:
+        The started server; close() it on shutdown
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the request headers
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
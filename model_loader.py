@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from itertools import cycle, islice
+from typing import Any, Callable, Optional
+from PIL import Image
+from config import (
+    CAPTION_BACKEND, BATCH_MAX_SIZE, DEFAULT_PROFILE, GENERATION_PROFILES,
+    WARMUP_ENABLED, WARMUP_BATCH_SIZES, WARMUP_IMAGE_SIZES
+)
+from metrics import METRICS, STAGE_METRIC
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def warm_up_model(caption_model: Any, on_progress: Optional[Callable[[str], None]] = None) -> int:
+    """
+    Caption synthetic images so lazy initialisation, compilation and allocator
+    growth happen before the first real request.
+
+    Every configured batch size runs with the default profile; the other
+    profiles run once at batch size 1. Images cycle through WARMUP_IMAGE_SIZES
+    and are fresh noise for every run, so none is served from the embedding
+    cache and the encoder sees every batch size too.
+
+    Args:
+        caption_model: Loaded caption model
+        on_progress: Called with a short stage description before each run
+
+    Returns:
+        Number of warm-up runs
+    """
+    # A remote server warms itself up
+    if getattr(caption_model, "remote", False):
+        return 0
+
+    batch_sizes = sorted({max(1, min(size, BATCH_MAX_SIZE)) for size in WARMUP_BATCH_SIZES})
+    runs = [(size, DEFAULT_PROFILE) for size in batch_sizes]
+    runs += [(1, profile) for profile in GENERATION_PROFILES if profile != DEFAULT_PROFILE]
+
+    for index, (batch_size, profile) in enumerate(runs, start=1):
+        if on_progress is not None:
+            on_progress(f"warming up ({index}/{len(runs)}: {profile} x{batch_size})")
+        batch = [Image.effect_noise(size, 40).convert('RGB')
+                 for size in islice(cycle(WARMUP_IMAGE_SIZES), batch_size)]
+        caption_model.generate_captions(batch, [profile] * batch_size)
+
+    # Synthetic embeddings would only take space from real ones
+    embedding_cache = getattr(caption_model, "embedding_cache", None)
+    if embedding_cache is not None:
+        embedding_cache.clear()
+    # Warm-up runs (compilation included) are not representative latencies
+    for stage in ("preprocess", "encoder", "decoder"):
+        METRICS.discard(STAGE_METRIC, stage=stage)
+    METRICS.discard("caption_tokens_generated_total")
+    return len(runs)
+
+class ModelLoader:
+    """Loads the caption model (and its heavy imports) while the bot is already running."""
+
+    def __init__(self, backend: str = CAPTION_BACKEND, warm_up: bool = WARMUP_ENABLED):
+        self.backend = backend
+        self.warm_up = warm_up
+        self.state = "pending"  # pending -> loading -> ready | failed
+        self.stage = "waiting to start"
+        self.error: Optional[str] = None
+        self.caption_model: Any = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def set_stage(self, stage: str):
+        """Record what the loader is doing, for /status."""
+        with self._lock:
+            self.stage = stage
+        logger.info(f"Model startup: {stage}")
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds spent loading so far (or in total once finished)."""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def load(self) -> Any:
+        """
+        Import the model libraries and build the caption model (blocking).
+
+        Meant to run in a worker thread; progress is visible through stage.
+
+        Returns:
+            The loaded caption model
+        """
+        self.started_at = time.perf_counter()
+        self.state = "loading"
+        try:
+            # torch and transformers are only imported here, so the bot can
+            # start answering commands before they finish loading
+            self.set_stage("importing model libraries")
+            from caption_model import create_caption_model
+
+            self.set_stage(f"loading {self.backend} caption model")
+            self.caption_model = create_caption_model(self.backend)
+
+            if self.warm_up:
+                warm_up_started = time.perf_counter()
+                runs = warm_up_model(self.caption_model, self.set_stage)
+                if runs:
+                    logger.info(
+                        f"Warm-up: {runs} runs in {time.perf_counter() - warm_up_started:.1f}s"
+                    )
+
+            self.state = "ready"
+            self.set_stage("ready")
+            return self.caption_model
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            self.set_stage(f"failed: {e}")
+            raise
+        finally:
+            self.finished_at = time.perf_counter()
+
+    def describe(self) -> str:
+        """One-line summary of the loading progress."""
+        with self._lock:
+            stage = self.stage
+        if self.state == "ready":
+            return f"ready (loaded in {self.elapsed:.1f}s)"
+        if self.state == "failed":
+            return f"failed after {self.elapsed:.1f}s: {self.error}"
+        return f"{stage} ({self.elapsed:.0f}s elapsed)"
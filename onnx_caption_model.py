@@ -0,0 +1,246 @@
+import json
+import logging
+import time
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+from PIL import Image
+from transformers import BlipProcessor
+from caption_model import CaptionModel
+from blip_preprocessor import BlipPreprocessor
+from artifact_cache import is_fresh, onnx_optimized_path
+from config import (
+    ONNX_MODEL_DIR, ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS,
+    GENERATION_PROFILES, DEFAULT_PROFILE
+)
+from metrics import METRICS, observe_stage, time_stage
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class OnnxCaptionModel(CaptionModel):
+    """Runs BLIP caption generation on onnxruntime using graphs from export_onnx.py."""
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR,
+                 intra_op_threads: int = ONNX_INTRA_OP_THREADS,
+                 inter_op_threads: int = ONNX_INTER_OP_THREADS):
+        self.model_dir = Path(model_dir)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.sessions: dict = {}
+        self.export_info: dict = {}
+        # torch-only optimizations do not apply to onnxruntime
+        super().__init__(quantize_int8=False, bf16_autocast=False, torch_compile=False)
+
+    def _load_model(self):
+        """Load the exported graphs and the saved processor."""
+        try:
+            import onnxruntime as ort
+
+            logger.info(f"Loading ONNX caption model from: {self.model_dir}")
+            info_path = self.model_dir / "export_info.json"
+            if not info_path.exists():
+                raise FileNotFoundError(f"{info_path} not found, run export_onnx.py first")
+            self.export_info = json.loads(info_path.read_text())
+            self.device = "cpu"
+
+            self.processor = BlipProcessor.from_pretrained(str(self.model_dir))  # type: ignore
+            self.preprocessor = BlipPreprocessor(self.processor, self.text_prompt)
+
+            model_name = self.export_info.get("model_name", self.model_name)
+            reused = 0
+            for name in ("vision_encoder", "cross_attention_kv", "decoder_init", "decoder_step"):
+                source = self.model_dir / f"{name}.onnx"
+                optimized = onnx_optimized_path(source, model_name, ort.__version__)
+                if optimized is not None and is_fresh(optimized, source):
+                    # Graph optimizations were already applied when it was saved
+                    options = self._session_options(ort, ort.GraphOptimizationLevel.ORT_DISABLE_ALL)
+                    path = optimized
+                    reused += 1
+                else:
+                    options = self._session_options(ort, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+                    if optimized is not None:
+                        options.optimized_model_filepath = str(optimized)
+                    path = source
+                self.sessions[name] = ort.InferenceSession(
+                    str(path), options, providers=["CPUExecutionProvider"]
+                )
+            if reused:
+                logger.info(f"Reused {reused} cached optimized ONNX graphs")
+
+            if any(profile.get("num_beams", 1) > 1 for profile in GENERATION_PROFILES.values()):
+                logger.info("ONNX backend decodes without beam search (num_beams is ignored)")
+            logger.info("ONNX caption model loaded successfully!")
+
+        except Exception as e:
+            logger.error(f"Error loading ONNX caption model: {e}")
+            raise
+
+    def _session_options(self, ort, optimization_level):
+        """Session options with the configured thread settings."""
+        options = ort.SessionOptions()
+        options.graph_optimization_level = optimization_level
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        return options
+
+    @property
+    def optimizations(self) -> str:
+        """Short description of the active inference backend."""
+        return "onnxruntime"
+
+    def _process_scores(self, logits: np.ndarray, sequences: np.ndarray,
+                        repetition_penalty: float, temperature: float) -> np.ndarray:
+        """Apply repetition penalty and temperature to next-token logits."""
+        scores = logits.astype(np.float32, copy=True)
+
+        # Same rule as transformers: shrink scores of tokens already generated
+        seen = np.take_along_axis(scores, sequences, axis=1)
+        seen = np.where(seen < 0, seen * repetition_penalty, seen / repetition_penalty)
+        np.put_along_axis(scores, sequences, seen, axis=1)
+
+        if temperature and temperature != 1.0:
+            scores /= temperature
+        return scores
+
+    def _sample(self, scores: np.ndarray, rng: np.random.Generator, top_p: float) -> np.ndarray:
+        """Nucleus (top-p) sampling over each row of scores."""
+        order = np.argsort(-scores, axis=1)
+        sorted_scores = np.take_along_axis(scores, order, axis=1)
+        probs = np.exp(sorted_scores - sorted_scores[:, :1])
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        # Drop tokens once the preceding ones already cover top_p (always keep the first)
+        cumulative = np.cumsum(probs, axis=1)
+        probs[(cumulative - probs) > top_p] = 0.0
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        draws = rng.random((scores.shape[0], 1))
+        picks = (np.cumsum(probs, axis=1) < draws).sum(axis=1)
+        picks = np.minimum(picks, scores.shape[1] - 1)
+        return order[np.arange(scores.shape[0]), picks]
+
+    def _run_encoder(self, images: List[Image.Image]) -> list:
+        """Run the exported vision encoder and return one embedding per image."""
+        assert self.preprocessor is not None
+        with time_stage("preprocess"):
+            pixel_values = self.preprocessor.pixel_values(images).numpy()
+        with time_stage("encoder"):
+            image_embeds = self.sessions["vision_encoder"].run(
+                None, {"pixel_values": pixel_values}
+            )[0]
+        return [row.copy() for row in image_embeds]
+
+    def _stack(self, embeddings: list) -> np.ndarray:
+        """Combine per-image embeddings into one batch."""
+        return np.stack(embeddings)
+
+    def _embedding_nbytes(self, embedding: np.ndarray) -> int:
+        """Memory held by one cached embedding."""
+        return embedding.nbytes
+
+    def decode(self, image_embeds: np.ndarray, conditional: Optional[bool] = None,
+               **generate_kwargs) -> List[Optional[str]]:
+        """
+        Generate captions from image embeddings produced by encode_images().
+
+        Args:
+            image_embeds: Output of encode_images()
+            conditional: Start from the text prompt (defaults to whether one is configured)
+            **generate_kwargs: max_length, do_sample, temperature, top_p, repetition_penalty
+                and streamer (beam search settings are ignored); unset ones come
+                from DEFAULT_PROFILE
+
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        batch_size = len(image_embeds)
+        try:
+            if self.preprocessor is None or not self.sessions:
+                logger.error("Model or processor not loaded")
+                return [None] * batch_size
+
+            if conditional is None:
+                conditional = bool(self.text_prompt)
+            generate_kwargs = {**GENERATION_PROFILES[DEFAULT_PROFILE], **generate_kwargs}
+            max_length = generate_kwargs.get("max_length", self.max_length)
+            do_sample = generate_kwargs.get("do_sample", False)
+            streamer = generate_kwargs.get("streamer")
+            temperature = generate_kwargs.get("temperature", 1.0)
+            top_p = generate_kwargs.get("top_p", self.top_p)
+            repetition_penalty = generate_kwargs.get("repetition_penalty", self.repetition_penalty)
+
+            started = time.perf_counter()
+            cross_session = self.sessions["cross_attention_kv"]
+            cross_feeds = dict(zip(
+                (output.name for output in cross_session.get_outputs()),
+                cross_session.run(None, {"image_embeds": image_embeds})
+            ))
+
+            if conditional:
+                input_ids, _ = self.preprocessor.prompt_inputs(batch_size)
+                # BLIP decodes from [DEC] in place of [CLS] and drops the trailing [SEP]
+                sequences = input_ids.numpy()[:, :-1].astype(np.int64)
+            else:
+                sequences = np.zeros((batch_size, 1), dtype=np.int64)
+            sequences[:, 0] = self.export_info["bos_token_id"]
+            prompt_length = sequences.shape[1]
+            if streamer is not None:
+                streamer.put(sequences)
+
+            sep_token_id = self.export_info["sep_token_id"]
+            pad_token_id = self.export_info["pad_token_id"]
+            step_session = self.sessions["decoder_step"]
+            past_names = [item.name for item in step_session.get_inputs()
+                          if item.name.startswith("past_")]
+
+            outputs = self.sessions["decoder_init"].run(
+                None, {"input_ids": sequences, **cross_feeds}
+            )
+            finished = np.zeros(batch_size, dtype=bool)
+            rng = np.random.default_rng()
+
+            while True:
+                scores = self._process_scores(outputs[0], sequences,
+                                              repetition_penalty, temperature)
+                if do_sample:
+                    next_tokens = self._sample(scores, rng, top_p)
+                else:
+                    next_tokens = scores.argmax(axis=1)
+                next_tokens = np.where(finished, pad_token_id, next_tokens).astype(np.int64)
+                sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+                finished |= next_tokens == sep_token_id
+                if streamer is not None:
+                    streamer.put(next_tokens)
+
+                if finished.all() or sequences.shape[1] >= max_length:
+                    break
+
+                feeds = {"input_ids": next_tokens[:, None], **cross_feeds}
+                feeds.update(zip(past_names, outputs[1:]))
+                outputs = step_session.run(None, feeds)
+
+            if streamer is not None:
+                streamer.end()
+            observe_stage("decoder", time.perf_counter() - started)
+            METRICS.counter("caption_tokens_generated_total", "Caption tokens generated").inc(
+                int((sequences[:, prompt_length:] != pad_token_id).sum())
+            )
+
+            tokenizer = getattr(self.processor, "tokenizer", None)
+            if tokenizer is None:
+                logger.error("Processor does not have a tokenizer attribute")
+                return [None] * batch_size
+            captions = tokenizer.batch_decode(sequences, skip_special_tokens=True)
+
+            captions = [self._clean_caption(caption) for caption in captions]
+            logger.info(f"Generated captions: {captions}")
+            return captions
+
+        except Exception as e:
+            logger.error(f"Error generating captions: {e}")
+            return [None] * batch_size
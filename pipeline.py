@@ -0,0 +1,455 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Awaitable, Callable, Hashable, List, Optional, Tuple
+from PIL import Image
+from telegram import Bot
+from config import (
+    IO_WORKERS, INFERENCE_WORKERS, CACHE_ENABLED,
+    GENERATION_PROFILES, STREAM_CAPTIONS, MAX_DOWNLOAD_BYTES,
+    DOWNLOAD_MEMORY_BUDGET, DECODE_MEMORY_BUDGET, MEMORY_WAIT_TIMEOUT
+)
+from image_processor import ImageProcessor
+from caption_batcher import CaptionBatcher
+from downloader import ImageDownloader
+from caption_cache import CaptionCache, perceptual_hash
+from generation_policy import AdaptiveProfilePolicy
+from fair_scheduler import FairScheduler, SchedulerSlot
+from memory_budget import MemoryBudget, MemoryBudgetError
+from metrics import METRICS, observe_stage, time_stage
+
+if TYPE_CHECKING:
+    from caption_model import CaptionModel
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class CaptionPipeline:
+    """Runs image download, preprocessing and captioning off the event loop."""
+
+    def __init__(self, image_processor: ImageProcessor,
+                 caption_model: Optional["CaptionModel"] = None):
+        """
+        Args:
+            image_processor: Decodes and preprocesses downloaded images
+            caption_model: Caption model, or None to attach one later with
+                attach_model() (images queue until then)
+        """
+        self.image_processor = image_processor
+        self.caption_model: Optional["CaptionModel"] = None
+        self.inference_executor: Optional[ThreadPoolExecutor] = None
+        self.caption_batcher: Optional[CaptionBatcher] = None
+        self._model_ready = asyncio.Event()
+
+        # Blocking network and PIL work shares one pool; torch gets its own
+        # threads (see attach_model) so a slow download never delays a ready batch
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=IO_WORKERS, thread_name_prefix="image-io"
+        )
+        self.downloader = ImageDownloader()
+        self.caption_cache: Optional[CaptionCache] = CaptionCache() if CACHE_ENABLED else None
+        self.profile_policy = AdaptiveProfilePolicy()
+        # Decides which user's image enters the pipeline next
+        self.scheduler = FairScheduler()
+        # Bound the bytes held by images in flight; separate budgets for files
+        # and bitmaps so an image holding its file never waits on itself
+        self.download_budget = MemoryBudget(DOWNLOAD_MEMORY_BUDGET, "download", MEMORY_WAIT_TIMEOUT)
+        self.decode_budget = MemoryBudget(DECODE_MEMORY_BUDGET, "decode", MEMORY_WAIT_TIMEOUT)
+        self._register_metrics()
+
+        if caption_model is not None:
+            self.attach_model(caption_model)
+
+    def _register_metrics(self):
+        """
+        Expose queue, load and cache counters, read when metrics are scraped.
+
+        The callbacks replace those of any earlier pipeline in this process.
+        """
+        METRICS.gauge("caption_in_flight", "Images being downloaded, decoded or captioned",
+                      fn=lambda: self.scheduler.in_flight)
+        METRICS.gauge("caption_scheduler_queued", "Images waiting for a scheduler slot",
+                      fn=lambda: self.scheduler.queued)
+        METRICS.counter("caption_scheduler_rejected_total", "Images refused as busy",
+                        fn=lambda: self.scheduler.rejected)
+        METRICS.gauge("caption_batch_queue_depth", "Images waiting to be batched",
+                      fn=lambda: self.caption_batcher.pending if self.caption_batcher else 0)
+        for name in ("download", "decode"):
+            attr = f"{name}_budget"
+            METRICS.gauge("caption_memory_reserved_bytes", "Bytes reserved by images in flight",
+                          fn=lambda attr=attr: getattr(self, attr).in_use, budget=name)
+            METRICS.gauge("caption_memory_waiting", "Images waiting for memory",
+                          fn=lambda attr=attr: getattr(self, attr).waiting, budget=name)
+        for kind in ("file_id", "hash"):
+            METRICS.counter("caption_cache_hits_total", "Caption cache hits",
+                            fn=lambda key=f"{kind}_hits": self._cache_stat(key), kind=kind)
+            METRICS.counter("caption_cache_misses_total", "Caption cache misses",
+                            fn=lambda key=f"{kind}_misses": self._cache_stat(key), kind=kind)
+
+    def _cache_stat(self, key: str) -> int:
+        """One caption cache counter (0 without a cache)."""
+        return self.caption_cache.get_stats()[key] if self.caption_cache is not None else 0
+
+    @property
+    def in_flight(self) -> int:
+        """Images currently downloading, decoding or captioning."""
+        return self.scheduler.in_flight
+
+    @property
+    def model_ready(self) -> bool:
+        """Whether a caption model is attached."""
+        return self.caption_model is not None
+
+    def attach_model(self, caption_model: "CaptionModel"):
+        """
+        Start captioning with a loaded model, releasing images queued while it loaded.
+
+        Args:
+            caption_model: CaptionModel or a drop-in replacement
+        """
+        # Models that run elsewhere (worker processes, a caption server) say
+        # how many batches they can take at once
+        inference_workers = getattr(caption_model, "parallel_batches", INFERENCE_WORKERS)
+        self.inference_executor = ThreadPoolExecutor(
+            max_workers=inference_workers, thread_name_prefix="inference"
+        )
+        self.caption_batcher = CaptionBatcher(
+            caption_model,
+            executor=self.inference_executor,
+            max_concurrent_batches=inference_workers
+        )
+        self.caption_model = caption_model
+        self._model_ready.set()
+
+    def fail_model(self):
+        """Give up on the model: images waiting for it (and later ones) get no caption."""
+        self._model_ready.set()
+
+    async def _cache_call(self, method: Callable, *args, **kwargs):
+        """Run a caption cache method, in the I/O pool when it may hit the database."""
+        assert self.caption_cache is not None
+        if not self.caption_cache.persistent:
+            return method(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, functools.partial(method, *args, **kwargs))
+
+    async def get_cached_caption(self, file_unique_id: Optional[str],
+                                 profile: Optional[str] = None) -> Optional[str]:
+        """
+        Look up a caption for a file that was already described.
+
+        Args:
+            file_unique_id: Telegram file_unique_id of the image
+            profile: Generation profile selected for the chat
+
+        Returns:
+            Cached caption or None on miss
+        """
+        if self.caption_cache is None or not file_unique_id:
+            return None
+        return await self._cache_call(self.caption_cache.get_by_file_id, file_unique_id,
+                                      self.profile_policy.resolve(profile))
+
+    def _prepare_image(self, data: bytearray) -> Tuple[Optional[Image.Image], Optional[int]]:
+        """Decode and preprocess downloaded bytes, hashing the result for the cache."""
+        with time_stage("decode"):
+            processed_image = self.image_processor.process_image_bytes(data)
+        if processed_image is None or self.caption_cache is None:
+            return processed_image, None
+        with time_stage("hash"):
+            return processed_image, perceptual_hash(processed_image)
+
+    async def _fetch_image(self, bot: Bot, file_id: str
+                           ) -> Tuple[Optional[Image.Image], Optional[int]]:
+        """Download and preprocess a Telegram file, returning the image and its hash."""
+        # Get file path
+        with time_stage("get_file"):
+            file = await bot.get_file(file_id)
+        if file.file_path is None:
+            return None, None
+
+        download_url = self.image_processor.build_download_url(file.file_path)
+        if download_url is None:
+            return None, None
+
+        try:
+            # The download buffer is sized up front, so reserve the reported size
+            async with self.download_budget.reserve(file.file_size or MAX_DOWNLOAD_BYTES) as raw:
+                with time_stage("download"):
+                    data = await self.downloader.download(
+                        download_url, file.file_size, probe=self.image_processor.probe_header
+                    )
+                if data is None:
+                    return None, None
+                raw.shrink(len(data))
+
+                # Decoded bitmaps dwarf the file; hold both until only the result is left
+                decoded_bytes = self.image_processor.estimate_decoded_bytes(data)
+                async with self.decode_budget.reserve(decoded_bytes):
+                    return await self.prepare_image(data)
+        except MemoryBudgetError as e:
+            logger.warning(f"Image refused: {e}")
+            return None, None
+
+    async def prepare_image(self, data: bytearray
+                            ) -> Tuple[Optional[Image.Image], Optional[int]]:
+        """
+        Decode and preprocess image bytes in the I/O pool.
+
+        Args:
+            data: Encoded image file contents
+
+        Returns:
+            Tuple of (preprocessed image or None, perceptual hash or None without a cache)
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, self._prepare_image, data)
+
+    async def caption_telegram_file(self, bot: Bot, file_id: str,
+                                    file_unique_id: Optional[str] = None,
+                                    profile: Optional[str] = None,
+                                    on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+                                    slot: Optional[SchedulerSlot] = None,
+                                    user: Hashable = None) -> Optional[str]:
+        """
+        Download, preprocess and caption a Telegram image without blocking the loop.
+
+        Args:
+            bot: Bot used to resolve the file
+            file_id: Telegram file id of the image
+            file_unique_id: Telegram file_unique_id, used as the cache key
+            profile: Generation profile selected for the chat
+            on_partial: Receives partial captions when the caption is streamed
+            slot: Place already reserved with scheduler.reserve(), freed when
+                captioning ends; reserved here for user if None
+            user: Key the image is scheduled under when no slot is given
+
+        Returns:
+            Generated caption string or None if failed
+
+        Raises:
+            SchedulerBusyError: No slot was given and the scheduler refused the image
+        """
+        # Captions are cached per requested profile (fallback captions are not stored)
+        cache_profile = self.profile_policy.resolve(profile)
+        if slot is None:
+            slot = self.scheduler.reserve(user)
+        async with slot:
+            with time_stage("scheduler_wait"):
+                await slot.wait()
+            processed_image, image_hash = await self._fetch_image(bot, file_id)
+            if processed_image is None:
+                return None
+
+            # Near-duplicates (recompressed forwards, re-sent photos) skip inference
+            if image_hash is not None and self.caption_cache is not None:
+                cached = await self._cache_call(self.caption_cache.get_by_hash, image_hash,
+                                                cache_profile)
+                if cached is not None:
+                    await self._cache_call(self.caption_cache.put, cached,
+                                           file_unique_id=file_unique_id, profile=cache_profile)
+                    return cached
+
+            caption, degraded = await self.caption_image(processed_image, profile, on_partial)
+
+            # Fallback captions are not cached so the image gets a proper one later
+            if caption is not None and self.caption_cache is not None and not degraded:
+                await self._cache_call(self.caption_cache.put, caption,
+                                       file_unique_id=file_unique_id, image_hash=image_hash,
+                                       profile=cache_profile)
+            return caption
+
+    async def caption_telegram_files(self, bot: Bot,
+                                     files: List[Tuple[str, Optional[str]]],
+                                     profile: Optional[str] = None,
+                                     slot: Optional[SchedulerSlot] = None,
+                                     user: Hashable = None) -> List[Optional[str]]:
+        """
+        Caption several Telegram images (an album) together.
+
+        All files are downloaded concurrently and the images are submitted to
+        the batcher at once, so they share forward passes. The whole album
+        uses a single scheduler slot.
+
+        Args:
+            bot: Bot used to resolve the files
+            files: (file_id, file_unique_id) per image
+            profile: Generation profile selected for the chat
+            slot: Place already reserved with scheduler.reserve(); reserved
+                here for user if None
+            user: Key the album is scheduled under when no slot is given
+
+        Returns:
+            Caption string or None per file, in input order
+
+        Raises:
+            SchedulerBusyError: No slot was given and the scheduler refused the album
+        """
+        # Captions are cached per requested profile (fallback captions are not stored)
+        cache_profile = self.profile_policy.resolve(profile)
+        captions: List[Optional[str]] = [
+            await self.get_cached_caption(file_unique_id, cache_profile)
+            for _, file_unique_id in files
+        ]
+        missing = [index for index, caption in enumerate(captions) if caption is None]
+        if not missing:
+            return captions
+
+        if slot is None:
+            slot = self.scheduler.reserve(user)
+        async with slot:
+            with time_stage("scheduler_wait"):
+                await slot.wait()
+            fetched = await asyncio.gather(
+                *(self._fetch_image(bot, files[index][0]) for index in missing),
+                return_exceptions=True
+            )
+
+            to_caption = []
+            for index, result in zip(missing, fetched):
+                if isinstance(result, BaseException):
+                    logger.error(f"Error fetching album image: {result}")
+                    continue
+                processed_image, image_hash = result
+                if processed_image is None:
+                    continue
+                if image_hash is not None and self.caption_cache is not None:
+                    cached = await self._cache_call(self.caption_cache.get_by_hash, image_hash,
+                                                    cache_profile)
+                    if cached is not None:
+                        captions[index] = cached
+                        await self._cache_call(self.caption_cache.put, cached,
+                                               file_unique_id=files[index][1],
+                                               profile=cache_profile)
+                        continue
+                to_caption.append((index, processed_image, image_hash))
+
+            if to_caption:
+                generated, degraded = await self.caption_images(
+                    [image for _, image, _ in to_caption], profile
+                )
+                for (index, _, image_hash), caption in zip(to_caption, generated):
+                    captions[index] = caption
+                    if caption is not None and self.caption_cache is not None and not degraded:
+                        await self._cache_call(self.caption_cache.put, caption,
+                                               file_unique_id=files[index][1],
+                                               image_hash=image_hash, profile=cache_profile)
+        return captions
+
+    async def caption_images(self, images: List[Image.Image], profile: Optional[str] = None
+                             ) -> Tuple[List[Optional[str]], bool]:
+        """
+        Caption preprocessed images submitted to the batcher together.
+
+        Args:
+            images: Preprocessed PIL Image objects
+            profile: Generation profile requested for the images
+
+        Returns:
+            Tuple of (caption or None per image, whether the fallback profile was used)
+        """
+        await self._model_ready.wait()
+        if self.caption_batcher is None:
+            return [None] * len(images), False
+
+        requested = self.profile_policy.resolve(profile)
+        chosen = self.profile_policy.choose(requested, self.caption_batcher.pending)
+        started = time.perf_counter()
+        captions = await asyncio.gather(
+            *(self.caption_batcher.submit(image, chosen) for image in images)
+        )
+        elapsed = time.perf_counter() - started
+        self.profile_policy.record_latency(elapsed)
+        observe_stage("caption", elapsed)
+        return list(captions), chosen != requested
+
+    async def caption_image(self, image: Image.Image, profile: Optional[str] = None,
+                            on_partial: Optional[Callable[[str], Awaitable[None]]] = None
+                            ) -> Tuple[Optional[str], bool]:
+        """
+        Caption a preprocessed image through the batcher (or streamed when idle).
+
+        Args:
+            image: Preprocessed PIL Image object
+            profile: Generation profile requested for the image
+            on_partial: Receives partial captions when the caption is streamed
+
+        Returns:
+            Tuple of (caption or None, whether the fallback profile was used)
+        """
+        # Images that arrive while the model loads wait here, already decoded
+        await self._model_ready.wait()
+        if self.caption_batcher is None:
+            return None, False
+
+        # Under load the requested profile may be swapped for the cheaper fallback
+        requested = self.profile_policy.resolve(profile)
+        chosen = self.profile_policy.choose(requested, self.caption_batcher.pending)
+        started = time.perf_counter()
+        if on_partial is not None and self._can_stream(chosen):
+            caption = await self._stream_caption(image, chosen, on_partial)
+        else:
+            caption = await self.caption_batcher.submit(image, chosen)
+        elapsed = time.perf_counter() - started
+        self.profile_policy.record_latency(elapsed)
+        # Batch queue wait plus inference, as seen by one image
+        observe_stage("caption", elapsed)
+        return caption, chosen != requested
+
+    def _can_stream(self, profile: str) -> bool:
+        """
+        Whether a caption can be streamed without costing batch throughput.
+
+        Streaming decodes one image at a time, so it is only used for
+        single-beam profiles and while no other images wait for a batch.
+        """
+        return (STREAM_CAPTIONS
+                and self.caption_batcher is not None
+                and GENERATION_PROFILES[profile].get("num_beams", 1) == 1
+                and self.caption_batcher.pending == 0)
+
+    async def _stream_caption(self, image: Image.Image, profile: str,
+                              on_partial: Callable[[str], Awaitable[None]]) -> Optional[str]:
+        """Caption one image in the inference pool, forwarding partial captions to the loop."""
+        assert self.caption_model is not None
+        caption_model = self.caption_model
+        loop = asyncio.get_running_loop()
+        partials: asyncio.Queue = asyncio.Queue()
+
+        def run() -> Optional[str]:
+            try:
+                return caption_model.stream_caption(
+                    image, lambda text: loop.call_soon_threadsafe(partials.put_nowait, text),
+                    profile
+                )
+            finally:
+                loop.call_soon_threadsafe(partials.put_nowait, None)
+
+        result = loop.run_in_executor(self.inference_executor, run)
+        while True:
+            partial = await partials.get()
+            # Skip ahead to the newest text if the callback fell behind
+            while partial is not None and not partials.empty():
+                partial = partials.get_nowait()
+            if partial is None:
+                break
+            await on_partial(partial)
+        return await result
+
+    async def shutdown(self):
+        """Stop the batcher and release worker threads."""
+        if self.caption_batcher is not None:
+            await self.caption_batcher.stop()
+        await self.downloader.close()
+        if self.caption_cache is not None:
+            self.caption_cache.close()
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+        if self.inference_executor is not None:
+            self.inference_executor.shutdown(wait=False, cancel_futures=True)
+        close = getattr(self.caption_model, "close", None)
+        if close is not None:
+            close()
+        logger.info("Caption pipeline shut down")
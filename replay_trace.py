@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded request trace against the captioning pipeline.
+Reads a JSONL trace written with TRACE_PATH set and sends each image request
+to the bot's handlers at its original time offset (optionally sped up).
+Telegram is stubbed: replies are recorded instead of sent, and files are
+synthetic JPEGs with the recorded dimensions, served from a local HTTP
+server so the real downloader is used. Re-sent files and albums keep their
+hashed ids, so cache hits and album grouping happen as they did in
+production. Prints reply outcomes, end-to-end latency percentiles and the
+per-stage breakdown as JSON.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# Replays must not record themselves; the token only has to be present
+os.environ.pop("TRACE_PATH", None)
+os.environ.setdefault("BOT_TOKEN", "123456:REPLAY")
+
+class _FileServer:
+    """Serves the synthetic image files over HTTP from its own thread."""
+
+    def __init__(self, files: Dict[str, bytes]):
+        self.files = files
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = server.files.get(self.path.rsplit("/", 1)[-1])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self._httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._httpd.shutdown()
+
+class _StubBot:
+    """The Bot API calls the pipeline makes, answered locally."""
+
+    def __init__(self, files: _FileServer):
+        self.files = files
+
+    async def get_file(self, file_id: str):
+        return SimpleNamespace(
+            file_path=f"http://127.0.0.1:{self.files.port}/file/{file_id}",
+            file_size=len(self.files.files[file_id])
+        )
+
+class _StubMessage:
+    """Incoming message whose replies are recorded instead of sent."""
+
+    def __init__(self, message_id: int, chat_id: str, media_group_id: Optional[str]):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.media_group_id = media_group_id
+        self.replies: List[str] = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+def build_files(entries: List[dict], default_size: str) -> Dict[str, bytes]:
+    """One synthetic JPEG per distinct file in the trace, in its recorded size."""
+    from bench import make_synthetic_jpeg
+
+    default_width, default_height = (int(value) for value in default_size.lower().split("x"))
+    files: Dict[str, bytes] = {}
+    for index, entry in enumerate(entries):
+        if entry["file"] in files:
+            continue
+        width = entry.get("width") or default_width
+        height = entry.get("height") or default_height
+        files[entry["file"]] = make_synthetic_jpeg(index, width, height)
+    return files
+
+async def replay(entries: List[dict], speed: float, default_size: str) -> dict:
+    """Send the trace's requests to the bot at their recorded offsets."""
+    import bot as bot_module
+    from bench import reset_stage_metrics, stage_breakdown
+    from config import CONCURRENT_UPDATES
+    from metrics import METRICS
+
+    files = _FileServer(build_files(entries, default_size))
+    files.start()
+    stub_bot = _StubBot(files)
+    bot = bot_module.ImageCaptionBot(lazy_model_loading=False)
+    reset_stage_metrics()
+
+    # Like the application, handle at most CONCURRENT_UPDATES updates at once
+    updates = asyncio.Semaphore(CONCURRENT_UPDATES)
+    chat_data: Dict[str, dict] = {}
+    message_ids = itertools.count(1)
+    lateness: List[float] = []
+    errors = 0
+
+    async def handle(entry: dict, due: float):
+        nonlocal errors
+        lateness.append(time.perf_counter() - due)
+        message = _StubMessage(next(message_ids), entry["chat"], entry.get("group"))
+        data = chat_data.setdefault(entry["chat"], {})
+        if entry.get("profile"):
+            data["profile"] = entry["profile"]
+        update = SimpleNamespace(message=message, effective_user=None)
+        context = SimpleNamespace(args=[], chat_data=data, bot=stub_bot)
+        async with updates:
+            try:
+                await bot._describe_file(update, context, entry["file"], entry["file"])
+            except Exception as e:
+                errors += 1
+                print(f"Request failed: {e}", file=sys.stderr)
+
+    first_ts = entries[0]["ts"]
+    started = time.perf_counter()
+    tasks = []
+    for entry in entries:
+        due = started + (entry["ts"] - first_ts) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.get_running_loop().create_task(handle(entry, due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    outcomes = {
+        dict(labels)["result"]: int(counter.value)  # type: ignore[attr-defined]
+        for labels, counter in METRICS.collect("caption_requests_total").items()
+    }
+    await bot.pipeline.shutdown()
+    files.stop()
+
+    ordered = sorted(lateness)
+    return {
+        "requests": len(entries),
+        "distinct_files": len(files.files),
+        "chats": len(chat_data),
+        "speed": speed,
+        "trace_duration_s": round(entries[-1]["ts"] - first_ts, 2),
+        "replay_duration_s": round(elapsed, 2),
+        "max_dispatch_lateness_ms": round(ordered[-1] * 1000, 1) if ordered else None,
+        "outcomes": outcomes,
+        "errors": errors,
+        "scheduler": bot.pipeline.scheduler.get_stats(),
+        "stages": stage_breakdown()
+    }
+
+def main():
+    """Replay a trace and print JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="JSONL trace recorded with TRACE_PATH")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed factor (2 = twice as fast as recorded)")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests")
+    parser.add_argument("--default-size", default="1280x960",
+                        help="Size for files without recorded dimensions (documents)")
+    args = parser.parse_args()
+
+    from request_trace import read_trace
+
+    entries = sorted(read_trace(args.trace), key=lambda entry: entry["ts"])
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit(f"No requests in {args.trace}")
+
+    results = asyncio.run(replay(entries, max(args.speed, 1e-3), args.default_size))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Iterator, Optional
+from config import TRACE_PATH, TRACE_SALT
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TraceRecorder:
+    """
+    Appends an anonymized JSON line per incoming image request.
+
+    Chat, file and album ids are replaced by salted hashes, so a trace shows
+    repeats and grouping without identifying anyone. Without a configured
+    salt a random one is used, and hashes only match within one run.
+    """
+
+    def __init__(self, path: str = TRACE_PATH, salt: Optional[str] = TRACE_SALT):
+        self.path = path
+        self._salt = (salt or os.urandom(16).hex()).encode()
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self.recorded = 0
+        logger.info(f"Recording request trace to {path}")
+
+    def anonymize(self, value: Any) -> Optional[str]:
+        """Salted hash of an id (None stays None)."""
+        if value is None:
+            return None
+        digest = hashlib.blake2b(str(value).encode(), key=self._salt[:64], digest_size=8)
+        return digest.hexdigest()
+
+    def record(self, kind: str, chat_id: int, file_unique_id: str,
+               media_group_id: Optional[str] = None, width: Optional[int] = None,
+               height: Optional[int] = None, file_size: Optional[int] = None,
+               mime_type: Optional[str] = None, profile: Optional[str] = None):
+        """
+        Append one image request.
+
+        Args:
+            kind: "photo" or "document"
+            chat_id: Telegram chat id (hashed)
+            file_unique_id: Telegram file_unique_id (hashed)
+            media_group_id: Album id (hashed), None outside albums
+            width: Image width, if Telegram reported it
+            height: Image height, if Telegram reported it
+            file_size: File size in bytes, if Telegram reported it
+            mime_type: Document MIME type
+            profile: Generation profile selected for the chat
+        """
+        entry = {
+            "ts": round(time.time(), 3),
+            "kind": kind,
+            "chat": self.anonymize(chat_id),
+            "file": self.anonymize(file_unique_id),
+            "group": self.anonymize(media_group_id),
+            "width": width,
+            "height": height,
+            "file_size": file_size,
+            "mime_type": mime_type,
+            "profile": profile
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file.closed:
+                return
+            try:
+                self._file.write(line)
+                self.recorded += 1
+            except OSError as e:
+                logger.warning(f"Could not write request trace: {e}")
+
+    def close(self):
+        """Close the trace file."""
+        with self._lock:
+            self._file.close()
+
+def read_trace(path: str) -> Iterator[dict]:
+    """
+    Read a trace written by TraceRecorder, skipping malformed lines.
+
+    Args:
+        path: JSONL trace file
+    """
+    with open(path, encoding="utf-8") as trace:
+        for number, line in enumerate(trace, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning(f"Skipping malformed trace line {number}")
+                continue
+            if "ts" in entry and "file" in entry:
+                yield entry
@@ -100,6 +100,54 @@ def test_components():
         print(f"❌ Failed to import CaptionModel: {e}")
         return False
 
+def test_preprocessing_parity():
+    """Test that the fast preprocessing path matches BlipProcessor (None if it cannot run)."""
+    print("\n🔍 Testing preprocessing parity...")
+    
+    try:
+        import torch
+        from PIL import Image
+        from transformers import BlipProcessor
+        from config import MODEL_NAME, TEXT_PROMPT
+        from blip_preprocessor import BlipPreprocessor
+    except Exception as e:
+        print(f"❌ Failed to import preprocessing components: {e}")
+        return False
+    
+    try:
+        processor = BlipProcessor.from_pretrained(MODEL_NAME)
+    except Exception as e:
+        print(f"⚠️  Skipped: could not load processor ({e})")
+        return None
+    
+    try:
+        sizes = [(512, 384), (384, 700), (384, 384), (100, 90), (1024, 768)]
+        images = [Image.effect_noise(size, 60).convert('RGB') for size in sizes]
+        images.append(Image.linear_gradient('L').resize((600, 400)))
+        
+        reference = processor(
+            images=images, text=[TEXT_PROMPT] * len(images), return_tensors="pt"
+        )
+        preprocessor = BlipPreprocessor(processor, TEXT_PROMPT)
+        pixel_values = preprocessor.pixel_values(images)
+        input_ids, _ = preprocessor.prompt_inputs(len(images))
+        
+        difference = (pixel_values - reference["pixel_values"]).abs()
+        # Resampling backends may round a few pixels differently
+        if difference.max().item() > 0.05 or difference.mean().item() > 1e-3:
+            print(f"❌ pixel_values differ (max {difference.max().item():.4f}, "
+                  f"mean {difference.mean().item():.6f})")
+            return False
+        if not torch.equal(input_ids, reference["input_ids"]):
+            print("❌ Prompt tokens differ from BlipProcessor")
+            return False
+        
+        print(f"✅ Preprocessing matches BlipProcessor (max difference {difference.max().item():.4f})")
+        return True
+    except Exception as e:
+        print(f"❌ Error checking preprocessing parity: {e}")
+        return False
+
 def test_environment():
     """Test environment setup."""
     print("\n🔍 Testing environment...")
@@ -150,21 +198,30 @@ def main():
         test_imports,
         test_config,
         test_components,
+        test_preprocessing_parity,
         test_environment,
         test_cuda
     ]
     
     passed = 0
+    skipped = 0
     total = len(tests)
     
+    # A test returns None when it could not run (not counted as passed)
     for test in tests:
-        if test():
+        result = test()
+        if result is None:
+            skipped += 1
+        elif result:
             passed += 1
     
     print("\n" + "=" * 50)
-    print(f"📊 Test Results: {passed}/{total} tests passed")
+    print(f"📊 Test Results: {passed}/{total} tests passed"
+          f"{f', {skipped} skipped' if skipped else ''}")
     
-    if passed == total:
+    if passed + skipped == total and skipped:
+        print("⚠️  No failures, but some checks were skipped (see above).")
+    elif passed == total:
         print("🎉 All tests passed! Your setup is ready.")
         print("\nNext steps:")
         print("1. Set your BOT_TOKEN in .env file")
@@ -177,7 +234,7 @@ def main():
         print("2. Check your Python version (3.8+ required)")
         print("3. Set up your .env file with BOT_TOKEN")
     
-    return passed == total
+    return passed + skipped == total
 
 if __name__ == "__main__":
     success = main()
@@ -0,0 +1,281 @@
+import logging
+import os
+import queue
+import threading
+from typing import Callable, List, Optional
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+from config import (
+    QUANTIZE_INT8, BF16_AUTOCAST, TORCH_COMPILE, BATCH_MAX_SIZE,
+    INFERENCE_PROCESSES, INFERENCE_PROCESS_THREADS, WORKER_START_TIMEOUT
+)
+from caption_model import CaptionModel
+from metrics import time_stage
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def available_cores() -> int:
+    """CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _worker_main(model, processor, pixel_buffer: torch.Tensor, embed_buffer: torch.Tensor,
+                 connection, threads: int, quantize_int8: bool, bf16_autocast: bool,
+                 torch_compile: bool):
+    """
+    Worker process: caption batches whose inputs arrive in shared-memory buffers.
+
+    The parent writes embeddings it has cached into embed_buffer and the
+    pixels of the other images (in order) into pixel_buffer. The worker
+    encodes those, stores their embeddings in embed_buffer for the parent
+    to cache, and decodes the whole batch.
+
+    Messages in: ("batch", count, profiles, missing), ("stream", 1, [profile], missing)
+    or None to exit, where missing lists the batch positions to encode.
+    Messages out: ("ready", optimizations), ("partial", text) while streaming,
+    and ("done", captions) once per request.
+    """
+    # Each worker gets its own slice of the cores instead of every process
+    # spawning one torch thread per core
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    # The weights arrive as shared-memory tensors; int8 and compile create
+    # worker-local copies of what they transform. Embeddings are cached by the parent
+    caption_model = CaptionModel(
+        quantize_int8=quantize_int8, bf16_autocast=bf16_autocast, torch_compile=torch_compile,
+        embedding_cache_bytes=0, model=model, processor=processor
+    )
+    connection.send(("ready", caption_model.optimizations))
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        kind, count, profiles, missing = message
+        captions: List[Optional[str]] = [None] * count
+        try:
+            if missing:
+                encoded = caption_model.encode_pixel_values(pixel_buffer[:len(missing)])
+                embed_buffer[missing] = encoded.to(embed_buffer.dtype)
+            image_embeds = embed_buffer[:count]
+            if kind == "stream":
+                captions = [caption_model.stream_decode(
+                    image_embeds, lambda text: connection.send(("partial", text)), profiles[0]
+                )]
+            else:
+                captions = caption_model.decode_profiles(image_embeds, profiles)
+        except Exception as e:
+            logger.error(f"Error in caption worker: {e}")
+        connection.send(("done", captions))
+
+class _Worker:
+    """Parent-side handle of one worker process."""
+
+    def __init__(self, index: int, process, connection, pixel_buffer: torch.Tensor,
+                 embed_buffer: torch.Tensor):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.pixel_buffer = pixel_buffer
+        self.embed_buffer = embed_buffer
+
+class ProcessPoolCaptionModel:
+    """
+    Serves captions from several worker processes sharing one copy of the model weights.
+
+    The parent loads BLIP once and moves its parameters into shared memory;
+    workers map the same storage, so RAM does not grow with the number of
+    workers. Images are preprocessed in the calling thread and handed over
+    through a per-worker shared pixel buffer, so only small control messages
+    are pickled. The embedding cache lives in the parent: cached embeddings
+    are passed through a shared buffer and only the other images are encoded.
+    Drop-in replacement for CaptionModel in CaptionPipeline.
+    """
+
+    def __init__(self, num_workers: int = INFERENCE_PROCESSES,
+                 threads_per_worker: int = INFERENCE_PROCESS_THREADS,
+                 max_batch_size: int = BATCH_MAX_SIZE):
+        self.num_workers = max(1, num_workers)
+        self.threads_per_worker = threads_per_worker or max(1, available_cores() // self.num_workers)
+        self.max_batch_size = max(1, max_batch_size)
+        # CaptionPipeline runs one batch per worker at a time
+        self.parallel_batches = self.num_workers
+
+        # Load plain fp32 weights once; optimizations are applied in the workers
+        self.base = CaptionModel(quantize_int8=False, bf16_autocast=False, torch_compile=False)
+        if self.base.device != "cpu":
+            raise ValueError("The inference worker pool only supports CPU inference")
+        assert self.base.model is not None and self.base.preprocessor is not None
+        self.base.model.share_memory()
+
+        self._context = mp.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self.worker_optimizations = "fp32"
+
+        for index in range(self.num_workers):
+            worker = self._spawn(index)
+            self._workers.append(worker)
+            self._idle.put(worker)
+        logger.info(f"Started {self.num_workers} caption worker(s) with "
+                    f"{self.threads_per_worker} torch thread(s) each")
+        if QUANTIZE_INT8 or TORCH_COMPILE:
+            logger.info("QUANTIZE_INT8/TORCH_COMPILE give each worker its own copy of the "
+                        "transformed weights, so RAM grows with INFERENCE_PROCESSES")
+
+    @property
+    def embedding_cache(self):
+        """Vision-encoder output cache shared by all workers (None if disabled)."""
+        return self.base.embedding_cache
+
+    def _spawn(self, index: int) -> _Worker:
+        """Start one worker process and wait until its model is ready."""
+        preprocessor = self.base.preprocessor
+        assert preprocessor is not None
+        pixel_buffer = torch.empty(
+            (self.max_batch_size, 3, preprocessor.height, preprocessor.width), dtype=torch.float32
+        ).share_memory_()
+        assert self.base.model is not None
+        vision = self.base.model.config.vision_config
+        patches = (preprocessor.height // vision.patch_size) * (preprocessor.width // vision.patch_size)
+        embed_buffer = torch.empty(
+            (self.max_batch_size, patches + 1, vision.hidden_size), dtype=torch.float32
+        ).share_memory_()
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.base.model, self.base.processor, pixel_buffer, embed_buffer,
+                  child_connection, self.threads_per_worker, QUANTIZE_INT8, BF16_AUTOCAST,
+                  TORCH_COMPILE),
+            name=f"caption-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        child_connection.close()
+
+        if not parent_connection.poll(WORKER_START_TIMEOUT):
+            process.terminate()
+            raise RuntimeError(f"Caption worker {index} did not start within "
+                               f"{WORKER_START_TIMEOUT} seconds")
+        try:
+            _, self.worker_optimizations = parent_connection.recv()
+        except EOFError:
+            raise RuntimeError(f"Caption worker {index} exited during startup")
+        return _Worker(index, process, parent_connection, pixel_buffer, embed_buffer)
+
+    def _checkout(self) -> _Worker:
+        """Take an idle worker, replacing it first if its process died."""
+        worker = self._idle.get()
+        if not worker.process.is_alive():
+            logger.warning(f"Caption worker {worker.index} died, restarting it")
+            try:
+                with self._lock:
+                    replacement = self._spawn(worker.index)
+                    self._workers[worker.index] = replacement
+            except Exception:
+                # Keep the slot so a later request retries the restart
+                self._idle.put(worker)
+                raise
+            worker = replacement
+        return worker
+
+    def _request(self, images: List[Image.Image], kind: str, profiles: List[Optional[str]],
+                 on_partial: Optional[Callable[[str], None]] = None) -> List[Optional[str]]:
+        """Run one request of at most max_batch_size images on an idle worker."""
+        preprocessor = self.base.preprocessor
+        cache = self.base.embedding_cache
+        assert preprocessor is not None
+        keys = [self.base._embedding_key(image) for image in images] if cache is not None else []
+        cached = [cache.get(key) for key in keys] if cache is not None else [None] * len(images)
+        missing = [index for index, embedding in enumerate(cached) if embedding is None]
+
+        worker = self._checkout()
+        try:
+            for index, embedding in enumerate(cached):
+                if embedding is not None:
+                    worker.embed_buffer[index].copy_(embedding)
+            if missing:
+                with time_stage("preprocess"):
+                    pixel_values = preprocessor.pixel_values([images[index] for index in missing])
+                worker.pixel_buffer[:len(missing)].copy_(pixel_values)
+            worker.connection.send((kind, len(images), profiles, missing))
+            while True:
+                message, payload = worker.connection.recv()
+                if message == "done":
+                    break
+                if on_partial is not None:
+                    on_partial(payload)
+            if cache is not None:
+                for index in missing:
+                    embedding = worker.embed_buffer[index].clone()
+                    cache.put(keys[index], embedding, self.base._embedding_nbytes(embedding))
+            return payload
+        except (EOFError, OSError) as e:
+            logger.error(f"Caption worker {worker.index} failed: {e}")
+            return [None] * len(images)
+        finally:
+            self._idle.put(worker)
+
+    @property
+    def optimizations(self) -> str:
+        """Short description of the inference optimizations used by the workers."""
+        return f"{self.worker_optimizations} x{self.num_workers} processes"
+
+    def generate_caption(self, image: Image.Image) -> Optional[str]:
+        """Generate a caption for one image."""
+        return self.generate_captions([image])[0]
+
+    def generate_captions(self, images: List[Image.Image],
+                          profiles: Optional[List[str]] = None) -> List[Optional[str]]:
+        """
+        Generate captions for a batch of images on one worker (see CaptionModel).
+
+        Args:
+            images: List of PIL Image objects
+            profiles: Generation profile name per image (None entries use DEFAULT_PROFILE)
+
+        Returns:
+            List of caption strings (None for failed entries), in input order
+        """
+        profile_list = list(profiles) if profiles else [None] * len(images)
+        captions: List[Optional[str]] = []
+        for start in range(0, len(images), self.max_batch_size):
+            end = start + self.max_batch_size
+            captions.extend(self._request(images[start:end], "batch", profile_list[start:end]))
+        return captions
+
+    def stream_caption(self, image: Image.Image, on_partial: Callable[[str], None],
+                       profile: Optional[str] = None) -> Optional[str]:
+        """Generate one caption on a worker, reporting partial captions (see CaptionModel)."""
+        return self._request([image], "stream", [profile], on_partial)[0]
+
+    def get_model_info(self) -> dict:
+        """Get information about the loaded model and the workers."""
+        info = self.base.get_model_info()
+        info["optimizations"] = self.optimizations
+        info["workers"] = self.num_workers
+        info["threads_per_worker"] = self.threads_per_worker
+        return info
+
+    def close(self):
+        """Stop the worker processes."""
+        for worker in self._workers:
+            try:
+                worker.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        logger.info("Caption workers stopped")